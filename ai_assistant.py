@@ -0,0 +1,362 @@
+"""AI助手代理：浏览器只与本站通信，服务器调用大模型接口并以 SSE 流式转发
+
+- 接口密钥只保存在服务器配置中，不再出现在页面里；
+- 后端可替换：DeepseekBackend 通过保持连接的连接池调用 chat/completions 接口，
+  StubBackend 直接生成回答，用于测试和压测，不访问外部服务；
+- 回答按规范化后的问题缓存（LRU + 过期时间），“怎么查积分”“积分怎么用”这类重复问题直接返回；
+- 每个用户按令牌桶限流，每个进程同时转发的请求数有上限，AI助手不会占满处理购买的线程。
+"""
+import http.client
+import json
+import queue
+import re
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+from urllib.parse import urlsplit
+
+
+class AssistantError(Exception):
+    """请求未被接受（问题为空或过长、接口出错），消息直接返回给用户"""
+
+
+class RateLimited(AssistantError):
+    """用户提问太频繁"""
+
+
+def normalize_prompt(prompt):
+    """缓存键：全角转半角、忽略大小写、合并空白、去掉结尾的标点"""
+    text = unicodedata.normalize('NFKC', prompt).lower()
+    text = re.sub(r'\s+', ' ', text).strip()
+    return text.rstrip('?!.。？！~～ ')
+
+
+def sse_event(payload):
+    return f"data: {json.dumps(payload, ensure_ascii=False)}\n\n"
+
+
+class ResponseCache:
+    """按规范化问题缓存完整回答的 LRU，条目 ttl 秒后过期"""
+
+    def __init__(self, maxsize=512, ttl=3600):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # key -> (过期时间, 回答)
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and entry[0] > now:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            if entry:
+                del self._entries[key]
+            self.misses += 1
+            return None
+
+    def put(self, key, answer):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, answer)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self._entries), 'maxsize': self.maxsize}
+
+
+class RateLimiter:
+    """每个用户一个令牌桶：最多连续 burst 次，之后每分钟恢复 per_minute 次"""
+
+    def __init__(self, per_minute=6, burst=3, max_users=10000):
+        self.rate = per_minute / 60.0
+        self.burst = burst
+        self.max_users = max_users
+        self._lock = threading.Lock()
+        self._buckets = OrderedDict()  # user_id -> (令牌数, 上次更新时间)
+        self.rejected = 0
+
+    def allow(self, user_id):
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated = self._buckets.pop(user_id, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - updated) * self.rate)
+            allowed = tokens >= 1
+            if allowed:
+                tokens -= 1
+            else:
+                self.rejected += 1
+            self._buckets[user_id] = (tokens, now)
+            while len(self._buckets) > self.max_users:
+                self._buckets.popitem(last=False)  # 最久没有提问的用户，令牌早已恢复满
+            return allowed
+
+
+class ConnectionPool:
+    """到同一主机的 HTTP(S) 长连接池，每次请求复用空闲连接，避免重复 TCP/TLS 握手"""
+
+    def __init__(self, url, size=4, timeout=60):
+        parts = urlsplit(url)
+        self.https = parts.scheme == 'https'
+        self.host = parts.hostname
+        self.port = parts.port
+        self.timeout = timeout
+        self._idle = queue.LifoQueue(maxsize=size)
+        self.created = 0
+
+    def get(self):
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            self.created += 1
+            connection_class = http.client.HTTPSConnection if self.https else http.client.HTTPConnection
+            return connection_class(self.host, self.port, timeout=self.timeout)
+
+    def put(self, connection):
+        try:
+            self._idle.put_nowait(connection)
+        except queue.Full:
+            connection.close()
+
+
+class DeepseekBackend:
+    """OpenAI 兼容的 chat/completions 流式接口"""
+
+    def __init__(self, url, api_key, model='deepseek-chat', pool_size=4, timeout=60):
+        self.path = urlsplit(url).path
+        self.api_key = api_key
+        self.model = model
+        self.pool = ConnectionPool(url, size=pool_size, timeout=timeout)
+
+    def stream(self, prompt):
+        """逐段返回回答内容；未配置接口密钥时抛出 AssistantError"""
+        if not self.api_key:
+            raise AssistantError('AI助手未配置（服务器未设置接口密钥），请联系管理员')
+        body = json.dumps({
+            'model': self.model,
+            'messages': [{'role': 'user', 'content': prompt}],
+            'stream': True,
+        })
+        headers = {
+            'Content-Type': 'application/json',
+            'Authorization': f'Bearer {self.api_key}',
+            'Accept': 'text/event-stream',
+        }
+        connection = self.pool.get()
+        reusable = False
+        try:
+            try:
+                connection.request('POST', self.path, body=body, headers=headers)
+                response = connection.getresponse()
+            except (http.client.RemoteDisconnected, BrokenPipeError, ConnectionResetError):
+                # 空闲连接已被服务器关闭，重新连接一次
+                connection.close()
+                connection.request('POST', self.path, body=body, headers=headers)
+                response = connection.getresponse()
+            if response.status != 200:
+                response.read()
+                reusable = not response.will_close
+                raise AssistantError(f'AI服务返回错误（{response.status}）')
+            for line in response:
+                line = line.strip()
+                if not line.startswith(b'data:'):
+                    continue
+                data = line[5:].strip()
+                if data == b'[DONE]':
+                    break
+                choices = json.loads(data).get('choices') or [{}]
+                content = (choices[0].get('delta') or {}).get('content')
+                if content:
+                    yield content
+            response.read()  # 读完剩余数据，连接才能复用
+            reusable = not response.will_close
+        finally:
+            if reusable:
+                self.pool.put(connection)
+            else:
+                connection.close()
+
+    def stats(self):
+        return {'connections_created': self.pool.created}
+
+
+class StubBackend:
+    """本地测试后端：把问题原样放进固定格式的回答，按 delay 秒的间隔分段返回"""
+
+    def __init__(self, delay=0.0, chunk_size=8):
+        self.delay = delay
+        self.chunk_size = chunk_size
+        self.calls = 0
+
+    def stream(self, prompt):
+        self.calls += 1
+        answer = f'（测试回答）关于“{prompt}”，请在爱心屋页面查看剩余积分和兑换记录。'
+        for start in range(0, len(answer), self.chunk_size):
+            if self.delay:
+                time.sleep(self.delay)
+            yield answer[start:start + self.chunk_size]
+
+    def stats(self):
+        return {'calls': self.calls}
+
+
+class _Flight:
+    """一个正在转发的回答：同一问题的其他请求跟随读取已收到的分段，不再调用接口"""
+
+    def __init__(self):
+        self.parts = []
+        self.done = False
+        self.error = None
+        self._changed = threading.Condition()
+
+    def append(self, content):
+        with self._changed:
+            self.parts.append(content)
+            self._changed.notify_all()
+
+    def finish(self, error=None):
+        with self._changed:
+            self.done = True
+            self.error = error
+            self._changed.notify_all()
+
+    def follow(self, timeout):
+        """逐段返回内容，结束后返回错误信息（成功时为 None）"""
+        index = 0
+        while True:
+            with self._changed:
+                if not self._changed.wait_for(lambda: index < len(self.parts) or self.done, timeout):
+                    return '抱歉，AI服务暂时不可用'
+                parts, done, error = self.parts[index:], self.done, self.error
+            index += len(parts)
+            yield from parts
+            if done and index == len(self.parts):
+                return error
+
+
+class AssistantProxy:
+    """组合后端、缓存和限流：open() 校验请求后返回 SSE 事件生成器
+
+    同一问题同时只调用一次接口，其他请求跟随这次调用的结果（不占用转发名额，不计入限流）。
+    """
+
+    def __init__(self, backend, cache, limiter, max_streams=4, max_prompt_chars=2000, timeout=60):
+        self.backend = backend
+        self.cache = cache
+        self.limiter = limiter
+        self.max_prompt_chars = max_prompt_chars
+        self.timeout = timeout
+        self._streams = threading.BoundedSemaphore(max_streams)
+        self._lock = threading.Lock()
+        self._flights = {}  # 规范化问题 -> _Flight
+        self.busy = 0
+        self.errors = 0
+        self.coalesced = 0
+
+    def open(self, user_id, prompt):
+        if prompt is not None and not isinstance(prompt, str):
+            raise AssistantError('问题格式不正确')
+        prompt = (prompt or '').strip()
+        if not prompt:
+            raise AssistantError('请输入问题')
+        if len(prompt) > self.max_prompt_chars:
+            raise AssistantError(f'问题不能超过{self.max_prompt_chars}个字')
+        key = normalize_prompt(prompt)
+        cached = self.cache.get(key)
+        if cached is not None:
+            return self._replay(cached)  # 缓存命中不调用后端，不计入限流
+        with self._lock:
+            flight = self._flights.get(key)
+            if flight is not None:
+                self.coalesced += 1
+        if flight is not None:
+            return self._follow(flight)
+        if not self.limiter.allow(user_id):
+            raise RateLimited('提问太频繁，请稍后再试')
+        return self._relay(key, prompt)
+
+    def _replay(self, answer):
+        yield sse_event({'content': answer})
+        yield sse_event({'done': True, 'cached': True})
+
+    def _follow(self, flight):
+        parts = flight.follow(self.timeout)
+        while True:
+            try:
+                content = next(parts)
+            except StopIteration as stop:
+                error = stop.value
+                break
+            yield sse_event({'content': content})
+        yield sse_event({'error': error} if error else {'done': True, 'cached': True})
+
+    def _relay(self, key, prompt):
+        # 生成器开始执行时才占用名额和登记：客户端在响应开始前断开时不会泄漏
+        with self._lock:
+            flight = self._flights.get(key)
+            if flight is None:
+                flight = self._flights[key] = _Flight()
+                leader = True
+            else:
+                leader = False
+                self.coalesced += 1
+        if not leader:
+            yield from self._follow(flight)
+            return
+        if not self._streams.acquire(blocking=False):
+            with self._lock:
+                self.busy += 1
+            self._land(key, flight, '当前使用人数较多，请稍后再试')
+            yield sse_event({'error': flight.error})
+            return
+        error = '请求已取消'  # 客户端中途断开（生成器被关闭）时跟随的请求收到的错误
+        stream = self.backend.stream(prompt)
+        try:
+            for content in stream:
+                flight.append(content)
+                yield sse_event({'content': content})
+            error = None
+        except AssistantError as e:
+            error = str(e)
+            self._count_error()
+        except (OSError, http.client.HTTPException, ValueError):
+            error = '抱歉，AI服务暂时不可用'
+            self._count_error()
+        finally:
+            stream.close()  # 客户端断开时立即关闭到接口的连接
+            self._streams.release()
+            self._land(key, flight, error)
+        yield sse_event({'error': error} if error else {'done': True, 'cached': False})
+
+    def _count_error(self):
+        # 计数与 _flights 共用一把锁，多个请求线程同时更新不会丢失
+        with self._lock:
+            self.errors += 1
+
+    def _land(self, key, flight, error):
+        if not error and flight.parts:
+            # 只缓存完整的回答，先写入缓存再注销，之后的请求直接命中缓存
+            self.cache.put(key, ''.join(flight.parts))
+        with self._lock:
+            self._flights.pop(key, None)
+        flight.finish(error)
+
+    def stats(self):
+        return {
+            'cache': self.cache.stats(),
+            'rate_limited': self.limiter.rejected,
+            'coalesced': self.coalesced,
+            'busy': self.busy,
+            'errors': self.errors,
+            'backend': self.backend.stats(),
+        }
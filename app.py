@@ -1,37 +1,245 @@
-from flask import Flask, render_template, request, redirect, url_for, session, jsonify
+from flask import Flask, render_template, request, redirect, url_for, session, jsonify, abort, g, send_file, \
+    Response, stream_with_context
 from flask_sqlalchemy import SQLAlchemy
+import click
+import json
+from contextlib import contextmanager
 from datetime import datetime
 import os
 from werkzeug.utils import secure_filename
-import uuid  # 用于生成唯一文件名
-from openpyxl import load_workbook  # 新增：处理Excel文件
+from werkzeug.datastructures import MultiDict
+from urllib.parse import quote
+from excel_stream import ExcelFormatError, spooled_upload, iter_roster, estimate_rows
+from excel_merge import merge_excel, merged_output_path
+from migrations import run_migrations
+from catalog_cache import CatalogCache, CATALOG_VERSION, STOCK_VERSION
+from static_assets import init_static_assets, precompress_static
+from request_metrics import init_request_metrics
+from job_queue import JobQueue, JobFailed, JOB_SUCCEEDED
+import reports
+from reports import ReportCache, ReportError, ReportRange, USERS_VERSION
+import purchase_archive
+from purchase_archive import ARCHIVE_VERSION, ArchiveError
+from user_search import contains_pattern, create_search_index, search_index_exists, search_user_ids, uses_index
+from flash_sale import FlashSaleManager, FlashSaleRejected
+from events import EventHub
+from fragment_cache import FragmentCache, conditional_page, folder_version
+from ai_assistant import (AssistantError, AssistantProxy, DeepseekBackend, RateLimited, RateLimiter,
+                          ResponseCache, StubBackend)
+from auth import Identity, IdentityCache, BULK_HASH_METHOD, hash_password, verify_password, needs_rehash
+from image_pipeline import ImageError, store_image, remove_image, picture_sources, VARIANTS, VARIANT_FORMATS
 import sqlite3  # 新增：直接使用sqlite3
 import tempfile  # 新增：处理临时文件
-import io  # 新增：字节流处理
+import time
+import random
+import hashlib
+import shutil
+from sqlalchemy import event, or_, and_, insert, literal, select, update
+from sqlalchemy.orm import contains_eager, joinedload
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import OperationalError
 
 app = Flask(__name__)
 app.secret_key = 'your_secret_key'
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///shop.db'
+app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('SHOP_DATABASE_URI', 'sqlite:///shop.db')
 app.config['UPLOAD_FOLDER'] = 'static/images'  # 图片上传目录
 app.config['ALLOWED_EXTENSIONS'] = {'png', 'jpg', 'jpeg', 'gif'}  # 允许的图片格式
+app.config['SQLITE_BUSY_TIMEOUT_MS'] = 5000  # 等待写锁的最长时间
+app.config['PURCHASE_MAX_RETRIES'] = 5  # 遇到SQLITE_BUSY时的重试次数
+# 抢购模式：每件商品排队等待写入的请求上限、每批写入的请求数、各进程重新读取抢购商品和库存的间隔（秒）、
+# 请求等待写入结果的最长时间（秒）
+app.config['FLASH_SALE_QUEUE_SIZE'] = int(os.environ.get('SHOP_FLASH_SALE_QUEUE_SIZE', 1000))
+app.config['FLASH_SALE_BATCH_SIZE'] = int(os.environ.get('SHOP_FLASH_SALE_BATCH_SIZE', 50))
+app.config['FLASH_SALE_REFRESH_INTERVAL'] = 1.0
+app.config['FLASH_SALE_TIMEOUT'] = 10.0
+app.config['IMPORT_BATCH_SIZE'] = 1000  # Excel导入时每批写入的行数
+app.config['ADMIN_PAGE_SIZE'] = 60  # 管理员页面每次加载的用户数
+app.config['BATCH_MAX_OPERATIONS'] = 5000  # /admin/batch 一次请求最多包含的操作数
+app.config['FRAGMENT_CACHE_SIZE'] = 8192  # 进程内缓存的商品卡片、兑换记录、用户卡片等页面片段数
+# 连接池：每个进程最多 pool_size + max_overflow 个连接，与 serve 的线程数相匹配
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+    'pool_size': int(os.environ.get('SHOP_DB_POOL_SIZE', 10)),
+    'max_overflow': int(os.environ.get('SHOP_DB_MAX_OVERFLOW', 10)),
+    'pool_timeout': 30,
+    'pool_recycle': 3600,
+}
+# SQLite 每个连接的 PRAGMA：page cache 约 20MB（负数单位为KB），内存映射读取最多 256MB
+app.config['SQLITE_CACHE_SIZE_KB'] = 20000
+app.config['SQLITE_MMAP_SIZE'] = 256 * 1024 * 1024
+# 请求级性能统计，设置环境变量 SHOP_METRICS=1 开启，结果见 /metrics
+app.config['METRICS_ENABLED'] = os.environ.get('SHOP_METRICS') == '1'
+app.config['METRICS_TOKEN'] = os.environ.get('SHOP_METRICS_TOKEN')  # Prometheus 抓取时使用的 Bearer token
+app.config['METRICS_N_PLUS_ONE_THRESHOLD'] = 10  # 同一请求内相同SQL执行次数达到该值时记为疑似N+1
+app.config['METRICS_PROFILE_SAMPLE_RATE'] = float(os.environ.get('SHOP_PROFILE_SAMPLE_RATE', 0))  # cProfile 采样比例
+app.config['METRICS_PROFILE_DIR'] = 'profiles'
+app.config['METRICS_PROFILE_KEEP'] = 20  # 只保留最慢的若干个 .prof 文件
+# 密码哈希方法，迭代次数越大越安全、登录越慢；修改后旧密码在用户下次登录时自动按新方法重新哈希
+app.config['PASSWORD_HASH_METHOD'] = os.environ.get('SHOP_PASSWORD_HASH_METHOD', 'pbkdf2:sha256:600000')
+# Excel批量导入的初始密码（学号）使用的低成本方法，首次登录时升级
+app.config['PASSWORD_BULK_HASH_METHOD'] = BULK_HASH_METHOD
+app.config['IDENTITY_CACHE_SIZE'] = 4096  # 进程内缓存的登录身份数量
+app.config['IDENTITY_CACHE_TTL'] = 30  # 身份缓存有效期（秒），其他进程修改用户后最多延迟这么久生效
+# 后台任务：上传文件和结果文件保存目录、每个进程的任务线程数（0 表示只由 flask run-jobs 进程执行）
+app.config['JOB_DIR'] = os.environ.get('SHOP_JOB_DIR', os.path.join(app.instance_path, 'jobs'))
+app.config['JOB_WORKER_THREADS'] = int(os.environ.get('SHOP_JOB_THREADS', 1))
+app.config['JOB_RETENTION_DAYS'] = 7  # 完成的任务及其文件保留天数
+# 兑换记录归档（flask archive-purchases）：按学年保存的归档文件目录、学年开始的月份
+app.config['ARCHIVE_DIR'] = os.environ.get('SHOP_ARCHIVE_DIR', os.path.join(app.instance_path, 'archive'))
+app.config['ACADEMIC_YEAR_START_MONTH'] = 9
+# AI助手（/deepseek）：服务器端代理大模型接口。SHOP_AI_BACKEND=stub 时使用本地测试后端，不访问外部服务
+app.config['AI_BACKEND'] = os.environ.get('SHOP_AI_BACKEND', 'deepseek')
+app.config['AI_API_URL'] = os.environ.get('SHOP_AI_API_URL', 'https://api.deepseek.com/v1/chat/completions')
+app.config['AI_API_KEY'] = os.environ.get('SHOP_AI_API_KEY')  # 未设置时AI助手提示未配置
+app.config['AI_MODEL'] = os.environ.get('SHOP_AI_MODEL', 'deepseek-chat')
+app.config['AI_TIMEOUT'] = 60  # 等待大模型接口数据的最长时间（秒）
+app.config['AI_POOL_SIZE'] = 4  # 每个进程保持的接口长连接数
+app.config['AI_MAX_STREAMS'] = int(os.environ.get('SHOP_AI_MAX_STREAMS', 4))  # 每个进程同时转发的回答数
+app.config['AI_RATE_PER_MINUTE'] = 6  # 每个用户每分钟可以提问的次数（缓存命中的问题不计入）
+app.config['AI_RATE_BURST'] = 3  # 每个用户可以连续提问的次数
+app.config['AI_CACHE_SIZE'] = 512  # 缓存的回答数
+app.config['AI_CACHE_TTL'] = 3600  # 回答缓存有效期（秒）
+# 实时事件（/events）：每个进程同时保持的 SSE 连接数（每个连接占用一个处理请求的线程，超出后浏览器改为轮询）、
+# 每个连接保持的时间（秒）、轮询间隔（毫秒）、各进程读取其他进程所做修改的间隔（秒）
+app.config['EVENTS_MAX_STREAMS'] = int(os.environ.get('SHOP_EVENTS_MAX_STREAMS', 4))
+app.config['EVENTS_STREAM_SECONDS'] = 25
+app.config['EVENTS_POLL_RETRY_MS'] = 5000
+app.config['EVENTS_POLL_INTERVAL'] = 1.0
 
 # 确保上传目录存在
 os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
 
+# 静态文件地址附加内容哈希并返回长期缓存头
+init_static_assets(app)
+request_metrics = init_request_metrics(app)
+
 db = SQLAlchemy(app)
 
 
+# 每个SQLite连接开启WAL模式和busy_timeout，读写互不阻塞，写锁冲突时先等待而不是立即报错；
+# WAL模式下 synchronous=NORMAL 在断电时最多丢失最后几个事务，但不会损坏数据库
+@event.listens_for(Engine, 'connect')
+def set_sqlite_pragma(dbapi_connection, connection_record):
+    if not isinstance(dbapi_connection, sqlite3.Connection):
+        return
+    cursor = dbapi_connection.cursor()
+    cursor.execute('PRAGMA journal_mode=WAL')
+    cursor.execute('PRAGMA synchronous=NORMAL')
+    cursor.execute(f"PRAGMA busy_timeout={app.config['SQLITE_BUSY_TIMEOUT_MS']}")
+    cursor.execute(f"PRAGMA cache_size=-{app.config['SQLITE_CACHE_SIZE_KB']}")
+    cursor.execute(f"PRAGMA mmap_size={app.config['SQLITE_MMAP_SIZE']}")
+    cursor.execute('PRAGMA temp_store=MEMORY')
+    cursor.close()
+
+
 class PurchaseRecord(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     product_id = db.Column(db.Integer, db.ForeignKey('product.id'), nullable=False)
     quantity = db.Column(db.Integer, nullable=False)
     purchase_time = db.Column(db.DateTime, default=datetime.utcnow)
+    unit_price = db.Column(db.Integer)  # 购买时的单价（积分），退货按此返还
+    total_cost = db.Column(db.Integer)  # 购买时实际扣除的积分
 
     # 关系
     product = db.relationship('Product', backref='purchases')
     user = db.relationship('User', backref='purchases')
 
+    # 与 migrations.py 中的迁移3、9保持一致
+    __table_args__ = (
+        db.Index('ix_purchase_record_user_product_time', 'user_id', 'product_id', 'purchase_time'),
+        db.Index('ix_purchase_record_user_time', 'user_id', 'purchase_time'),
+        db.Index('ix_purchase_record_time', 'purchase_time'),  # 迁移9：统计报表按时间区间查询
+    )
+
+
+class PurchaseCounter(db.Model):
+    """每个用户每件商品每月的已购数量，购买和退货时与购买记录在同一事务中更新"""
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True)
+    product_id = db.Column(db.Integer, db.ForeignKey('product.id'), primary_key=True)
+    year_month = db.Column(db.String(7), primary_key=True)  # 格式：2025-11
+    quantity = db.Column(db.Integer, nullable=False, default=0)
+
+
+# 积分流水类型
+LEDGER_OPENING = 'opening'  # 启用流水时的期初余额
+LEDGER_IMPORT = 'import'  # Excel导入
+LEDGER_PURCHASE = 'purchase'  # 兑换商品
+LEDGER_REFUND = 'refund'  # 退货
+LEDGER_ADJUST = 'adjust'  # 管理员新建/修改用户
+
+
+class PointsLedger(db.Model):
+    """积分流水：只追加不修改，user.points 是各用户流水之和的缓存，与流水在同一事务中更新"""
+    __tablename__ = 'points_ledger'
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    kind = db.Column(db.String(20), nullable=False)
+    delta = db.Column(db.Integer, nullable=False)  # 积分变化量
+    balance_after = db.Column(db.Integer, nullable=False)  # 变化后的余额
+    purchase_record_id = db.Column(db.Integer)  # 兑换/退货对应的购买记录（退货后记录会被删除，不设外键）
+    note = db.Column(db.String(200))
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+    # 与 migrations.py 中的迁移7保持一致
+    __table_args__ = (
+        db.Index('ix_points_ledger_user_id', 'user_id', 'id'),
+    )
+
+
+class RosterFingerprint(db.Model):
+    """每个学号最近一次导入的花名册行的指纹，差异同步时与新表格逐行比较（与 migrations.py 中的迁移12保持一致）"""
+    __tablename__ = 'roster_fingerprint'
+    username = db.Column(db.String(80), primary_key=True)
+    row_hash = db.Column(db.String(32), nullable=False)
+    imported_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+
+class ArchiveManifest(db.Model):
+    """每次归档（批次）移到归档文件的学年和记录合计，见 purchase_archive.py（与 migrations.py 中的迁移13保持一致）"""
+    __tablename__ = 'archive_manifest'
+    batch_id = db.Column(db.String(32), primary_key=True)
+    period = db.Column(db.String(9), nullable=False, index=True)  # 学年，如 2024-2025
+    start_time = db.Column(db.DateTime, nullable=False)
+    end_time = db.Column(db.DateTime, nullable=False)
+    filename = db.Column(db.String(200), nullable=False)
+    record_count = db.Column(db.Integer, nullable=False)
+    total_quantity = db.Column(db.Integer, nullable=False)
+    total_cost = db.Column(db.Integer, nullable=False)
+    archived_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+
+class BackgroundJob(db.Model):
+    """后台任务（Excel导入、整理表格），由 job_queue.JobQueue 调度"""
+    __tablename__ = 'background_job'
+    id = db.Column(db.String(32), primary_key=True)
+    kind = db.Column(db.String(50), nullable=False)
+    status = db.Column(db.String(20), nullable=False)  # queued / running / succeeded / failed
+    created_by = db.Column(db.Integer)
+    original_filename = db.Column(db.String(255))
+    input_name = db.Column(db.String(255))
+    params = db.Column(db.Text)  # JSON
+    processed_rows = db.Column(db.Integer, nullable=False, default=0)
+    failed_rows = db.Column(db.Integer, nullable=False, default=0)
+    total_rows = db.Column(db.Integer)  # 估算的总行数，可能为空
+    result = db.Column(db.Text)  # JSON
+    error = db.Column(db.Text)
+    artifact_name = db.Column(db.String(255))  # 可下载的结果文件
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    started_at = db.Column(db.DateTime)
+    heartbeat_at = db.Column(db.DateTime)
+    finished_at = db.Column(db.DateTime)
+
+    # 与 migrations.py 中的迁移8保持一致
+    __table_args__ = (
+        db.Index('ix_background_job_status_created', 'status', 'created_at'),
+    )
+
+
+class CacheVersion(db.Model):
+    """进程间共享的缓存版本号，修改数据的事务中递增，各进程据此判断内存缓存是否过期"""
+    name = db.Column(db.String(50), primary_key=True)
+    version = db.Column(db.Integer, nullable=False, default=0)
+
 
 class Product(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -40,12 +248,13 @@ class Product(db.Model):
     price = db.Column(db.Float, nullable=False)
     stock = db.Column(db.Integer, nullable=False)
     limit = db.Column(db.Integer, nullable=False)
+    flash_sale = db.Column(db.Boolean, nullable=False, default=False)  # 抢购模式，见 flash_sale.py
 
 
 class User(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     username = db.Column(db.String(80), unique=True, nullable=False)
-    password = db.Column(db.String(80), nullable=False)
+    password = db.Column(db.String(255), nullable=False)  # 密码哈希
     is_admin = db.Column(db.Boolean, default=False)
     name = db.Column(db.String(80))  # 姓名
     gender = db.Column(db.String(10))  # 性别
@@ -60,55 +269,625 @@ def allowed_file(filename):
         filename.rsplit('.', 1)[1].lower() in app.config['ALLOWED_EXTENSIONS']
 
 
-# 修复后的数据库表结构更新函数
-def update_database_schema():
-    # 直接使用sqlite3连接数据库
-    conn = sqlite3.connect('shop.db')
-    cursor = conn.cursor()
+def remove_unused_picture(picture):
+    # 图片按内容去重后可能被多个商品共用，只有没有商品引用时才删除文件（在修改商品的事务提交后调用）
+    if not picture:
+        return
+    if Product.query.filter(Product.picture == picture).first() is None:
+        remove_image(app.config['UPLOAD_FOLDER'], picture)
 
-    # 检查并添加college字段
-    try:
-        cursor.execute('ALTER TABLE user ADD COLUMN college VARCHAR(100)')
-        print("成功添加college字段")
-    except sqlite3.OperationalError as e:
-        if "duplicate column name" in str(e).lower():
-            print("college字段已存在")
+
+@app.template_global()
+def product_picture(picture):
+    """商品图片的 src 和 srcset，模板中使用"""
+    return picture_sources(app.config['UPLOAD_FOLDER'], picture,
+                           lambda name: url_for('static', filename=f'images/{name}'))
+
+
+def bump_cache_version(name):
+    # 在当前事务中递增版本号，随修改一起提交
+    db.session.execute(db.text(
+        'INSERT INTO cache_version (name, version) VALUES (:name, 1) '
+        'ON CONFLICT (name) DO UPDATE SET version = version + 1'
+    ), {'name': name})
+
+
+def read_cache_versions():
+    return dict(db.session.query(CacheVersion.name, CacheVersion.version))
+
+
+catalog_cache = CatalogCache(
+    load_products=lambda: Product.query.order_by(Product.id).all(),
+    load_stock=lambda: dict(db.session.query(Product.id, Product.stock)),
+    read_versions=read_cache_versions
+)
+
+# 统计报表缓存：购买、退货、商品或用户变化（缓存版本号递增）时失效
+report_cache = ReportCache(read_cache_versions)
+
+# 页面片段缓存：键中包含行版本，不需要主动失效
+fragment_cache = FragmentCache(maxsize=app.config['FRAGMENT_CACHE_SIZE'])
+TEMPLATE_DIR = os.path.join(app.root_path, app.template_folder)
+
+
+def latest_ledger_ids(user_ids):
+    """每个用户最新一条积分流水的id（索引 ix_points_ledger_user_id）
+
+    兑换、退货和积分调整都会追加流水，用作用户积分和兑换记录的行版本。
+    """
+    return dict(db.session.query(PointsLedger.user_id, db.func.max(PointsLedger.id))
+                .filter(PointsLedger.user_id.in_(user_ids)).group_by(PointsLedger.user_id))
+
+
+def load_identity(user_id):
+    row = db.session.query(User.id, User.username, User.is_admin).filter(User.id == user_id).first()
+    return Identity(row.id, row.username, bool(row.is_admin)) if row else None
+
+
+identity_cache = IdentityCache(load_identity, maxsize=app.config['IDENTITY_CACHE_SIZE'],
+                               ttl=app.config['IDENTITY_CACHE_TTL'])
+
+
+def current_user():
+    """当前请求的登录身份，未登录或用户已被删除时返回 None"""
+    if 'identity' in g:
+        return g.identity
+    user_id = session.get('user_id')
+    if user_id is None and 'username' in session:
+        # 旧版本的会话只保存了用户名，查询一次后改为保存用户id
+        user_id = db.session.query(User.id).filter_by(username=session['username']).scalar()
+        if user_id is not None:
+            session['user_id'] = user_id
+    identity = identity_cache.get(user_id) if user_id is not None else None
+    if identity is None and session:
+        session.clear()
+    g.identity = identity
+    return identity
+
+
+def is_admin_user():
+    identity = current_user()
+    return identity is not None and identity.is_admin
+
+
+def points_price(price):
+    # 商品价格列为浮点数，积分按整数计算
+    return int(round(price))
+
+
+def parse_points_price(value):
+    """解析表单中的商品价格，只接受整数积分，否则抛出 ValueError"""
+    price = float(value)
+    if not price.is_integer() or price < 0:
+        raise ValueError(value)
+    return int(price)
+
+
+def record_points_change(user, delta, kind, purchase_record_id=None, note=None):
+    """修改用户积分余额并追加一条流水，调用方负责在同一事务中提交"""
+    user.points = (user.points or 0) + delta
+    user.remaining_points = user.points  # 同步更新剩余爱心币
+    db.session.add(PointsLedger(user_id=user.id, kind=kind, delta=delta, balance_after=user.points,
+                                purchase_record_id=purchase_record_id, note=note))
+
+
+def verify_points_ledger(fix=False):
+    """对比每个用户的缓存余额与流水合计，一次聚合查询完成
+
+    返回不一致的条目列表 [(user_id, 缓存余额, 流水合计)]；流水是权威数据，
+    fix=True 时用流水合计覆盖缓存余额。
+    """
+    ledger_totals = dict(
+        db.session.query(PointsLedger.user_id, db.func.sum(PointsLedger.delta)).group_by(PointsLedger.user_id)
+    )
+    drift = [
+        (user_id, points or 0, ledger_totals.get(user_id, 0))
+        for user_id, points in db.session.query(User.id, User.points)
+        if (points or 0) != ledger_totals.get(user_id, 0)
+    ]
+    if fix and drift:
+        db.session.bulk_update_mappings(User, [
+            {'id': user_id, 'points': total, 'remaining_points': total} for user_id, _, total in drift
+        ])
+        db.session.commit()
+    return drift
+
+
+job_queue = JobQueue(db, BackgroundJob, app.config['JOB_DIR'],
+                     retention_days=app.config['JOB_RETENTION_DAYS'])
+
+
+def start_job_worker():
+    """在当前进程中启动后台任务线程（gunicorn worker、serve 命令和开发服务器）"""
+    threads = app.config['JOB_WORKER_THREADS']
+    if threads > 0:
+        job_queue.start(app, threads)
+
+
+def year_month_of(moment):
+    return moment.strftime('%Y-%m')
+
+
+def purchase_counter_query(user_id, product_id, year_month):
+    # 限购检查按主键 (user_id, product_id, year_month) 查找当月计数
+    return db.session.query(PurchaseCounter).filter_by(
+        user_id=user_id, product_id=product_id, year_month=year_month
+    )
+
+
+def get_purchase_counter(user_id, product_id, year_month, lock=False):
+    query = purchase_counter_query(user_id, product_id, year_month).populate_existing()
+    if lock:
+        query = query.with_for_update()
+    return query.first()
+
+
+def add_to_purchase_counter(user_id, product_id, moment, quantity):
+    # 调用方负责提交事务；退货时 quantity 为负数
+    counter = get_purchase_counter(user_id, product_id, year_month_of(moment))
+    if counter is None:
+        counter = PurchaseCounter(user_id=user_id, product_id=product_id,
+                                  year_month=year_month_of(moment), quantity=0)
+        db.session.add(counter)
+    counter.quantity = max(counter.quantity + quantity, 0)
+    return counter
+
+
+def purchase_history_query(user_id):
+    # 用户兑换记录（最新在前），使用索引 ix_purchase_record_user_time
+    return PurchaseRecord.query \
+        .filter_by(user_id=user_id) \
+        .join(Product) \
+        .options(contains_eager(PurchaseRecord.product)) \
+        .order_by(PurchaseRecord.purchase_time.desc())
+
+
+class PurchaseError(Exception):
+    """购买校验失败（库存、积分或限购不满足），消息直接返回给前端"""
+
+
+def is_sqlite_busy(error):
+    message = str(getattr(error, 'orig', error)).lower()
+    return 'database is locked' in message or 'database is busy' in message
+
+
+def begin_locked_transaction():
+    # 结束当前会话中可能存在的只读事务，保证下面的检查读到的是最新数据
+    db.session.rollback()
+    connection = db.session.connection()
+    if connection.dialect.name == 'sqlite':
+        # BEGIN IMMEDIATE 在事务开始时就拿到写锁，后续的检查和写入不会与其他购买交错
+        connection.exec_driver_sql('BEGIN IMMEDIATE')
+        return False
+    return True  # 其他数据库使用行锁（SELECT ... FOR UPDATE）
+
+
+def _purchase_once(user_id, product_id, quantity):
+    use_row_lock = begin_locked_transaction()
+    product_query = db.session.query(Product).filter_by(id=product_id).populate_existing()
+    user_query = db.session.query(User).filter_by(id=user_id).populate_existing()
+    if use_row_lock:
+        product_query = product_query.with_for_update()
+        user_query = user_query.with_for_update()
+    product = product_query.first()
+    user = user_query.first()
+    if product is None or user is None:
+        db.session.rollback()
+        raise PurchaseError("商品或用户不存在")
+
+    now = datetime.utcnow()
+    error = check_purchase(product, user, quantity, now, lock=use_row_lock)
+    if error:
+        db.session.rollback()
+        raise PurchaseError(error)
+    result = apply_purchase(product, user, quantity, now)
+    db.session.commit()
+    return result
+
+
+def check_purchase(product, user, quantity, now, lock=False):
+    """检查限购、库存和积分，返回错误信息；可以购买时返回 None"""
+    # 检查本月购买记录（按主键读取预先累计的月度计数）
+    counter = get_purchase_counter(user.id, product.id, year_month_of(now), lock=lock)
+    purchased_this_month = counter.quantity if counter else 0
+    if purchased_this_month + quantity > product.limit:
+        return f"本月已购买{purchased_this_month}件，超过限购数量"
+    if quantity > product.limit or quantity > product.stock:
+        return "超过购买限制或库存不足"
+    if user.points < points_price(product.price) * quantity:
+        return "积分不足"
+    return None
+
+
+def apply_purchase(product, user, quantity, now):
+    """扣减库存、积分并记录购买和积分流水，调用方负责在同一个事务中提交"""
+    unit_price = points_price(product.price)
+    total_cost = unit_price * quantity
+    product.stock -= quantity
+    record = PurchaseRecord(
+        user_id=user.id,
+        product_id=product.id,
+        quantity=quantity,
+        purchase_time=now,
+        unit_price=unit_price,
+        total_cost=total_cost
+    )
+    db.session.add(record)
+    db.session.flush()  # 取得购买记录id，写入流水
+    record_points_change(user, -total_cost, LEDGER_PURCHASE, purchase_record_id=record.id)
+    add_to_purchase_counter(user.id, product.id, now, quantity)
+    bump_cache_version(STOCK_VERSION)
+    return {
+        'product_id': product.id,
+        'product_name': product.name,
+        'quantity': quantity,
+        'total_cost': total_cost,
+        'purchase_time': now,
+        'stock': product.stock,
+        'current_points': user.points
+    }
+
+
+def execute_purchase(user_id, product_id, quantity):
+    """在一个加锁事务内完成限购、库存、积分检查以及所有写入，遇到SQLITE_BUSY时退避重试"""
+    if quantity <= 0:
+        raise PurchaseError("购买数量必须大于0")
+    max_retries = app.config['PURCHASE_MAX_RETRIES']
+    for attempt in range(max_retries):
+        try:
+            return _purchase_once(user_id, product_id, quantity)
+        except OperationalError as e:
+            db.session.rollback()
+            if not is_sqlite_busy(e) or attempt == max_retries - 1:
+                raise
+            time.sleep(random.uniform(0, 0.05 * (2 ** attempt)))
+
+
+def _commit_flash_sale_batch_once(product_id, tickets):
+    use_row_lock = begin_locked_transaction()
+    product_query = db.session.query(Product).filter_by(id=product_id).populate_existing()
+    user_query = User.query.filter(User.id.in_({ticket.user_id for ticket in tickets})).populate_existing()
+    if use_row_lock:
+        product_query = product_query.with_for_update()
+        user_query = user_query.with_for_update()
+    product = product_query.first()
+    users = {user.id: user for user in user_query}
+    now = datetime.utcnow()
+    outcomes = []
+    for ticket in tickets:
+        user = users.get(ticket.user_id)
+        if product is None or user is None:
+            outcomes.append((ticket, None, "商品或用户不存在"))
+            continue
+        error = check_purchase(product, user, ticket.quantity, now, lock=use_row_lock)
+        if error:
+            outcomes.append((ticket, None, error))
         else:
-            print(f"添加college字段出错: {e}")
+            outcomes.append((ticket, apply_purchase(product, user, ticket.quantity, now), None))
+    db.session.commit()
+    return outcomes, product.stock if product else 0
 
-    # 检查并添加remaining_points字段
+
+def commit_flash_sale_batch(product_id, tickets):
+    """抢购后台线程调用：一个加锁事务中按先后顺序写入一批预留，返回写入后的库存"""
+    max_retries = app.config['PURCHASE_MAX_RETRIES']
     try:
-        cursor.execute('ALTER TABLE user ADD COLUMN remaining_points INTEGER DEFAULT 0')
-        print("成功添加remaining_points字段")
-    except sqlite3.OperationalError as e:
-        if "duplicate column name" in str(e).lower():
-            print("remaining_points字段已存在")
+        for attempt in range(max_retries):
+            try:
+                outcomes, stock = _commit_flash_sale_batch_once(product_id, tickets)
+                break
+            except OperationalError as e:
+                db.session.rollback()
+                if not is_sqlite_busy(e) or attempt == max_retries - 1:
+                    raise
+                time.sleep(random.uniform(0, 0.05 * (2 ** attempt)))
+    finally:
+        db.session.remove()
+    # 提交成功后才通知等待中的请求
+    for ticket, result, error in outcomes:
+        if error:
+            ticket.fail(error)
+        else:
+            ticket.succeed(result)
+    return stock
+
+
+flash_sale = FlashSaleManager(
+    app,
+    load_active=lambda: dict(db.session.query(Product.id, Product.stock).filter(Product.flash_sale.is_(True))),
+    commit_batch=commit_flash_sale_batch,
+    queue_size=app.config['FLASH_SALE_QUEUE_SIZE'],
+    batch_size=app.config['FLASH_SALE_BATCH_SIZE'],
+    refresh_interval=app.config['FLASH_SALE_REFRESH_INTERVAL'],
+    timeout=app.config['FLASH_SALE_TIMEOUT'],
+)
+
+
+def submit_purchase(user_id, product_id, quantity):
+    """抢购商品在内存中预留并排队写入，售罄后直接拒绝，不访问数据库；其他商品在加锁事务中购买
+
+    失败时抛出 PurchaseError 或 FlashSaleRejected。
+    """
+    result = flash_sale.purchase(product_id, user_id, quantity)
+    if result is None:
+        result = execute_purchase(user_id, product_id, quantity)
+    return result
+
+
+# ---------- 实时事件 ----------
+
+def load_balance_changes(after_id, limit=5000):
+    """积分流水只追加，按id从上次读到的位置继续读取，返回 (最后一条流水id, {用户id: 最新余额})"""
+    if after_id is None:
+        return db.session.query(db.func.max(PointsLedger.id)).scalar() or 0, {}
+    rows = db.session.query(PointsLedger.id, PointsLedger.user_id, PointsLedger.balance_after) \
+        .filter(PointsLedger.id > after_id).order_by(PointsLedger.id).limit(limit).all()
+    return (rows[-1].id if rows else after_id), {row.user_id: row.balance_after for row in rows}
+
+
+event_hub = EventHub(
+    app,
+    read_stock_version=lambda: read_cache_versions().get(STOCK_VERSION, 0),
+    load_stock=lambda: dict(db.session.query(Product.id, Product.stock)),
+    load_balances=load_balance_changes,
+    max_streams=app.config['EVENTS_MAX_STREAMS'],
+    stream_seconds=app.config['EVENTS_STREAM_SECONDS'],
+    poll_retry_ms=app.config['EVENTS_POLL_RETRY_MS'],
+    poll_interval=app.config['EVENTS_POLL_INTERVAL'],
+)
+
+
+@event.listens_for(db.session, 'after_flush')
+def collect_live_changes(session, flush_context):
+    """记录事务中修改过的库存和积分，提交后发布（批量 SQL 更新不经过这里，由 event_hub 按版本号和流水补齐）"""
+    for obj in session.dirty:
+        if isinstance(obj, Product):
+            kind, attr = 'stock', 'stock'
+        elif isinstance(obj, User):
+            kind, attr = 'balance', 'points'
         else:
-            print(f"添加remaining_points字段出错: {e}")
+            continue
+        if db.inspect(obj).attrs[attr].history.has_changes():
+            session.info.setdefault('live_changes', {})[(kind, obj.id)] = getattr(obj, attr)
+
+
+@event.listens_for(db.session, 'after_commit')
+def publish_live_changes(session):
+    changes = session.info.pop('live_changes', None)
+    if changes:
+        event_hub.publish_changes(changes)
+
+
+@event.listens_for(db.session, 'after_soft_rollback')
+def discard_live_changes(session, previous_transaction):
+    # 包括批量操作中回滚的保存点：丢弃的修改如果其实已经提交，最多延迟一个轮询间隔后由 event_hub 补齐
+    session.info.pop('live_changes', None)
+
+
+def verify_purchase_counters(fix=False):
+    """根据购买记录重新统计月度计数并与 purchase_counter 表对比
+
+    返回不一致的条目列表 [(user_id, product_id, year_month, 计数表中的值, 实际值)]；
+    fix=True 时用统计结果覆盖计数表。
+    """
+    year_month = db.func.strftime('%Y-%m', PurchaseRecord.purchase_time)
+    actual = {
+        (user_id, product_id, month): quantity
+        for user_id, product_id, month, quantity in db.session.query(
+            PurchaseRecord.user_id, PurchaseRecord.product_id, year_month, db.func.sum(PurchaseRecord.quantity)
+        ).group_by(PurchaseRecord.user_id, PurchaseRecord.product_id, year_month)
+    }
+    stored = {
+        (counter.user_id, counter.product_id, counter.year_month): counter.quantity
+        for counter in PurchaseCounter.query
+    }
+    drift = [
+        (*key, stored.get(key, 0), actual.get(key, 0))
+        for key in sorted(set(actual) | set(stored))
+        if stored.get(key, 0) != actual.get(key, 0)
+    ]
+    if fix and drift:
+        PurchaseCounter.query.delete()
+        db.session.bulk_insert_mappings(PurchaseCounter, [
+            {'user_id': user_id, 'product_id': product_id, 'year_month': month, 'quantity': quantity}
+            for (user_id, product_id, month), quantity in actual.items()
+        ])
+        db.session.commit()
+    return drift
+
+
+@app.cli.command('run-jobs')
+@click.option('--once', is_flag=True, help='执行完当前排队的任务后退出')
+def run_jobs_command(once):
+    """在独立进程中执行后台任务（可配合 SHOP_JOB_THREADS=0，使Web进程只负责接收请求）"""
+    if once:
+        job_queue.maintain()
+        click.echo(f'执行了 {job_queue.run_pending()} 个任务')
+        return
+    click.echo('等待后台任务，按 Ctrl+C 退出')
+    job_queue.run_forever(app)
+
+
+@app.cli.command('reconcile-points')
+@click.option('--fix', is_flag=True, help='用流水合计覆盖不一致的缓存余额')
+def reconcile_points_command(fix):
+    """核对每个用户的积分余额与积分流水合计"""
+    started = time.perf_counter()
+    drift = verify_points_ledger(fix=fix)
+    for user_id, points, total in drift:
+        click.echo(f'用户{user_id}：余额 {points}，流水合计 {total}')
+    elapsed = time.perf_counter() - started
+    if drift:
+        click.echo(f'{len(drift)} 个用户不一致' + ('，已按流水修正' if fix else '') + f'（{elapsed:.2f}s）')
+    else:
+        click.echo(f'积分余额与流水一致（{elapsed:.2f}s）')
+
+
+@app.cli.command('rebuild-search-index')
+def rebuild_search_index_command():
+    """创建（如果还没有）并按用户表重建学生搜索索引"""
+    with db.engine.begin() as connection:
+        created = create_search_index(connection)
+    click.echo('已重建学生搜索索引' if created else '当前SQLite不支持FTS5 trigram分词器，搜索使用LIKE查询')
+
+
+@app.cli.command('rebuild-purchase-counters')
+@click.option('--check-only', is_flag=True, help='只报告不一致，不修改计数表')
+def rebuild_purchase_counters_command(check_only):
+    """根据购买记录重建月度限购计数，并报告与现有计数的差异"""
+    drift = verify_purchase_counters(fix=not check_only)
+    for user_id, product_id, month, stored, actual in drift:
+        click.echo(f'用户{user_id} 商品{product_id} {month}：计数表 {stored}，实际 {actual}')
+    if not drift:
+        click.echo('月度计数与购买记录一致')
+    elif check_only:
+        click.echo(f'共 {len(drift)} 条不一致，未修改')
+    else:
+        click.echo(f'共 {len(drift)} 条不一致，已重建')
+
+
+@app.cli.command('archive-purchases')
+@click.option('--year', type=int, help='只归档该学年（起始年份，如 2023 表示 2023-2024 学年），默认归档所有已结束的学年')
+@click.option('--dry-run', is_flag=True, help='只列出将要归档的学年和记录数，不修改')
+@click.option('--list', 'list_only', is_flag=True, help='列出已归档的学年')
+@click.option('--vacuum', is_flag=True, help='归档后执行 VACUUM，把删除记录腾出的空间还给文件系统（期间阻塞所有读写）')
+def archive_purchases_command(year, dry_run, list_only, vacuum):
+    """把已结束学年的兑换记录移到按学年划分的归档文件，报表和导出仍包含这些记录"""
+    start_month = app.config['ACADEMIC_YEAR_START_MONTH']
+    with db.engine.connect() as connection:
+        if list_only:
+            for archive in purchase_archive.list_archives(connection):
+                click.echo(f"{archive['period']}：{archive['record_count']} 条记录，{archive['total_quantity']} 件，"
+                           f"{archive['total_cost']} 积分，{archive['batches']} 次归档，文件 {archive['filename']}")
+            return
+        pending = purchase_archive.pending_years(connection, start_month=start_month)
+    if year is not None:
+        pending = [item for item in pending if item[0] == year]
+    if not pending:
+        click.echo('没有需要归档的记录')
+        return
+    for pending_year, count, quantity, cost in pending:
+        label = purchase_archive.period_label(pending_year)
+        if dry_run:
+            click.echo(f'{label}：{count} 条记录，{quantity} 件，{cost} 积分')
+            continue
+        started = time.perf_counter()
+        try:
+            batch = purchase_archive.archive_year(db.engine, app.config['ARCHIVE_DIR'], pending_year, start_month)
+        except ArchiveError as e:
+            raise click.ClickException(str(e))
+        click.echo(f"{label}：已归档 {batch['record_count']} 条记录到 {batch['filename']}"
+                   f'（{time.perf_counter() - started:.2f}s）')
+    if vacuum and not dry_run:
+        with db.engine.connect() as connection:
+            connection.exec_driver_sql('VACUUM')
+        click.echo('已执行 VACUUM')
+
+
+@app.cli.command('query-purchases')
+@click.option('--report', 'name', default='purchases', type=click.Choice(sorted(reports.EXPORTS)), help='报表名称')
+@click.option('--start', default='', help='开始日期 YYYY-MM-DD')
+@click.option('--end', default='', help='结束日期 YYYY-MM-DD（包含当天）')
+@click.option('--min-points', default=1, type=int, help='未使用积分报表的积分下限')
+@click.option('--output', '-o', type=click.Path(dir_okay=False), help='写入CSV文件，默认输出到终端')
+def query_purchases_command(name, start, end, min_points, output):
+    """跨主库和归档文件查询兑换记录，按报表输出CSV"""
+    try:
+        report_range = ReportRange.parse(start.strip(), end.strip())
+    except ReportError as e:
+        raise click.UsageError(str(e))
+    _, headers, _ = reports.EXPORTS[name]
+    try:
+        with archived_purchases(report_range if name != 'unused_balance' else None) as source:
+            rows = reports.iter_export_rows(db.session, name, report_range, max(min_points, 1), source=source)
+            if output:
+                with open(output, 'wb') as f:
+                    for chunk in reports.iter_csv(headers, rows):
+                        f.write(chunk)
+            else:
+                for chunk in reports.iter_csv(headers, rows):
+                    click.echo(chunk.decode('utf-8-sig'), nl=False)  # 终端输出不需要BOM
+    except ArchiveError as e:
+        raise click.ClickException(str(e))
+
+
+@app.cli.command('backfill-images')
+def backfill_images_command():
+    """把现有商品图片改为内容哈希命名、合并重复图片并生成各尺寸版本"""
+    folder = app.config['UPLOAD_FOLDER']
+    renamed = 0
+    replaced = []
+    for product in Product.query.order_by(Product.id):
+        path = os.path.join(folder, product.picture or '')
+        if not product.picture or not os.path.isfile(path):
+            click.echo(f'商品{product.id}（{product.name}）的图片不存在：{product.picture}')
+            continue
+        with open(path, 'rb') as f:
+            try:
+                picture = store_image(folder, f.read(), product.picture)
+            except ImageError:
+                click.echo(f'商品{product.id}（{product.name}）的图片无法识别：{product.picture}')
+                continue
+        if picture != product.picture:
+            replaced.append(product.picture)
+            product.picture = picture
+            renamed += 1
+        click.echo(f'商品{product.id}（{product.name}）：{picture}')
+    bump_cache_version(CATALOG_VERSION)
+    db.session.commit()
+    # 提交成功后再删除改名前的文件
+    for old_picture in replaced:
+        remove_unused_picture(old_picture)
+
+    # 没有被任何商品引用的原图只做提示，由管理员确认后手动删除
+    referenced = {picture for picture, in db.session.query(Product.picture)}
+    variant_suffixes = tuple(f'_{variant}.{fmt}' for variant in VARIANTS for fmt in VARIANT_FORMATS)
+    for name in sorted(os.listdir(folder)):
+        if name not in referenced and not name.endswith(variant_suffixes):
+            click.echo(f'未被商品引用的图片：{name}')
+    click.echo(f'完成：{renamed} 个商品图片改为哈希命名')
+
 
-    conn.commit()
-    conn.close()
+@app.cli.command('precompress-static')
+def precompress_static_command():
+    """为 static 目录下的 JS/CSS 等文件生成预压缩的 .gz/.br 版本"""
+    created = precompress_static(app.static_folder, log=click.echo)
+    click.echo(f'完成：生成 {created} 个压缩文件')
 
 
 @app.route('/')
 def home():
-    if 'username' not in session:
+    identity = current_user()
+    if identity is None:
         return redirect(url_for('login'))
 
-    if session.get('is_admin'):
+    if identity.is_admin:
         return redirect(url_for('admin'))
-    else:
-        products = Product.query.all()
-        user = User.query.filter_by(username=session['username']).first()
-        purchase_records = PurchaseRecord.query \
-            .filter_by(user_id=user.id) \
-            .join(Product) \
-            .order_by(PurchaseRecord.purchase_time.desc()) \
-            .all()
+
+    # 页面只取决于商品目录、库存、本人积分和兑换记录：这些版本都没有变化时返回 304，不查询也不渲染
+    versions = read_cache_versions()
+    catalog_version = versions.get(CATALOG_VERSION, 0)
+    archive_version = versions.get(ARCHIVE_VERSION, 0)
+    current_points = db.session.query(User.points).filter(User.id == identity.id).scalar()
+    ledger_id = latest_ledger_ids([identity.id]).get(identity.id)
+
+    def render():
+        product_cards = [
+            fragment_cache.render('_product_card.html', product, product=product)
+            for product in catalog_cache.all()
+        ]
+        purchase_history = fragment_cache.render(
+            '_purchase_history.html', (identity.id, ledger_id, catalog_version, archive_version),
+            load=lambda: {'purchase_records': purchase_history_query(identity.id).all()})
         return render_template('shop.html',
-                               products=products,
-                               current_points=user.points,
-                               purchase_records=purchase_records)
+                               product_cards=product_cards,
+                               current_points=current_points,
+                               purchase_history=purchase_history,
+                               events_cursor=event_hub.cursor())
+
+    return conditional_page(('shop', folder_version(TEMPLATE_DIR), identity.id, session.get('username'),
+                             current_points, ledger_id, catalog_version, archive_version,
+                             versions.get(STOCK_VERSION, 0)), render)
 
 
 @app.route('/login', methods=['GET', 'POST'])
@@ -117,8 +896,14 @@ def login():
         username = request.form['username']
         password = request.form['password']
 
-        user = User.query.filter_by(username=username, password=password).first()
-        if user:
+        user = User.query.filter_by(username=username).first()
+        if user and verify_password(user.password, password):
+            # 明文、批量导入的低成本哈希或哈希参数已调整时，按当前配置重新哈希
+            if needs_rehash(user.password, app.config['PASSWORD_HASH_METHOD']):
+                user.password = hash_password(password, app.config['PASSWORD_HASH_METHOD'])
+                db.session.commit()
+            session.clear()
+            session['user_id'] = user.id
             session['username'] = username
             session['is_admin'] = user.is_admin
             return redirect(url_for('home'))
@@ -136,16 +921,158 @@ def logout():
 
 @app.route('/admin')
 def admin():
-    if 'username' not in session or not session.get('is_admin'):
+    if not is_admin_user():
         return redirect(url_for('login'))
-    products = Product.query.all()
-    users = User.query.all()
-    return render_template('admin.html', products=products, users=users)
+    versions = read_cache_versions()
+
+    def render():
+        product_rows = [
+            fragment_cache.render('_admin_product_row.html', product, product=product)
+            for product in catalog_cache.all()
+        ]
+        # 用户列表由页面通过 /admin/users 分页加载
+        return render_template('admin.html', product_rows=product_rows, page_size=app.config['ADMIN_PAGE_SIZE'],
+                               events_cursor=event_hub.cursor())
+
+    return conditional_page(('admin', folder_version(TEMPLATE_DIR), versions.get(CATALOG_VERSION, 0),
+                             versions.get(STOCK_VERSION, 0), app.config['ADMIN_PAGE_SIZE']), render)
+
+
+def serialize_admin_user(user, purchases):
+    """purchases 为该用户的兑换记录，最新在前"""
+    return {
+        'id': user.id,
+        'username': user.username,
+        'name': user.name,
+        'gender': user.gender,
+        'college': user.college,
+        'points': user.points,
+        'remaining_points': user.remaining_points,
+        'is_admin': bool(user.is_admin),
+        'purchases': [{
+            'id': record.id,
+            'product_name': record.product.name,
+            'quantity': record.quantity,
+            'total_cost': record.total_cost,
+            'purchase_time': record.purchase_time.strftime('%Y-%m-%d %H:%M')
+        } for record in purchases]
+    }
+
+
+def admin_user_cards(users):
+    """管理员用户卡片，按用户行、最新积分流水id和商品目录版本缓存，只为未命中的用户查询兑换记录"""
+    if not users:
+        return []
+    versions = read_cache_versions()
+    ledger_ids = latest_ledger_ids([user.id for user in users])
+    keys = {
+        user.id: ('admin_user', user.id, user.username, user.name, user.gender, user.college, user.points,
+                  user.remaining_points, bool(user.is_admin), ledger_ids.get(user.id),
+                  versions.get(CATALOG_VERSION, 0), versions.get(ARCHIVE_VERSION, 0))
+        for user in users
+    }
+    cards = {user.id: fragment_cache.get(keys[user.id]) for user in users}
+    missing = [user.id for user in users if cards[user.id] is None]
+    if missing:
+        purchases = {user_id: [] for user_id in missing}
+        records = PurchaseRecord.query.options(joinedload(PurchaseRecord.product)) \
+            .filter(PurchaseRecord.user_id.in_(missing)).order_by(PurchaseRecord.purchase_time.desc())
+        for record in records:
+            purchases[record.user_id].append(record)
+        for user in users:
+            if cards[user.id] is None:
+                cards[user.id] = serialize_admin_user(user, purchases[user.id])
+                fragment_cache.put(keys[user.id], cards[user.id])
+    return [cards[user.id] for user in users]
+
+
+@app.route('/admin/users')
+def admin_users():
+    """管理员用户列表接口：按学院、学号/姓名筛选，键集分页（管理员在前，再按id升序）
+
+    有学号/姓名关键字时使用全文索引，游标格式见 user_search.search_user_ids：命中不多时按相关度排序、
+    按偏移量翻页（最多翻到前 RANK_LIMIT 个结果），命中很多时按id排序、按id键集分页。
+    没有索引时按子串匹配，关键字中的 % 和 _ 按普通字符处理。
+    """
+    if not is_admin_user():
+        return jsonify({'error': '未授权访问'}), 403
+
+    limit = max(1, min(request.args.get('limit', app.config['ADMIN_PAGE_SIZE'], type=int), 200))
+    college = request.args.get('college', '').strip()
+    keyword = request.args.get('q', '').strip()
+    cursor = request.args.get('after', '')
+
+    query = User.query
+    if keyword and uses_index(keyword, college) and search_index_exists(db.session):
+        try:
+            user_ids, next_cursor = search_user_ids(db.session, keyword, college, limit, cursor)
+        except ValueError:
+            return jsonify({'error': '无效的分页游标'}), 400
+        users_by_id = {user.id: user for user in query.filter(User.id.in_(user_ids))}
+        return jsonify({
+            'users': admin_user_cards([users_by_id[user_id] for user_id in user_ids if user_id in users_by_id]),
+            'next_cursor': next_cursor
+        })
+
+    admin_flag = db.func.coalesce(User.is_admin, 0)
+    if college:
+        query = query.filter(User.college.ilike(contains_pattern(college), escape='\\'))
+    if keyword:
+        pattern = contains_pattern(keyword)
+        query = query.filter(or_(User.username.ilike(pattern, escape='\\'), User.name.ilike(pattern, escape='\\')))
+    if cursor:
+        # 游标格式："是否管理员-用户id"，例如 "1-3"、"0-1520"
+        try:
+            cursor_admin, cursor_id = (int(part) for part in cursor.split('-', 1))
+        except ValueError:
+            return jsonify({'error': '无效的分页游标'}), 400
+        query = query.filter(or_(
+            admin_flag < cursor_admin,
+            and_(admin_flag == cursor_admin, User.id > cursor_id)
+        ))
+
+    users = query.order_by(admin_flag.desc(), User.id).limit(limit + 1).all()
+    has_more = len(users) > limit
+    users = users[:limit]
+    next_cursor = None
+    if has_more:
+        last = users[-1]
+        next_cursor = f'{int(bool(last.is_admin))}-{last.id}'
+    return jsonify({
+        'users': admin_user_cards(users),
+        'next_cursor': next_cursor
+    })
+
+
+@app.route('/admin/cache_stats')
+def cache_stats():
+    if not is_admin_user():
+        return jsonify({'error': '未授权访问'}), 403
+    return jsonify({'catalog': catalog_cache.stats(), 'reports': report_cache.stats(),
+                    'flash_sale': flash_sale.stats(), 'assistant': assistant.stats(), 'events': event_hub.stats(),
+                    'fragments': fragment_cache.stats()})
+
+
+@app.route('/metrics')
+def metrics():
+    if request_metrics is None:
+        abort(404)
+    token = app.config['METRICS_TOKEN']
+    authorized_by_token = token and request.headers.get('Authorization') == f'Bearer {token}'
+    if not authorized_by_token and not is_admin_user():
+        return jsonify({'error': '未授权访问'}), 403
+    stats = catalog_cache.stats()
+    body = request_metrics.render_prometheus({
+        'shop_catalog_cache_hits': ('商品目录缓存命中次数', stats['hits']),
+        'shop_catalog_cache_misses': ('商品目录缓存完整重新加载次数', stats['misses']),
+        'shop_catalog_cache_stock_refreshes': ('商品目录缓存只刷新库存的次数', stats['stock_refreshes']),
+    })
+    return body, 200, {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
 
 
 @app.route('/add_user', methods=['POST'])
 def add_user():
-    if 'username' not in session or not session.get('is_admin'):
+    if not is_admin_user():
         return redirect(url_for('login'))
 
     username = request.form['username']
@@ -157,13 +1084,17 @@ def add_user():
 
     new_user = User(
         username=username,
-        password=password,
+        password=hash_password(password, app.config['PASSWORD_HASH_METHOD']),
         is_admin=is_admin,
         name=name,
         gender=gender,
-        points=points
+        points=0
     )
     db.session.add(new_user)
+    db.session.flush()
+    if points:
+        record_points_change(new_user, points, LEDGER_ADJUST, note='新建用户')
+    bump_cache_version(USERS_VERSION)
     db.session.commit()
 
     return redirect(url_for('admin'))
@@ -171,7 +1102,7 @@ def add_user():
 
 @app.route('/add_product', methods=['POST'])
 def add_product():
-    if 'username' not in session or not session.get('is_admin'):
+    if not is_admin_user():
         return redirect(url_for('login'))
     if 'picture' not in request.files:
         return "未选择图片", 400
@@ -179,12 +1110,16 @@ def add_product():
     if file.filename == '':
         return "未选择图片", 400
     if file and allowed_file(file.filename):
-        filename = secure_filename(file.filename)
-        unique_filename = f"{uuid.uuid4().hex}_{filename}"
-        file_path = os.path.join(app.config['UPLOAD_FOLDER'], unique_filename)
-        file.save(file_path)
+        # 按内容哈希保存并生成各尺寸版本，相同图片只保存一份
+        try:
+            unique_filename = store_image(app.config['UPLOAD_FOLDER'], file.read(), secure_filename(file.filename))
+        except ImageError:
+            return "不支持的文件格式", 400
         name = request.form['name']
-        price = float(request.form['price'])
+        try:
+            price = parse_points_price(request.form['price'])
+        except ValueError:
+            return "价格必须是非负整数", 400
         stock = int(request.form['stock'])
         limit = int(request.form['limit'])
 
@@ -196,6 +1131,7 @@ def add_product():
             limit=limit
         )
         db.session.add(new_product)
+        bump_cache_version(CATALOG_VERSION)
         db.session.commit()
 
         return redirect(url_for('admin'))
@@ -205,61 +1141,82 @@ def add_product():
 
 @app.route('/purchase/<int:product_id>', methods=['POST'])
 def purchase(product_id):
-    if 'username' not in session:
+    identity = current_user()
+    if identity is None:
         return redirect(url_for('login'))
 
-    product = Product.query.get_or_404(product_id)
-    user = User.query.filter_by(username=session['username']).first()
     quantity = int(request.form['quantity'])
-    total_cost = product.price * quantity
+    if quantity <= 0:
+        return "购买数量必须大于0", 400
 
-    # 检查本月购买记录
-    now = datetime.utcnow()
-    first_day_of_month = datetime(now.year, now.month, 1)
-    purchased_this_month = PurchaseRecord.query.filter(
-        PurchaseRecord.user_id == user.id,
-        PurchaseRecord.product_id == product.id,
-        PurchaseRecord.purchase_time >= first_day_of_month
-    ).with_entities(db.func.sum(PurchaseRecord.quantity)).scalar() or 0
-
-    if purchased_this_month + quantity > product.limit:
-        return f"本月已购买{purchased_this_month}件，超过限购数量", 400
+    try:
+        result = submit_purchase(identity.id, product_id, quantity)
+    except (PurchaseError, FlashSaleRejected) as e:
+        return str(e), 400
 
-    if quantity > product.limit or quantity > product.stock:
-        return "超过购买限制或库存不足", 400
-    if user.points < total_cost:
-        return "积分不足", 400
+    return render_template('purchase_success.html', **result)
 
-    # 扣减库存和用户积分
-    product.stock -= quantity
-    user.points -= total_cost
-    user.remaining_points = user.points  # 更新剩余爱心币
-    db.session.commit()
 
-    # 记录购买
-    record = PurchaseRecord(
-        user_id=user.id,
-        product_id=product.id,
-        quantity=quantity
-    )
-    db.session.add(record)
-    db.session.commit()
+@app.route('/api/purchase/<int:product_id>', methods=['POST'])
+def purchase_api(product_id):
+    """购买接口：请求体 {"quantity": 数量}，返回购买结果以及购买后的库存和积分，页面就地更新，不再重新加载"""
+    identity = current_user()
+    if identity is None:
+        return jsonify({'success': False, 'error': '请先登录'}), 401
+    payload = request.get_json(silent=True) or request.form
+    try:
+        quantity = int(payload.get('quantity', 1))
+    except (TypeError, ValueError):
+        return jsonify({'success': False, 'error': '购买数量必须是整数'}), 400
+    if quantity <= 0:
+        return jsonify({'success': False, 'error': '购买数量必须大于0'}), 400
 
-    return render_template('purchase_success.html',
-                           product_name=product.name,
-                           quantity=quantity,
-                           total_cost=total_cost,
-                           current_points=user.points)
+    try:
+        result = submit_purchase(identity.id, product_id, quantity)
+    except (PurchaseError, FlashSaleRejected) as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
+
+    return jsonify({
+        'success': True,
+        'product_id': result['product_id'],
+        'product_name': result['product_name'],
+        'quantity': result['quantity'],
+        'total_cost': result['total_cost'],
+        'purchase_time': result['purchase_time'].strftime('%Y-%m-%d %H:%M'),
+        'stock': result['stock'],
+        'points': result['current_points'],
+    })
+
+
+@app.route('/events')
+def live_events():
+    """SSE：商品库存变化（所有页面）和积分变化（本人；管理员接收所有在线用户）
+
+    浏览器断线或连接到期后带 Last-Event-ID 自动重连；重连到其他进程时先收到一次快照。
+    """
+    identity = current_user()
+    if identity is None:
+        return jsonify({'error': '请先登录'}), 401
+    event_hub.prime()
+    cursor = event_hub.parse_cursor(request.headers.get('Last-Event-ID') or request.args.get('since'))
+    points = None
+    if cursor is None and not identity.is_admin:
+        points = db.session.query(User.points).filter(User.id == identity.id).scalar()
+    events = event_hub.stream(identity.id, identity.is_admin, cursor, points=points)
+    return Response(events, mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
 
 
 @app.route('/delete_student/<int:student_id>', methods=['POST'])
 def delete_student(student_id):
-    if 'username' not in session or not session.get('is_admin'):
+    if not is_admin_user():
         return redirect(url_for('login'))
     student = User.query.get(student_id)
     if student and not student.is_admin:  # 确保不是管理员
         db.session.delete(student)
+        bump_cache_version(USERS_VERSION)
         db.session.commit()
+        identity_cache.invalidate(student_id)
     return redirect(url_for('admin'))
 
 
@@ -267,7 +1224,9 @@ def delete_student(student_id):
 def increase_stock(product_id):
     product = Product.query.get_or_404(product_id)
     product.stock += 1
+    bump_cache_version(STOCK_VERSION)
     db.session.commit()
+    flash_sale.invalidate()
     return redirect(url_for('admin'))
 
 
@@ -276,16 +1235,21 @@ def decrease_stock(product_id):
     product = Product.query.get_or_404(product_id)
     if product.stock > 0:
         product.stock -= 1
+        bump_cache_version(STOCK_VERSION)
         db.session.commit()
+        flash_sale.invalidate()
     return redirect(url_for('admin'))
 
 
 @app.route('/get_product/<int:product_id>')
 def get_product(product_id):
-    product = Product.query.get_or_404(product_id)
+    product = catalog_cache.get(product_id)
+    if product is None:
+        abort(404)
     return {
         'name': product.name,
         'picture': product.picture,
+        'picture_url': product_picture(product.picture)['src'],
         'price': float(product.price),
         'stock': product.stock,
         'limit': product.limit
@@ -295,29 +1259,50 @@ def get_product(product_id):
 @app.route('/update_product/<int:product_id>', methods=['POST'])
 def update_product(product_id):
     product = Product.query.get_or_404(product_id)
+    try:
+        price = parse_points_price(request.form['price'])
+    except ValueError:
+        return "价格必须是非负整数", 400
     product.name = request.form['name']
-    product.price = float(request.form['price'])
+    product.price = price
     product.stock = int(request.form['stock'])
     product.limit = int(request.form['limit'])
+    old_picture = product.picture
     if 'picture' in request.files and request.files['picture'].filename != '':
         file = request.files['picture']
         if file and allowed_file(file.filename):
-            old_picture_path = os.path.join(app.config['UPLOAD_FOLDER'], product.picture)
-            if os.path.exists(old_picture_path):
-                os.remove(old_picture_path)
-            filename = secure_filename(file.filename)
-            unique_filename = f"{uuid.uuid4().hex}_{filename}"
-            file_path = os.path.join(app.config['UPLOAD_FOLDER'], unique_filename)
-            file.save(file_path)
-            product.picture = unique_filename
-
+            try:
+                product.picture = store_image(app.config['UPLOAD_FOLDER'], file.read(),
+                                              secure_filename(file.filename))
+            except ImageError:
+                db.session.rollback()
+                return "不支持的文件格式", 400
+
+    bump_cache_version(CATALOG_VERSION)
     db.session.commit()
+    flash_sale.invalidate()
+    # 提交成功后再删除旧图片；重新上传同一张图片时文件名不变，不能删除
+    if product.picture != old_picture:
+        remove_unused_picture(old_picture)
     return '', 204
 
 
+@app.route('/toggle_flash_sale/<int:product_id>', methods=['POST'])
+def toggle_flash_sale(product_id):
+    """开启或关闭商品的抢购模式，各进程在 FLASH_SALE_REFRESH_INTERVAL 秒内生效"""
+    if not is_admin_user():
+        return redirect(url_for('login'))
+    product = Product.query.get_or_404(product_id)
+    product.flash_sale = not product.flash_sale
+    bump_cache_version(CATALOG_VERSION)
+    db.session.commit()
+    flash_sale.invalidate()
+    return redirect(url_for('admin'))
+
+
 @app.route('/delete_admin/<int:admin_id>', methods=['POST'])
 def delete_admin(admin_id):
-    if 'username' not in session or not session.get('is_admin'):
+    if not is_admin_user():
         return redirect(url_for('login'))
 
     admin = User.query.get_or_404(admin_id)
@@ -325,7 +1310,9 @@ def delete_admin(admin_id):
     admin_count = User.query.filter_by(is_admin=True).count()
     if admin.is_admin and admin_count > 1:
         db.session.delete(admin)
+        bump_cache_version(USERS_VERSION)
         db.session.commit()
+        identity_cache.invalidate(admin_id)
         return redirect(url_for('admin'))
     return "不能删除最后一个管理员", 403
 
@@ -339,8 +1326,7 @@ def get_user(user_id):
         'gender': user.gender,
         'college': user.college,
         'points': user.points,
-        'remaining_points': user.remaining_points,
-        'password': user.password
+        'remaining_points': user.remaining_points
     }
 
 
@@ -350,308 +1336,900 @@ def update_user(user_id):
     user.username = request.form['username']
     user.name = request.form['name']
     user.gender = request.form['gender']
-    user.points = int(request.form['points'])
-    user.remaining_points = user.points  # 同步更新剩余爱心币
+    delta = int(request.form['points']) - (user.points or 0)
+    if delta:
+        record_points_change(user, delta, LEDGER_ADJUST, note='管理员修改')
     # 更新学院字段
     if 'college' in request.form:
         user.college = request.form['college']
     # 更新密码字段
     if 'password' in request.form and request.form['password']:
-        user.password = request.form['password']
+        user.password = hash_password(request.form['password'], app.config['PASSWORD_HASH_METHOD'])
+    bump_cache_version(USERS_VERSION)
     db.session.commit()
+    identity_cache.invalidate(user_id)
     return '', 204
 
 
 @app.route('/return_purchase/<int:record_id>', methods=['POST'])
 def return_purchase(record_id):
-    if 'username' not in session or not session.get('is_admin'):
+    if not is_admin_user():
         return redirect(url_for('login'))
 
+    # 与购买使用同样的加锁事务，避免退货与并发购买交错
+    begin_locked_transaction()
     record = PurchaseRecord.query.get_or_404(record_id)
     user = User.query.get_or_404(record.user_id)
     product = Product.query.get_or_404(record.product_id)
+    refund_purchase_record(record, user, product)
+    db.session.commit()
 
-    # 返还积分和库存
-    refund_amount = record.quantity * product.price
-    user.points += refund_amount
-    user.remaining_points = user.points  # 同步更新剩余爱心币
+    return '', 204
+
+
+def refund_purchase_record(record, user, product):
+    """返还积分和库存、扣回月度计数并删除购买记录，调用方查出记录对应的用户和商品并负责提交事务"""
+    # 按购买时实际扣除的积分返还，不受之后调价影响
+    refund_amount = record.total_cost
+    record_points_change(user, refund_amount, LEDGER_REFUND, purchase_record_id=record.id)
     product.stock += record.quantity
+    add_to_purchase_counter(record.user_id, record.product_id, record.purchase_time, -record.quantity)
+    bump_cache_version(STOCK_VERSION)
 
     # 删除购买记录
     db.session.delete(record)
+    return refund_amount
+
+
+# ---------- 批量管理操作 ----------
+
+class BatchOperationError(Exception):
+    """批量操作中的单个操作校验失败，消息写入该操作的结果，不影响其他操作"""
+
+
+def _batch_int(op, name, minimum=None):
+    value = op.get(name)
+    if isinstance(value, bool) or not isinstance(value, (int, str)):
+        raise BatchOperationError(f"{name} 必须是整数")
+    try:
+        value = int(value)
+    except ValueError:
+        raise BatchOperationError(f"{name} 必须是整数")
+    if minimum is not None and value < minimum:
+        raise BatchOperationError(f"{name} 不能小于{minimum}")
+    return value
+
+
+def _batch_product(op):
+    product = db.session.get(Product, _batch_int(op, 'product_id'))
+    if product is None:
+        raise BatchOperationError("商品不存在")
+    return product
+
+
+def _batch_user(op):
+    user = db.session.get(User, _batch_int(op, 'user_id'))
+    if user is None:
+        raise BatchOperationError("用户不存在")
+    return user
+
+
+def _batch_note(op):
+    return str(op.get('note') or '管理员批量修改')[:200]
+
+
+def _batch_set_stock(op, touched):
+    product = _batch_product(op)
+    product.stock = _batch_int(op, 'stock', minimum=0)
+    touched.add(STOCK_VERSION)
+    return {'product_id': product.id, 'stock': product.stock}
+
+
+def _batch_adjust_stock(op, touched):
+    product = _batch_product(op)
+    delta = _batch_int(op, 'delta')
+    if product.stock + delta < 0:
+        raise BatchOperationError(f"库存不足，当前库存{product.stock}")
+    product.stock += delta
+    touched.add(STOCK_VERSION)
+    return {'product_id': product.id, 'stock': product.stock}
+
+
+def _batch_set_points(op, touched):
+    user = _batch_user(op)
+    delta = _batch_int(op, 'points', minimum=0) - (user.points or 0)
+    if delta:
+        record_points_change(user, delta, LEDGER_ADJUST, note=_batch_note(op))
+        touched.add(USERS_VERSION)
+    return {'user_id': user.id, 'points': user.points}
+
+
+def _batch_adjust_points(op, touched):
+    user = _batch_user(op)
+    delta = _batch_int(op, 'delta')
+    if (user.points or 0) + delta < 0:
+        raise BatchOperationError(f"积分不足，当前积分{user.points or 0}")
+    if delta:
+        record_points_change(user, delta, LEDGER_ADJUST, note=_batch_note(op))
+        touched.add(USERS_VERSION)
+    return {'user_id': user.id, 'points': user.points}
+
+
+def _batch_adjust_college_points(op, touched):
+    """给一个学院的所有学生（不含管理员）增减积分：一条UPDATE修改余额，一条INSERT ... SELECT追加流水"""
+    college = str(op.get('college') or '').strip()
+    if not college:
+        raise BatchOperationError("缺少学院")
+    delta = _batch_int(op, 'delta')
+    if delta == 0:
+        raise BatchOperationError("delta 不能为0")
+    students = and_(User.college == college, db.func.coalesce(User.is_admin, False).is_(False))
+    balance = db.func.coalesce(User.points, 0)
+    count = db.session.query(db.func.count(User.id)).filter(students).scalar()
+    if count == 0:
+        raise BatchOperationError("没有找到该学院的学生")
+    if delta < 0:
+        short = db.session.query(db.func.count(User.id)).filter(students, balance + delta < 0).scalar()
+        if short:
+            raise BatchOperationError(f"有{short}名学生积分不足")
+    db.session.execute(
+        update(User).where(students).values(points=balance + delta, remaining_points=balance + delta)
+        .execution_options(synchronize_session=False)
+    )
+    db.session.execute(insert(PointsLedger).from_select(
+        ['user_id', 'kind', 'delta', 'balance_after', 'note', 'created_at'],
+        select(User.id, literal(LEDGER_ADJUST), literal(delta), User.points, literal(_batch_note(op)),
+               literal(datetime.utcnow(), db.DateTime)).where(students)
+    ))
+    # 会话中已加载的用户对象余额已过期，后面的操作重新读取
+    db.session.expire_all()
+    touched.add(USERS_VERSION)
+    return {'college': college, 'delta': delta, 'students': count}
+
+
+def _batch_refund(op, touched):
+    record = db.session.get(PurchaseRecord, _batch_int(op, 'record_id'))
+    if record is None:
+        raise BatchOperationError("购买记录不存在")
+    # 用户或商品已被删除时只让这一项失败，不中断整个批次
+    user = db.session.get(User, record.user_id)
+    if user is None:
+        raise BatchOperationError("购买记录对应的用户不存在")
+    product = db.session.get(Product, record.product_id)
+    if product is None:
+        raise BatchOperationError("购买记录对应的商品不存在")
+    record_id = record.id
+    refunded = refund_purchase_record(record, user, product)
+    touched.add(STOCK_VERSION)
+    return {'record_id': record_id, 'refunded': refunded}
+
+
+BATCH_OPERATIONS = {
+    'set_stock': _batch_set_stock,  # {"product_id", "stock"}
+    'adjust_stock': _batch_adjust_stock,  # {"product_id", "delta"}
+    'set_points': _batch_set_points,  # {"user_id", "points", "note"}
+    'adjust_points': _batch_adjust_points,  # {"user_id", "delta", "note"}
+    'adjust_college_points': _batch_adjust_college_points,  # {"college", "delta", "note"}
+    'refund': _batch_refund,  # {"record_id"}
+}
+
+
+def run_batch_operations(operations, atomic=False):
+    """在一个加锁事务中按顺序执行操作，返回 (逐项结果, 是否已提交)
+
+    每个操作在一个保存点中执行，失败时只回滚该操作；atomic 为 True 时任何一个操作失败则全部回滚。
+    """
+    begin_locked_transaction()
+    touched = set()
+    results = []
+    for index, op in enumerate(operations):
+        name = op.get('op') if isinstance(op, dict) else None
+        handler = BATCH_OPERATIONS.get(name)
+        if handler is None:
+            results.append({'index': index, 'op': name, 'ok': False, 'error': "未知的操作类型"})
+            continue
+        savepoint = db.session.begin_nested()
+        try:
+            result = handler(op, touched)
+        except BatchOperationError as e:
+            savepoint.rollback()
+            results.append({'index': index, 'op': name, 'ok': False, 'error': str(e)})
+        else:
+            savepoint.commit()
+            results.append({'index': index, 'op': name, 'ok': True, **result})
+
+    if atomic and any(not result['ok'] for result in results):
+        db.session.rollback()
+        return results, False
+    for name in sorted(touched):
+        bump_cache_version(name)
     db.session.commit()
+    if STOCK_VERSION in touched:
+        flash_sale.invalidate()
+    return results, True
+
+
+@app.route('/admin/batch', methods=['POST'])
+def admin_batch():
+    """批量管理操作：请求体为 {"operations": [{"op": ..., ...}, ...], "atomic": false}，
+    所有操作在一个事务中执行，返回每个操作的结果"""
+    if not is_admin_user():
+        return jsonify({'error': '未授权访问'}), 403
+    payload = request.get_json(silent=True) or {}
+    operations = payload.get('operations')
+    if not isinstance(operations, list) or not operations:
+        return jsonify({'success': False, 'error': 'operations 必须是非空列表'}), 400
+    if len(operations) > app.config['BATCH_MAX_OPERATIONS']:
+        return jsonify({'success': False,
+                        'error': f"一次最多 {app.config['BATCH_MAX_OPERATIONS']} 个操作"}), 400
 
-    return '', 204
+    try:
+        results, committed = run_batch_operations(operations, atomic=bool(payload.get('atomic')))
+    except OperationalError as e:
+        db.session.rollback()
+        if not is_sqlite_busy(e):
+            raise
+        return jsonify({'success': False, 'error': '数据库繁忙，请稍后重试'}), 503
+
+    failed = sum(not result['ok'] for result in results)
+    return jsonify({
+        'success': committed,
+        'applied': len(results) - failed if committed else 0,
+        'failed': failed,
+        'results': results,
+    })
+
+
+IMPORT_REQUIRED_HEADERS = ['姓名', '学号', '学院', '爱心币数量', '剩余爱心币']
+
+
+def parse_roster_row(headers, row):
+    """把花名册的一行转换为 (学号, 用户字段)，数据有误时抛出 ValueError(原因)"""
+    # 创建数据字典，将单元格值与表头对应
+    row_data = dict(zip(headers, row))
+    student_id = row_data.get('学号') or ''
+    # 检查学号是否为空
+    if not student_id:
+        raise ValueError('学号为空')
+    try:
+        points = int(row_data.get('爱心币数量') or 0)
+        remaining_points = int(row_data.get('剩余爱心币') or 0)
+    except (TypeError, ValueError):
+        raise ValueError('爱心币数量或剩余爱心币不是整数')
+    return str(student_id), {
+        'name': row_data.get('姓名') or '',
+        'college': row_data.get('学院') or '',
+        'points': points,
+        'remaining_points': remaining_points,
+    }
 
 
-# 修复后的Excel导入路由
-@app.route('/import_excel', methods=['POST'])
-def import_excel():
-    if 'username' not in session or not session.get('is_admin'):
-        return redirect(url_for('login'))
+def new_user_mapping(username, fields):
+    # 创建新用户（密码默认为学号，写入时由 _flush_user_batches 哈希）
+    return {
+        'username': username,
+        'is_admin': False,
+        'gender': 'male',  # 默认性别
+        **fields
+    }
 
-    if 'excel_file' not in request.files:
-        return "未选择文件", 400
 
+def roster_fingerprint(fields):
+    """花名册一行（学号之外的各列）的指纹"""
+    values = json.dumps([str(fields['name']), str(fields['college']), fields['points'], fields['remaining_points']],
+                        ensure_ascii=False)
+    return hashlib.blake2b(values.encode('utf-8'), digest_size=16).hexdigest()
+
+
+def save_roster_fingerprints(fingerprints):
+    """写入 {学号: 指纹} 并清空，调用方负责提交"""
+    if not fingerprints:
+        return
+    now = datetime.utcnow()
+    db.session.execute(db.text(
+        'INSERT INTO roster_fingerprint (username, row_hash, imported_at) VALUES (:username, :row_hash, :now) '
+        'ON CONFLICT (username) DO UPDATE SET row_hash = excluded.row_hash, imported_at = excluded.imported_at'
+    ), [{'username': username, 'row_hash': row_hash, 'now': now} for username, row_hash in fingerprints.items()])
+    fingerprints.clear()
+
+
+def _flush_user_batches(existing_ids, balances, inserts, updates):
+    changed = []
+    if inserts:
+        mappings = list(inserts.values())
+        # 初始密码在去重之后、写入之前才哈希：每个实际插入的用户只哈希一次
+        method = app.config['PASSWORD_BULK_HASH_METHOD']
+        for mapping in mappings:
+            mapping['password'] = hash_password(mapping['username'], method)
+        # return_defaults 回填新用户主键，同一文件后面的重复学号可以直接按主键更新
+        db.session.bulk_insert_mappings(User, mappings, return_defaults=True)
+        existing_ids.update((mapping['username'], mapping['id']) for mapping in mappings)
+        changed.extend(mappings)
+        inserts.clear()
+    if updates:
+        mappings = list(updates.values())
+        db.session.bulk_update_mappings(User, mappings)
+        changed.extend(mappings)
+        updates.clear()
+    # 导入直接设置余额，按与原余额的差额追加积分流水
+    now = datetime.utcnow()
+    ledger = []
+    for mapping in changed:
+        delta = mapping['points'] - balances.get(mapping['id'], 0)
+        if delta:
+            ledger.append({'user_id': mapping['id'], 'kind': LEDGER_IMPORT, 'delta': delta,
+                           'balance_after': mapping['points'], 'created_at': now})
+        balances[mapping['id']] = mapping['points']
+    if ledger:
+        db.session.bulk_insert_mappings(PointsLedger, ledger)
+    if changed:
+        bump_cache_version(USERS_VERSION)
+
+
+def import_user_rows(headers, numbered_rows, batch_size=None, on_flush=None):
+    """批量导入学生：一次查询预加载已有学号，按批次bulk插入/更新，返回逐行错误报告
+
+    numbered_rows 为 (行号, 数据元组) 的可迭代对象，可以是流式读取的生成器。
+    不提交事务，由调用方决定commit或rollback；on_flush(result) 在每批写入后调用，
+    后台任务在其中提交本批数据并更新进度。
+    """
+    batch_size = batch_size or app.config['IMPORT_BATCH_SIZE']
+    # 一次性加载所有已有学号和余额，避免逐行查询
+    existing_ids, balances = {}, {}
+    for username, user_id, points in db.session.query(User.username, User.id, User.points):
+        existing_ids[username] = user_id
+        balances[user_id] = points or 0
+    inserts, updates, fingerprints = {}, {}, {}
+    result = {'success': 0, 'fail': 0, 'errors': []}
+
+    for row_number, row in numbered_rows:
+        try:
+            username, fields = parse_roster_row(headers, row)
+        except ValueError as e:
+            result['fail'] += 1
+            result['errors'].append((row_number, str(e)))
+            continue
+
+        if username in existing_ids:
+            # 更新现有用户信息（文件内重复时以最后一行为准）
+            updates.setdefault(username, {'id': existing_ids[username]}).update(fields)
+        elif username in inserts:
+            inserts[username].update(fields)
+        else:
+            inserts[username] = new_user_mapping(username, fields)
+        fingerprints[username] = roster_fingerprint(fields)
+        result['success'] += 1
+
+        if len(inserts) + len(updates) >= batch_size:
+            _flush_user_batches(existing_ids, balances, inserts, updates)
+            save_roster_fingerprints(fingerprints)
+            if on_flush:
+                on_flush(result)
+
+    _flush_user_batches(existing_ids, balances, inserts, updates)
+    save_roster_fingerprints(fingerprints)
+    if on_flush:
+        on_flush(result)
+    return result
+
+
+# 差异同步预览中每类变化展示的条数
+ROSTER_PREVIEW_SAMPLES = 50
+
+
+def diff_roster(headers, numbered_rows, on_progress=None):
+    """比较花名册与上次导入的指纹，只读不写，返回各类变化
+
+    - inserted：系统中没有的学号；
+    - changed：与上次导入的行不同（没有指纹时与当前数据比较），且与当前数据不同；
+    - unchanged：与上次导入相同，或与当前数据相同（只需要补写指纹，记入 refresh）；
+    - removed：上次导入过、这次表格中没有的学生。
+    文件内学号重复时以最后一行为准。
+    """
+    users = {
+        username: (user_id, is_admin, {'name': name or '', 'college': college or '',
+                                       'points': points or 0, 'remaining_points': remaining_points or 0})
+        for username, user_id, is_admin, name, college, points, remaining_points in db.session.query(
+            User.username, User.id, User.is_admin, User.name, User.college, User.points, User.remaining_points)
+    }
+    fingerprints = dict(db.session.query(RosterFingerprint.username, RosterFingerprint.row_hash))
+    rows = {}
+    diff = {'inserted': [], 'changed': [], 'removed': [], 'unchanged': 0, 'refresh': {},
+            'success': 0, 'fail': 0, 'errors': []}
+    for row_number, row in numbered_rows:
+        try:
+            username, fields = parse_roster_row(headers, row)
+        except ValueError as e:
+            diff['fail'] += 1
+            diff['errors'].append((row_number, str(e)))
+            continue
+        rows[username] = (row_number, fields)
+        diff['success'] += 1
+        if on_progress and (diff['success'] + diff['fail']) % app.config['IMPORT_BATCH_SIZE'] == 0:
+            on_progress(diff)
+
+    for username, (row_number, fields) in rows.items():
+        row_hash = roster_fingerprint(fields)
+        if username not in users:
+            diff['inserted'].append({'row': row_number, 'username': username, 'fields': fields, 'hash': row_hash})
+            continue
+        user_id, _, current = users[username]
+        if fingerprints.get(username) == row_hash:
+            diff['unchanged'] += 1
+        elif current == fields:
+            diff['unchanged'] += 1
+            diff['refresh'][username] = row_hash
+        else:
+            diff['changed'].append({'row': row_number, 'username': username, 'id': user_id,
+                                    'fields': fields, 'before': current, 'hash': row_hash})
+    for username in fingerprints.keys() - rows.keys():
+        user = users.get(username)
+        if user is not None and not user[1]:
+            diff['removed'].append({'username': username, 'id': user[0], 'before': user[2]})
+    return diff
+
+
+def apply_roster_diff(diff, remove_missing=False):
+    """按 diff_roster 的结果只写入新增和变化的学生，remove_missing 时清零已移出名单学生的积分；
+    不提交事务，返回写入的学生数"""
+    batch_size = app.config['IMPORT_BATCH_SIZE']
+    existing_ids = {}
+    balances = {item['id']: item['before']['points'] for item in diff['changed'] + diff['removed']}
+    written = 0
+
+    def batches(items):
+        for start in range(0, len(items), batch_size):
+            yield items[start:start + batch_size]
+
+    for batch in batches(diff['inserted']):
+        inserts = {item['username']: new_user_mapping(item['username'], item['fields']) for item in batch}
+        _flush_user_batches(existing_ids, balances, inserts, {})
+        save_roster_fingerprints({item['username']: item['hash'] for item in batch})
+        written += len(batch)
+    for batch in batches(diff['changed']):
+        updates = {item['username']: {'id': item['id'], **item['fields']} for item in batch}
+        _flush_user_batches(existing_ids, balances, {}, updates)
+        save_roster_fingerprints({item['username']: item['hash'] for item in batch})
+        written += len(batch)
+    save_roster_fingerprints(dict(diff['refresh']))
+    if remove_missing:
+        for batch in batches(diff['removed']):
+            updates = {item['username']: {'id': item['id'], 'points': 0, 'remaining_points': 0} for item in batch}
+            _flush_user_batches(existing_ids, balances, {}, updates)
+            # 删除指纹：之后重新出现在名单中时按当前数据比较
+            db.session.query(RosterFingerprint).filter(
+                RosterFingerprint.username.in_([item['username'] for item in batch])
+            ).delete(synchronize_session=False)
+            written += len(batch)
+    return written
+
+
+def summarize_roster_diff(diff, samples=ROSTER_PREVIEW_SAMPLES):
+    """差异同步的预览/结果：各类数量和前若干条明细"""
+    return {
+        'inserted': len(diff['inserted']),
+        'changed': len(diff['changed']),
+        'unchanged': diff['unchanged'],
+        'removed': len(diff['removed']),
+        'fail': diff['fail'],
+        'errors': diff['errors'][:IMPORT_MAX_STORED_ERRORS],
+        'samples': {
+            'inserted': [{'row': item['row'], 'username': item['username'], 'after': item['fields']}
+                         for item in diff['inserted'][:samples]],
+            'changed': [{'row': item['row'], 'username': item['username'], 'before': item['before'],
+                         'after': item['fields']} for item in diff['changed'][:samples]],
+            'removed': [{'username': item['username'], 'before': item['before']}
+                        for item in diff['removed'][:samples]],
+        },
+    }
+
+
+def format_import_result(result, max_errors=20):
+    message = f"导入成功！成功 {result['success']} 条，失败 {result['fail']} 条"
+    if result['errors']:
+        details = '；'.join(f'第{row}行：{reason}' for row, reason in result['errors'][:max_errors])
+        if len(result['errors']) > max_errors:
+            details += f"；等共 {len(result['errors'])} 条"
+        message += f"（失败明细：{details}）"
+    return message
+
+
+# 每个导入任务保存的失败明细条数上限
+IMPORT_MAX_STORED_ERRORS = 200
+
+
+def save_excel_upload(kind, params=None):
+    """校验并保存上传的Excel文件，登记后台任务；返回 (任务id, None) 或 (None, (错误信息, 状态码))"""
+    if 'excel_file' not in request.files:
+        return None, ("未选择文件", 400)
     file = request.files['excel_file']
     if file.filename == '':
-        return "未选择文件", 400
-
+        return None, ("未选择文件", 400)
     # 检查文件格式
     if not (file.filename.endswith('.xlsx') or file.filename.endswith('.xls')):
-        return "请上传Excel文件", 400
+        return None, ("请上传Excel文件", 400)
+
+    with spooled_upload(file) as path:
+        if kind in ('import_users', 'sync_users'):
+            # 先检查表头，缺少必要列时直接返回错误，不必等后台任务
+            roster = iter_roster(path, IMPORT_REQUIRED_HEADERS)
+            try:
+                next(roster)
+            except ExcelFormatError as e:
+                return None, (str(e), 400)
+            except Exception as e:
+                return None, (f"无法读取Excel文件: {str(e)}", 400)
+            finally:
+                roster.close()
+        job_id = job_queue.submit(kind, input_path=path, original_filename=secure_filename(file.filename),
+                                  created_by=current_user().id, params=params)
+    return job_id, None
+
+
+def serialize_job(job):
+    data = {
+        'id': job.id,
+        'kind': job.kind,
+        'status': job.status,
+        'original_filename': job.original_filename,
+        'processed_rows': job.processed_rows,
+        'failed_rows': job.failed_rows,
+        'total_rows': job.total_rows,
+        'result': json.loads(job.result) if job.result else None,
+        'error': job.error,
+        'created_at': job.created_at.strftime('%Y-%m-%d %H:%M:%S'),
+        'finished_at': job.finished_at.strftime('%Y-%m-%d %H:%M:%S') if job.finished_at else None,
+        'download_url': None,
+    }
+    if job_queue.artifact_file(job):
+        data['download_url'] = url_for('download_job_artifact', job_id=job.id)
+    return data
+
 
+@job_queue.register('import_users')
+def run_import_users_job(job):
+    """后台导入学生名单：每批写入后提交并更新进度，失败时已提交的批次保留（重新导入同一文件结果相同）"""
+    job.progress(total=max((estimate_rows(job.input_path) or 1) - 1, 0), force=True)
+    roster = iter_roster(job.input_path, IMPORT_REQUIRED_HEADERS)
     try:
-        # 修复：将上传的文件转换为字节流，解决seekable问题
-        # 方法1：读取文件内容到字节流
-        file_content = file.read()
-        file_stream = io.BytesIO(file_content)
-
-        # 加载Excel文件（使用字节流）
-        workbook = load_workbook(file_stream, data_only=True)
-        sheet = workbook.active
-
-        # 获取表头并验证
-        headers = [cell.value for cell in sheet[1]]
-        required_headers = ['姓名', '学号', '学院', '爱心币数量', '剩余爱心币']
-        for header in required_headers:
-            if header not in headers:
-                return f"Excel文件缺少必要列: {header}", 400
-
-        # 记录导入成功和失败的数量
-        success_count = 0
-        fail_count = 0
-
-        # 从第二行开始读取数据（跳过表头）
-        for row in sheet.iter_rows(min_row=2, values_only=True):
-            # 创建数据字典，将单元格值与表头对应
-            row_data = dict(zip(headers, row))
-
-            # 提取所需数据
-            name = row_data['姓名'] or ''
-            student_id = row_data['学号'] or ''
-            college = row_data['学院'] or ''
-            points = int(row_data['爱心币数量'] or 0)
-            remaining_points = int(row_data['剩余爱心币'] or 0)
-
-            # 检查学号是否为空
-            if not student_id:
-                fail_count += 1
-                continue
+        headers = next(roster)
+    except ExcelFormatError as e:
+        raise JobFailed(str(e))
+    result = import_user_rows(
+        headers, roster,
+        on_flush=lambda result: job.progress(result['success'] + result['fail'], result['fail'], force=True)
+    )
+    db.session.commit()
+    return {
+        'success': result['success'],
+        'fail': result['fail'],
+        'errors': result['errors'][:IMPORT_MAX_STORED_ERRORS],
+        'message': format_import_result(result),
+    }
 
-            # 检查用户是否已存在
-            existing_user = User.query.filter_by(username=str(student_id)).first()
-            if existing_user:
-                # 更新现有用户信息
-                existing_user.name = name
-                existing_user.college = college
-                existing_user.points = points
-                existing_user.remaining_points = remaining_points
-                success_count += 1
-            else:
-                # 创建新用户（密码默认为学号）
-                new_user = User(
-                    username=str(student_id),
-                    password=str(student_id),
-                    is_admin=False,
-                    name=name,
-                    college=college,
-                    points=points,
-                    remaining_points=remaining_points,
-                    gender='male'  # 默认性别
-                )
-                db.session.add(new_user)
-                success_count += 1
 
-        db.session.commit()
-        return f"导入成功！成功 {success_count} 条，失败 {fail_count} 条", 200
+@job_queue.register('sync_users')
+def run_sync_users_job(job):
+    """差异同步学生名单：dry_run 时只返回与上次导入相比的变化，否则只写入新增和变化的学生"""
+    dry_run = job.params.get('dry_run', True)
+    job.progress(total=max((estimate_rows(job.input_path) or 1) - 1, 0), force=True)
+    roster = iter_roster(job.input_path, IMPORT_REQUIRED_HEADERS)
+    try:
+        headers = next(roster)
+    except ExcelFormatError as e:
+        raise JobFailed(str(e))
+    diff = diff_roster(headers, roster,
+                       on_progress=lambda diff: job.progress(diff['success'] + diff['fail'], diff['fail']))
+    job.progress(diff['success'] + diff['fail'], diff['fail'], force=True)
+    result = summarize_roster_diff(diff)
+    result['dry_run'] = dry_run
+    if dry_run:
+        result['message'] = (f"预览：新增 {result['inserted']} 人，变化 {result['changed']} 人，"
+                             f"未变化 {result['unchanged']} 人，名单中已移除 {result['removed']} 人，"
+                             f"无法导入 {result['fail']} 行")
+        return result
+    remove_missing = job.params.get('remove_missing', False)
+    result['written'] = apply_roster_diff(diff, remove_missing=remove_missing)
+    db.session.commit()
+    result['message'] = (f"同步完成：新增 {result['inserted']} 人，更新 {result['changed']} 人，"
+                         f"未变化 {result['unchanged']} 人"
+                         + (f"，清零已移除的 {result['removed']} 人" if remove_missing else '')
+                         + f"，无法导入 {result['fail']} 行")
+    return result
+
+
+@job_queue.register('process_excel')
+def run_process_excel_job(job):
+    """后台整理表格，结果文件保存在任务目录中供下载"""
+    job.progress(total=estimate_rows(job.input_path, all_sheets=True), force=True)
+    output_path = merged_output_path(job.work_dir, job.original_filename)
+    stats = merge_excel(job.input_path, output_path,
+                        on_progress=lambda stats: job.progress(stats['total_rows']))
+    job.set_artifact(os.path.basename(output_path))
+    job.progress(stats['total_rows'], commit=False, force=True)
+    return stats
+
+
+@app.route('/import_excel', methods=['POST'])
+def import_excel():
+    """上传学生名单，后台导入；返回任务id，进度通过 /jobs/<任务id> 查询
+
+    mode=diff 时为差异同步：先生成预览（不写入），确认后通过 /import_excel/<任务id>/apply 写入。
+    """
+    if not is_admin_user():
+        return jsonify({'success': False, 'error': '未授权访问'}), 403
+    if request.form.get('mode') == 'diff':
+        job_id, error = save_excel_upload('sync_users', params={'dry_run': True})
+    else:
+        job_id, error = save_excel_upload('import_users')
+    if error:
+        return jsonify({'success': False, 'error': error[0]}), error[1]
+    return jsonify({'success': True, 'job_id': job_id, 'status_url': url_for('job_status', job_id=job_id)}), 202
+
+
+@app.route('/import_excel/<job_id>/apply', methods=['POST'])
+def apply_roster_sync(job_id):
+    """按差异同步预览使用的同一个文件执行同步（重新比较，以执行时的数据为准）"""
+    if not is_admin_user():
+        return jsonify({'success': False, 'error': '未授权访问'}), 403
+    preview = job_queue.get(job_id)
+    if preview is None or preview.kind != 'sync_users' or not preview.input_name:
+        abort(404)
+    if preview.status != JOB_SUCCEEDED or not json.loads(preview.params or '{}').get('dry_run'):
+        return jsonify({'success': False, 'error': '只能执行已完成的预览'}), 400
+    source = os.path.join(job_queue.job_dir(preview.id), preview.input_name)
+    if not os.path.isfile(source):
+        return jsonify({'success': False, 'error': '预览的文件已过期，请重新上传'}), 410
+    # submit 会把文件移动到新任务的目录，复制一份保留预览任务的文件
+    fd, path = tempfile.mkstemp(suffix=os.path.splitext(preview.input_name)[1])
+    os.close(fd)
+    shutil.copyfile(source, path)
+    params = {'dry_run': False, 'remove_missing': request.form.get('remove_missing') == '1', 'preview': preview.id}
+    new_job_id = job_queue.submit('sync_users', input_path=path, original_filename=preview.original_filename,
+                                  created_by=current_user().id, params=params)
+    return jsonify({'success': True, 'job_id': new_job_id,
+                    'status_url': url_for('job_status', job_id=new_job_id)}), 202
+
+
+@app.route('/jobs/<job_id>')
+def job_status(job_id):
+    if not is_admin_user():
+        return jsonify({'error': '未授权访问'}), 403
+    job = job_queue.get(job_id)
+    if job is None:
+        abort(404)
+    return jsonify(serialize_job(job))
+
+
+@app.route('/jobs/<job_id>/download')
+def download_job_artifact(job_id):
+    if not is_admin_user():
+        return redirect(url_for('login'))
+    job = job_queue.get(job_id)
+    path = job_queue.artifact_file(job) if job else None
+    if path is None:
+        abort(404)
+    return send_file(path, as_attachment=True, download_name=job.artifact_name)
+
+
+def parse_report_args(args):
+    """统计区间和未使用积分的下限；参数错误时抛出 ReportError"""
+    report_range = ReportRange.parse(args.get('start', '').strip(), args.get('end', '').strip())
+    min_points = args.get('min_points', 1, type=int)
+    return report_range, max(min_points, 1)
+
+
+@contextmanager
+def archived_purchases(report_range=None):
+    """报表的购买记录来源：统计区间与已归档学年重叠时把对应的归档文件 ATTACH 到当前连接，结束后分离
+
+    report_range 为 None 时包含全部归档（最近兑换时间）。缺少归档文件时抛出 ArchiveError。
+    """
+    connection = db.session.connection()
+    years = purchase_archive.archived_years(connection, report_range)
+    with purchase_archive.attached(connection, app.config['ARCHIVE_DIR'], years) as schemas:
+        yield purchase_archive.purchase_source(schemas, report_range)
+
+
+@app.route('/admin/reports')
+def admin_reports():
+    """统计报表：学院月度积分、商品排行、库存周转和未使用积分，结果缓存到有新的购买/修改为止"""
+    if not is_admin_user():
+        return jsonify({'error': '未授权访问'}), 403
+    try:
+        report_range, min_points = parse_report_args(request.args)
+    except ReportError as e:
+        return jsonify({'error': str(e)}), 400
+    limit = min(request.args.get('limit', 20, type=int), 200)
+    key = report_range.key()
+
+    def compute(report, report_range=report_range):
+        # 缓存未命中时才 ATTACH 归档文件
+        def run():
+            with archived_purchases(report_range) as source:
+                return report(source)
+        return run
+
+    try:
+        return jsonify({
+            'college_monthly': report_cache.get(('college_monthly', key), compute(
+                lambda source: reports.college_monthly(db.session, report_range, source))),
+            'top_products': report_cache.get(('top_products', key, limit), compute(
+                lambda source: reports.top_products(db.session, report_range, limit, source))),
+            'stock_turnover': report_cache.get(('stock_turnover', key), compute(
+                lambda source: reports.stock_turnover(db.session, report_range, source=source))),
+            'unused_balance': report_cache.get(('unused_balance', min_points, limit), compute(
+                lambda source: reports.unused_balance(db.session, min_points, limit, source), None)),
+        })
+    except ArchiveError as e:
+        return jsonify({'error': str(e)}), 500
 
-    except Exception as e:
-        db.session.rollback()
-        return f"导入失败: {str(e)}", 500
+
+@app.route('/admin/reports/<name>.csv')
+def export_report_csv(name):
+    """边查询边输出CSV，导出全年明细也不需要把记录全部放进内存"""
+    if not is_admin_user():
+        return redirect(url_for('login'))
+    if name not in reports.EXPORTS:
+        abort(404)
+    try:
+        report_range, min_points = parse_report_args(request.args)
+    except ReportError as e:
+        return jsonify({'error': str(e)}), 400
+    _, headers, _ = reports.EXPORTS[name]
+
+    def rows():
+        with archived_purchases(report_range if name != 'unused_balance' else None) as source:
+            yield from reports.iter_export_rows(db.session, name, report_range, min_points, source=source)
+
+    filename = reports.export_filename(name, report_range, 'csv')
+    response = Response(stream_with_context(reports.iter_csv(headers, rows())), mimetype='text/csv')
+    response.headers['Content-Disposition'] = \
+        f"attachment; filename=report.csv; filename*=UTF-8''{quote(filename)}"
+    return response
+
+
+@app.route('/admin/reports/<name>.xlsx', methods=['POST'])
+def export_report_xlsx(name):
+    """XLSX需要写完整个文件才能下载，在后台任务中生成；完成后从 /jobs/<任务id>/download 下载"""
+    if not is_admin_user():
+        return jsonify({'success': False, 'error': '未授权访问'}), 403
+    if name not in reports.EXPORTS:
+        abort(404)
+    try:
+        parse_report_args(request.form)
+    except ReportError as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
+    params = {'report': name, 'start': request.form.get('start', '').strip(),
+              'end': request.form.get('end', '').strip(), 'min_points': request.form.get('min_points', '')}
+    job_id = job_queue.submit('export_report', created_by=current_user().id, params=params)
+    return jsonify({'success': True, 'job_id': job_id, 'status_url': url_for('job_status', job_id=job_id)}), 202
+
+
+@job_queue.register('export_report')
+def run_export_report_job(job):
+    name = job.params['report']
+    report_range, min_points = parse_report_args(MultiDict(job.params))
+    title, headers, _ = reports.EXPORTS[name]
+    filename = reports.export_filename(name, report_range, 'xlsx')
+    with archived_purchases(report_range if name != 'unused_balance' else None) as source:
+        count = reports.write_xlsx(job.artifact_path(filename), title, headers,
+                                   reports.iter_export_rows(db.session, name, report_range, min_points, source=source),
+                                   on_progress=lambda count: job.progress(count, commit='separate'))
+    job.set_artifact(filename)
+    job.progress(count, commit=False, force=True)
+    return {'rows': count}
 
 
 @app.route('/deepseek')
 def deepseek():
-    if 'username' not in session:
+    if current_user() is None:
         return redirect(url_for('login'))
     return render_template('deepseek.html')
 
 
+def create_assistant_backend():
+    if app.config['AI_BACKEND'] == 'stub':
+        return StubBackend()
+    return DeepseekBackend(app.config['AI_API_URL'], app.config['AI_API_KEY'], model=app.config['AI_MODEL'],
+                           pool_size=app.config['AI_POOL_SIZE'], timeout=app.config['AI_TIMEOUT'])
+
+
+assistant = AssistantProxy(
+    create_assistant_backend(),
+    ResponseCache(maxsize=app.config['AI_CACHE_SIZE'], ttl=app.config['AI_CACHE_TTL']),
+    RateLimiter(per_minute=app.config['AI_RATE_PER_MINUTE'], burst=app.config['AI_RATE_BURST']),
+    max_streams=app.config['AI_MAX_STREAMS'],
+    timeout=app.config['AI_TIMEOUT'],
+)
+
+
+@app.route('/deepseek/chat', methods=['POST'])
+def deepseek_chat():
+    """请求体 {"message": 问题}，以 SSE 返回 {"content"}（分段）、{"done", "cached"} 或 {"error"}"""
+    identity = current_user()
+    if identity is None:
+        return jsonify({'error': '请先登录'}), 401
+    payload = request.get_json(silent=True) or {}
+    try:
+        events = assistant.open(identity.id, payload.get('message'))
+    except RateLimited as e:
+        return jsonify({'error': str(e)}), 429
+    except AssistantError as e:
+        return jsonify({'error': str(e)}), 400
+    return Response(events, mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
 @app.route('/help')
 def help_page():
-    if 'username' not in session:
+    if current_user() is None:
         return redirect(url_for('login'))
-    return render_template('help.html')
+    # 帮助页只引用模板和静态文件（地址中带内容哈希）
+    return conditional_page(('help', folder_version(TEMPLATE_DIR), folder_version(app.static_folder)),
+                            lambda: render_template('help.html'))
 
 
 @app.route('/process_excel', methods=['POST'])
 def process_excel():
-    if 'username' not in session or not session.get('is_admin'):
+    """上传需要整理的表格，后台处理；完成后从 /jobs/<任务id>/download 下载结果"""
+    if not is_admin_user():
         return jsonify({'success': False, 'error': '未授权访问'}), 403
+    job_id, error = save_excel_upload('process_excel')
+    if error:
+        return jsonify({'success': False, 'error': error[0]}), error[1]
+    return jsonify({'success': True, 'job_id': job_id, 'status_url': url_for('job_status', job_id=job_id)}), 202
 
-    if 'excel_file' not in request.files:
-        return jsonify({'success': False, 'error': '未选择文件'}), 400
 
-    file = request.files['excel_file']
-    if file.filename == '':
-        return jsonify({'success': False, 'error': '未选择文件'}), 400
+def init_database():
+    """建表、执行迁移并创建默认管理员
 
-    # 检查文件格式
-    if not (file.filename.endswith('.xlsx') or file.filename.endswith('.xls')):
-        return jsonify({'success': False, 'error': '请上传Excel文件'}), 400
-
-    try:
-        # 创建临时目录保存上传的文件
-        temp_dir = os.path.join(app.root_path, 'temp')
-        os.makedirs(temp_dir, exist_ok=True)
-        
-        # 保存文件到临时目录
-        temp_file_path = os.path.join(temp_dir, secure_filename(file.filename))
-        file.save(temp_file_path)
-        
-        # 直接在Flask应用中处理Excel文件
-        import openpyxl
-        from openpyxl import Workbook
-        
-        # 读取Excel文件
-        workbook = openpyxl.load_workbook(temp_file_path)
-        
-        # 创建新的工作簿来存储合并后的数据
-        merged_workbook = Workbook()
-        merged_sheet = merged_workbook.active
-        merged_sheet.title = '合并数据'
-        
-        # 获取所有sheet名称
-        sheet_names = workbook.sheetnames
-        original_sheets = len(sheet_names)
-        
-        # 遍历每个sheet
-        for sheet_name in sheet_names:
-            sheet = workbook[sheet_name]
-            
-            # 获取当前sheet的所有行
-            rows = list(sheet.iter_rows(values_only=True))
-            
-            # 如果是第一个sheet，复制所有行（包括表头）
-            if sheet_name == sheet_names[0]:
-                for row in rows:
-                    merged_sheet.append(row)
-            # 否则，跳过表头，只复制数据行
-            else:
-                for row in rows[1:]:
-                    merged_sheet.append(row)
-        
-        # 删除第一行（标题行）
-        merged_sheet.delete_rows(1)
-        
-        # 确保第一行是正确的表头
-        correct_headers = ["姓名", "学号", "学院", "爱心币数量", "剩余爱心币"]
-        # 获取当前第一行
-        current_header = merged_sheet[1]
-        # 检查当前表头是否正确
-        header_mismatch = False
-        for i, (current_cell, correct_header) in enumerate(zip(current_header, correct_headers)):
-            if current_cell.value != correct_header:
-                header_mismatch = True
-                break
-        
-        # 如果表头不正确，替换为正确的表头
-        if header_mismatch:
-            for i, header in enumerate(correct_headers, 1):
-                merged_sheet.cell(row=1, column=i).value = header
-        
-        # 处理D列和E列的数据
-        # 从第3行开始处理，跳过第1、2行
-        for row in range(3, merged_sheet.max_row + 1):
-            # 获取D列和E列的值
-            d_value = merged_sheet[f'D{row}'].value
-            e_value = merged_sheet[f'E{row}'].value
-            
-            # 确定最终值：如果E列有数值（不是None），则使用E列的值，否则使用D列的值
-            final_value = e_value if e_value is not None else d_value
-            
-            # 将最终值写入D列（爱心币数量）
-            merged_sheet[f'D{row}'] = final_value
-            # 保留E列（剩余爱心币）的原始值，不做修改
-        
-        # 删除空白行（从下往上检查，避免删除行后索引混乱）
-        # 从最后一行开始往上检查
-        for row in range(merged_sheet.max_row, 2, -1):  # 从最后一行到第3行（保留第1、2行）
-            # 检查当前行是否所有单元格都是空的
-            is_empty = True
-            for col in range(1, merged_sheet.max_column + 1):
-                cell_value = merged_sheet.cell(row=row, column=col).value
-                if cell_value is not None and cell_value != '':
-                    is_empty = False
-                    break
-            # 如果是空白行，则删除
-            if is_empty:
-                merged_sheet.delete_rows(row)
-        
-        # 删除包含"高等职业技术学院"的行（从下往上检查，避免删除行后索引混乱）
-        delete_count = 0
-        for row in range(merged_sheet.max_row, 2, -1):  # 从最后一行到第3行（保留第1、2行）
-            # 检查当前行的所有单元格
-            for col in range(1, merged_sheet.max_column + 1):
-                cell_value = merged_sheet.cell(row=row, column=col).value
-                if cell_value is not None and "高等职业技术学院" in str(cell_value):
-                    merged_sheet.delete_rows(row)
-                    delete_count += 1
-                    break
-        
-        # 创建Excel输出目录
-        excel_output_dir = os.path.join(app.root_path, 'static', 'excel')
-        os.makedirs(excel_output_dir, exist_ok=True)
-        
-        # 保存合并后的文件
-        # 生成输出文件路径：在静态目录下生成处理后的文件
-        input_filename = os.path.basename(temp_file_path)
-        name, ext = os.path.splitext(input_filename)
-        merged_filename = f'{name}_处理后{ext}'
-        merged_file_path = os.path.join(excel_output_dir, merged_filename)
-        merged_workbook.save(merged_file_path)
-        
-        # 生成前端可访问的URL路径
-        merged_file_url = f'static/excel/{merged_filename}'
-        
-        total_rows = merged_sheet.max_row
-        
-        # 返回处理结果
-        return jsonify({
-            'success': True,
-            'file_path': merged_file_url,
-            'original_sheets': original_sheets,
-            'total_rows': total_rows,
-            'deleted_rows': delete_count
-        })
-        
-    except Exception as e:
-        return jsonify({
-            'success': False,
-            'error': f'文件处理失败: {str(e)}'
-        }), 500
-    finally:
-        # 清理临时文件
-        if 'temp_file_path' in locals() and os.path.exists(temp_file_path):
-            os.remove(temp_file_path)
-
-
-if __name__ == '__main__':
+    部署时只在启动阶段执行一次（serve 命令，或 gunicorn 主进程启动 worker 前调用的 init-db 命令），不在每个worker中重复执行。
+    """
     with app.app_context():
         # 先创建所有表（删除旧文件后）
         db.create_all()
 
-        # 尝试更新表结构（兼容已有数据的情况）
-        try:
-            update_database_schema()
-        except:
-            pass
+        # 执行未执行过的数据库迁移（兼容已有数据的情况）
+        run_migrations(db.engine)
 
         # 添加管理员账号
         if not User.query.filter_by(username='111').first():
             # 管理员
-            admin = User(username='111', password='111', is_admin=True)
+            admin = User(username='111', password=hash_password('111', app.config['PASSWORD_HASH_METHOD']),
+                         is_admin=True)
             db.session.add(admin)
             db.session.commit()
-    app.run(debug=True)
\ No newline at end of file
+        db.session.remove()
+        # 关闭启动阶段建立的连接，fork出的worker进程各自重新连接
+        db.engine.dispose()
+
+
+@app.cli.command('init-db')
+def init_db_command():
+    """建表、执行数据库迁移并创建默认管理员"""
+    init_database()
+
+
+@app.cli.command('serve')
+@click.option('--host', default='0.0.0.0', show_default=True)
+@click.option('--port', default=5000, show_default=True)
+@click.option('--threads', default=16, show_default=True, help='处理请求的线程数')
+def serve_command(host, port, threads):
+    """生产环境启动：waitress 多线程服务（Linux 上也可以使用 gunicorn -c gunicorn.conf.py wsgi:app）"""
+    try:
+        from waitress import serve
+    except ImportError:
+        raise click.ClickException('请先安装 waitress：pip install waitress')
+    init_database()
+    start_job_worker()
+    serve(app, host=host, port=port, threads=threads)
+
+
+if __name__ == '__main__':
+    # 开发调试用，生产环境请使用 flask --app app serve
+    init_database()
+    # 调试模式下由重新加载器启动的子进程处理请求，只在子进程中启动任务线程
+    if os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        start_job_worker()
+    app.run(debug=True)
@@ -0,0 +1,97 @@
+"""登录身份与密码哈希
+
+会话中只保存用户id，每个请求按主键取得身份（id、用户名、是否管理员），
+并缓存在进程内的 LRU 中；缓存项有过期时间，其他进程修改或删除用户后最多延迟 ttl 秒生效，
+本进程内修改用户时直接失效对应缓存项。
+
+密码使用 werkzeug 的加盐哈希保存，哈希方法（含迭代次数）可配置。
+批量导入的初始密码（即学号）使用低成本的方法，用户首次登录时按正式方法重新哈希。
+"""
+import hmac
+import re
+import threading
+import time
+from collections import OrderedDict, namedtuple
+from functools import lru_cache
+
+from werkzeug.security import check_password_hash, generate_password_hash
+
+Identity = namedtuple('Identity', ['id', 'username', 'is_admin'])
+
+# 批量导入和迁移时使用的低成本哈希方法，用户首次登录时升级为正式配置
+BULK_HASH_METHOD = 'pbkdf2:sha256:1000'
+
+# werkzeug 哈希格式：方法$盐$摘要，例如 pbkdf2:sha256:600000$xxxx$xxxx
+_HASH_PATTERN = re.compile(r'^(pbkdf2|scrypt):[^$]+\$[^$]+\$[0-9a-f]+$')
+
+
+def is_password_hash(value):
+    return bool(value) and _HASH_PATTERN.match(value) is not None
+
+
+def hash_password(password, method):
+    return generate_password_hash(password, method=method)
+
+
+def verify_password(stored, password):
+    """校验密码；兼容尚未迁移的明文密码"""
+    if not stored:
+        return False
+    if is_password_hash(stored):
+        return check_password_hash(stored, password)
+    return hmac.compare_digest(stored.encode(), password.encode())
+
+
+@lru_cache(maxsize=None)
+def _hash_prefix(method):
+    # 'scrypt'、'pbkdf2' 等简写在哈希中会展开为完整参数，取一次实际生成的前缀
+    return generate_password_hash('', method=method).split('$', 1)[0]
+
+
+def needs_rehash(stored, method):
+    """明文密码或哈希方法/成本与配置不同时返回 True"""
+    return not is_password_hash(stored) or stored.split('$', 1)[0] != _hash_prefix(method)
+
+
+class IdentityCache:
+    """按用户id缓存 Identity 的 LRU，load(user_id) 在未命中时返回 Identity 或 None"""
+
+    def __init__(self, load, maxsize=1024, ttl=30):
+        self._load = load
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # user_id -> (过期时间, Identity)
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, user_id):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry and entry[0] > now:
+                self._entries.move_to_end(user_id)
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+        identity = self._load(user_id)
+        with self._lock:
+            if identity is None:
+                self._entries.pop(user_id, None)
+            else:
+                self._entries[user_id] = (now + self.ttl, identity)
+                self._entries.move_to_end(user_id)
+                while len(self._entries) > self.maxsize:
+                    self._entries.popitem(last=False)
+        return identity
+
+    def invalidate(self, user_id):
+        with self._lock:
+            self._entries.pop(user_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self._entries), 'maxsize': self.maxsize}
@@ -0,0 +1,192 @@
+"""兑换记录归档：归档已结束学年前后的报表一致性、主库记录数和常用查询耗时
+
+用法：python benchmarks/archive_bench.py [学生数] [每人每学年兑换记录数]
+生成跨四个学年的兑换记录（当前学年 + 三个已结束的学年），先统计全部报表和导出，然后：
+1. 模拟一次中途失败的归档（归档文件已写入、主库未登记），报表不受影响；
+2. 归档所有已结束的学年，主库只剩当前学年的记录，报表、CSV导出和月度限购计数与归档前一致；
+3. 对比归档前后商品页（兑换记录未缓存）和跨学年报表的耗时，并检查各分支都按时间索引查询。
+"""
+import os
+import statistics
+import sys
+import time
+from datetime import datetime, timedelta
+
+from bench_utils import use_temp_database, reset_database
+
+use_temp_database()
+
+from app import (app, db, User, Product, PurchaseRecord, PointsLedger, LEDGER_OPENING,  # noqa: E402
+                 archived_purchases, fragment_cache, identity_cache, report_cache, verify_purchase_counters)
+import purchase_archive  # noqa: E402
+from migrations import explain_query_plan  # noqa: E402
+from reports import ReportRange, college_monthly_statement  # noqa: E402
+
+PRODUCTS = 30
+START_MONTH = app.config['ACADEMIC_YEAR_START_MONTH']
+
+
+def seed(students, per_year, years):
+    with app.app_context():
+        reset_database(db)
+        products = [Product(name=f'商品{i}', picture='bench.png', price=2, stock=100000, limit=100000)
+                    for i in range(PRODUCTS)]
+        users = [User(username=f'S{i:05d}', password='x', name=f'学生{i}', college=f'学院{i % 10}',
+                      points=100000, remaining_points=100000) for i in range(students)]
+        admin = User(username='bench-admin', password='x', is_admin=True)
+        db.session.add_all(products + users + [admin])
+        db.session.flush()
+        db.session.add_all([
+            PointsLedger(user_id=user.id, kind=LEDGER_OPENING, delta=100000, balance_after=100000) for user in users
+        ])
+        now = datetime.utcnow()
+        for year in years:
+            start, end = purchase_archive.academic_year_bounds(year, START_MONTH)
+            span = (min(end, now) - start).total_seconds()
+            db.session.bulk_insert_mappings(PurchaseRecord, [
+                {'user_id': user.id, 'product_id': products[(user.id * 7 + i) % PRODUCTS].id,
+                 'quantity': 1 + i % 3, 'unit_price': 2, 'total_cost': 2 * (1 + i % 3),
+                 'purchase_time': start + timedelta(seconds=span * ((user.id * 31 + i * 997) % 10007) / 10007)}
+                for user in users for i in range(per_year)
+            ])
+        db.session.commit()
+        verify_purchase_counters(fix=True)
+        identity_cache.clear()
+        return users[0].id, admin.id
+
+
+def login(user_id):
+    client = app.test_client()
+    with client.session_transaction() as sess:
+        sess['user_id'] = user_id
+    return client
+
+
+def snapshot(admin, ranges):
+    """各区间的报表和明细导出"""
+    report_cache.clear()
+    result = {}
+    for start, end in ranges:
+        query = f'start={start}&end={end}'
+        result[(start, end)] = (admin.get(f'/admin/reports?{query}&limit=200').get_json(),
+                                admin.get(f'/admin/reports/purchases.csv?{query}').get_data(),
+                                admin.get(f'/admin/reports/unused_balance.csv?{query}').get_data())
+    return result
+
+
+def live_count():
+    with app.app_context():
+        return db.session.query(PurchaseRecord).count()
+
+
+def timed(request, before=None, repeat=10):
+    latencies = []
+    for _ in range(repeat):
+        if before:
+            before()
+        started = time.perf_counter()
+        response = request()
+        latencies.append((time.perf_counter() - started) * 1000)
+        assert response.status_code == 200
+    return statistics.median(latencies)
+
+
+def measure(student, admin, label):
+    shop = timed(lambda: student.get('/'), before=fragment_cache.clear)
+    reports = timed(lambda: admin.get('/admin/reports?limit=20'), before=report_cache.clear)
+    print(f'{label}：主库 {live_count()} 条记录，商品页（未缓存）p50 {shop:.1f}ms，全部学年报表 p50 {reports:.1f}ms')
+
+
+def interrupted_archive(year):
+    """复制到归档文件后主库未登记就中断"""
+    with app.app_context():
+        with db.engine.connect() as connection:
+            with purchase_archive.attached(connection, app.config['ARCHIVE_DIR'], [year], create=True) as (schema,):
+                params = {'start': f'{year}-{START_MONTH:02d}-01 00:00:00',
+                          'end': f'{year + 1}-{START_MONTH:02d}-01 00:00:00'}
+                copied = purchase_archive._copy(connection, schema, 'interrupted', params)
+                connection.commit()
+    return copied['record_count']
+
+
+def check_plan(years):
+    """跨学年区间的报表：UNION ALL 的每个分支（主库和各归档文件）都按时间索引查询"""
+    report_range = ReportRange(datetime(years[0], START_MONTH, 15), datetime(years[-1] + 1, 3, 1))
+    with app.app_context():
+        with archived_purchases(report_range) as source:
+            statement = college_monthly_statement(report_range, source)
+            plan = explain_query_plan(db.session.connection(), statement)
+        db.session.rollback()
+    branches = [line for line in plan if '.purchase_record' in line]
+    assert len(branches) == len(years) and all(line.startswith('SEARCH') for line in branches), plan
+    print('跨学年报表的查询计划：\n  ' + '\n  '.join(branches))
+
+
+def main():
+    students = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    per_year = int(sys.argv[2]) if len(sys.argv) > 2 else 40
+    current = purchase_archive.academic_year_of(datetime.utcnow(), START_MONTH)
+    years = [current - 3, current - 2, current - 1, current]
+    student_id, admin_id = seed(students, per_year, years)
+    student, admin = login(student_id), login(admin_id)
+    # 区间都在过去：库存周转的可售天数按区间天数计算，不随当前时间变化
+    recent = (datetime.utcnow() - timedelta(days=2)).strftime('%Y-%m-%d')
+    ranges = [(f'{years[0]}-10-01', f'{years[2]}-03-31'), (f'{years[1]}-12-01', recent), ('', recent)]
+
+    before = snapshot(admin, ranges)
+    total = live_count()
+    measure(student, admin, '归档前')
+
+    # 中途失败的归档：归档文件中有未登记的批次。另登记一个空批次，使报表 ATTACH 该学年的归档文件
+    with app.app_context():
+        db.session.execute(db.text(
+            'INSERT INTO archive_manifest (batch_id, period, start_time, end_time, filename, record_count, '
+            "total_quantity, total_cost, archived_at) VALUES ('placeholder', :period, :start, :end, :filename, "
+            '0, 0, 0, CURRENT_TIMESTAMP)'),
+            {'period': purchase_archive.period_label(years[2]), 'start': f'{years[2]}-09-01 00:00:00',
+             'end': f'{years[2] + 1}-09-01 00:00:00', 'filename': purchase_archive.archive_filename(years[2])})
+        db.session.commit()
+    stale = interrupted_archive(years[2])
+    assert snapshot(admin, ranges) == before, '未登记的批次被计入了报表'
+    with app.app_context():
+        db.session.execute(db.text("DELETE FROM archive_manifest WHERE batch_id = 'placeholder'"))
+        db.session.commit()
+    print(f'模拟中断：归档文件中留下 {stale} 条未登记记录，报表不变')
+
+    with app.app_context():
+        with db.engine.connect() as connection:
+            pending = purchase_archive.pending_years(connection, start_month=START_MONTH)
+        assert [item[0] for item in pending] == years[:3], pending
+        started = time.perf_counter()
+        for year, count, _, _ in pending:
+            batch = purchase_archive.archive_year(db.engine, app.config['ARCHIVE_DIR'], year, START_MONTH)
+            assert batch['record_count'] == count
+        elapsed = time.perf_counter() - started
+        assert not verify_purchase_counters(), '月度限购计数与主库记录不一致'
+        with db.engine.connect() as connection:
+            archives = purchase_archive.list_archives(connection)
+    archived = sum(archive['record_count'] for archive in archives)
+    sizes = sum(os.path.getsize(os.path.join(app.config['ARCHIVE_DIR'], archive['filename'])) for archive in archives)
+    print(f'归档 {len(archives)} 个学年共 {archived} 条记录（{elapsed:.2f}s），归档文件合计 {sizes / 1024 / 1024:.1f}MB')
+    assert archived + live_count() == total
+    assert snapshot(admin, ranges) == before, '归档后报表或导出与归档前不一致'
+
+    measure(student, admin, '归档后')
+    check_plan(years)
+
+    # 再次执行：没有需要归档的学年，当前学年不能归档
+    with app.app_context():
+        with db.engine.connect() as connection:
+            assert not purchase_archive.pending_years(connection, start_month=START_MONTH)
+        try:
+            purchase_archive.archive_year(db.engine, app.config['ARCHIVE_DIR'], current, START_MONTH)
+        except purchase_archive.ArchiveError as e:
+            print(f'当前学年：{e}')
+        else:
+            raise AssertionError('当前学年不应被归档')
+    assert student.post('/api/purchase/1', json={'quantity': 1}).get_json()['success']
+    print('校验通过：归档后报表和导出与归档前一致，主库只保留当前学年的记录')
+
+
+if __name__ == '__main__':
+    main()
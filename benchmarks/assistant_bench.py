@@ -0,0 +1,151 @@
+"""AI助手代理压测：本地启动一个模拟 chat/completions 流式接口的HTTP服务，代替外部大模型接口
+
+用法：python benchmarks/assistant_bench.py [并发用户数] [每段回答的间隔毫秒]
+1. 所有用户同时提问（几个常见问题的不同写法）：统计首段延迟、接口调用次数和新建连接数；
+2. 再问一遍：全部命中缓存，不调用接口；
+3. 大量不同的问题同时提问：超过每个进程的转发上限时立即返回“人数较多”，不占用线程等待；
+4. 同一用户连续提问：超过限流次数返回429。
+"""
+import json
+import os
+import statistics
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from bench_utils import use_temp_database, reset_database
+
+CHUNK_DELAY = (float(sys.argv[2]) if len(sys.argv) > 2 else 20) / 1000
+
+
+class FakeCompletions(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # 保持连接，验证代理的连接池复用
+    calls = 0
+    lock = threading.Lock()
+
+    def do_POST(self):
+        prompt = json.loads(self.rfile.read(int(self.headers['Content-Length'])))['messages'][0]['content']
+        with FakeCompletions.lock:
+            FakeCompletions.calls += 1
+        events = [
+            f"data: {json.dumps({'choices': [{'delta': {'content': part}}]}, ensure_ascii=False)}\n\n"
+            for part in ['您好，', f'关于“{prompt}”：', '剩余积分在首页右上角显示，', '兑换记录在“我的兑换”中查看。']
+        ] + ['data: [DONE]\n\n']
+        body = [event.encode() for event in events]
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Content-Length', str(sum(len(part) for part in body)))
+        self.end_headers()
+        for part in body:
+            time.sleep(CHUNK_DELAY)
+            self.wfile.write(part)
+            self.wfile.flush()
+
+    def log_message(self, *args):
+        pass
+
+
+server = ThreadingHTTPServer(('127.0.0.1', 0), FakeCompletions)
+threading.Thread(target=server.serve_forever, daemon=True).start()
+os.environ['SHOP_AI_BACKEND'] = 'deepseek'
+os.environ['SHOP_AI_API_URL'] = f'http://127.0.0.1:{server.server_address[1]}/v1/chat/completions'
+os.environ['SHOP_AI_API_KEY'] = 'bench'
+use_temp_database()
+
+from app import app, db, User, assistant  # noqa: E402
+
+FAQ = ['怎么查看剩余积分？', '怎么查看剩余积分', '  怎么查看剩余积分?  ', '积分可以做什么', '积分可以做什么！',
+       '如何退货？', '兑换记录在哪里看']
+
+
+def ask(client, message):
+    """返回 (状态码, 首段延迟ms, 总耗时ms, 结束事件)"""
+    started = time.perf_counter()
+    response = client.post('/deepseek/chat', json={'message': message}, buffered=False)
+    first, last = None, {}
+    if response.status_code == 200:
+        for chunk in response.response:
+            for line in chunk.decode().split('\n\n'):
+                if not line.startswith('data: '):
+                    continue
+                event = json.loads(line[6:])
+                if first is None:
+                    first = (time.perf_counter() - started) * 1000
+                last = event
+    response.close()
+    return response.status_code, first, (time.perf_counter() - started) * 1000, last
+
+
+def run_concurrently(user_ids, messages):
+    results = [None] * len(user_ids)
+    barrier = threading.Barrier(len(user_ids))
+
+    def worker(index):
+        client = app.test_client()
+        with client.session_transaction() as sess:
+            sess['user_id'] = user_ids[index]
+        barrier.wait()
+        results[index] = ask(client, messages[index])
+
+    threads = [threading.Thread(target=worker, args=(index,)) for index in range(len(user_ids))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+def summarize(label, results):
+    firsts = sorted(first for _, first, _, _ in results if first is not None)
+    statuses = {}
+    for status, _, _, last in results:
+        key = 'error' if last.get('error') else ('cached' if last.get('cached') else status)
+        statuses[key] = statuses.get(key, 0) + 1
+    totals = sorted(total for _, _, total, _ in results)
+    first_p50 = f'{statistics.median(firsts):.1f}ms' if firsts else '-'
+    print(f'{label}: {statuses}，首段 p50 {first_p50}，总耗时 p50 {statistics.median(totals):.1f}ms, max {totals[-1]:.1f}ms，'
+          f'接口调用累计 {FakeCompletions.calls} 次，新建连接 {assistant.backend.stats()["connections_created"]} 个')
+    return statuses
+
+
+def main():
+    users = int(sys.argv[1]) if len(sys.argv) > 1 else 40
+    with app.app_context():
+        reset_database(db)
+        db.session.add_all([User(username=f'S{i:05d}', password='x') for i in range(users + 1)])
+        db.session.commit()
+        user_ids = [user.id for user in User.query.order_by(User.id)]
+    assistant.cache.clear()
+    messages = [FAQ[index % len(FAQ)] for index in range(users)]
+
+    # 1. 常见问题：规范化后只有4个不同的问题
+    summarize('首次提问', run_concurrently(user_ids[:users], messages))
+    first_round_calls = FakeCompletions.calls
+
+    # 2. 再问一遍：全部命中缓存
+    statuses = summarize('再次提问', run_concurrently(user_ids[:users], messages))
+    assert FakeCompletions.calls == first_round_calls, '重复的问题不应再调用接口'
+    assert statuses.get('cached') == users
+
+    # 3. 不同的问题同时提问：超过转发上限的请求立即返回
+    unique = [f'第{index}个不同的问题' for index in range(users)]
+    statuses = summarize('不同问题同时提问', run_concurrently(user_ids[:users], unique))
+    assert statuses.get(200, 0) <= app.config['AI_MAX_STREAMS']  # 超出上限的立即返回，不排队等待
+
+    # 4. 同一用户连续提问
+    client = app.test_client()
+    with client.session_transaction() as sess:
+        sess['user_id'] = user_ids[-1]
+    codes = [ask(client, f'连续提问{index}')[0] for index in range(app.config['AI_RATE_BURST'] + 2)]
+    print(f'同一用户连续提问 {len(codes)} 次：{codes}')
+    assert codes.count(429) == 2
+
+    connections = assistant.backend.stats()['connections_created']
+    assert connections <= app.config['AI_MAX_STREAMS'] + app.config['AI_POOL_SIZE'], '连接没有复用'
+    print(f'代理统计: {assistant.stats()}')
+    print('校验通过：重复问题命中缓存、连接复用、转发上限和限流生效')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,29 @@
+"""压测脚本公用工具：在导入app之前把数据库切换到临时文件"""
+import os
+import sys
+import tempfile
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def use_temp_database(prefix='shop_bench_'):
+    db_dir = tempfile.mkdtemp(prefix=prefix)
+    os.environ['SHOP_DATABASE_URI'] = 'sqlite:///' + os.path.join(db_dir, 'bench.db')
+    os.environ['SHOP_JOB_DIR'] = os.path.join(db_dir, 'jobs')
+    os.environ['SHOP_ARCHIVE_DIR'] = os.path.join(db_dir, 'archive')
+    if ROOT_DIR not in sys.path:
+        sys.path.insert(0, ROOT_DIR)
+    return db_dir
+
+
+def reset_database(db):
+    """清空并重建数据库，再执行全部迁移（迁移中创建的搜索索引和触发器与正式环境一致）"""
+    from migrations import run_migrations
+
+    db.session.remove()
+    db.drop_all()
+    with db.engine.begin() as connection:
+        connection.exec_driver_sql('DROP TABLE IF EXISTS user_search')
+        connection.exec_driver_sql('DROP TABLE IF EXISTS schema_migrations')
+    db.create_all()
+    run_migrations(db.engine, log=lambda message: None)
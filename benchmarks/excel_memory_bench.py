@@ -0,0 +1,77 @@
+"""Excel导入峰值内存（RSS）对比：完整模式加载 vs 只读流式读取
+
+用法：python benchmarks/excel_memory_bench.py [行数 ...]（默认 10000 100000）
+每种模式在独立子进程中运行，读取 ru_maxrss 作为峰值内存。
+"""
+import io
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+
+from openpyxl import Workbook, load_workbook
+
+from bench_utils import ROOT_DIR
+
+sys.path.insert(0, ROOT_DIR)
+
+from excel_stream import iter_roster  # noqa: E402
+
+HEADERS = ['姓名', '学号', '学院', '爱心币数量', '剩余爱心币']
+
+
+def build_file(rows, directory):
+    path = os.path.join(directory, f'roster_{rows}.xlsx')
+    workbook = Workbook(write_only=True)
+    sheet = workbook.create_sheet()
+    sheet.append(HEADERS)
+    for i in range(rows):
+        sheet.append([f'学生{i}', f'2025{i:07d}', f'学院{i % 20}', 300, 300 - i % 50])
+    workbook.save(path)
+    return path
+
+
+def consume_full(path):
+    """旧实现：整个工作簿读入内存"""
+    with open(path, 'rb') as f:
+        sheet = load_workbook(io.BytesIO(f.read()), data_only=True).active
+    return sum(1 for _ in sheet.iter_rows(min_row=2, values_only=True))
+
+
+def consume_stream(path):
+    """新实现：只读模式逐行读取"""
+    roster = iter_roster(path, HEADERS)
+    next(roster)
+    return sum(1 for _ in roster)
+
+
+def peak_rss_mb():
+    # Linux 下 ru_maxrss 单位为KB，macOS 下为字节
+    usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return usage / 1024 / (1024 if sys.platform == 'darwin' else 1)
+
+
+def measure(mode, path):
+    result = subprocess.run(
+        [sys.executable, __file__, '--measure', mode, path],
+        capture_output=True, text=True, check=True
+    )
+    return result.stdout.strip()
+
+
+if __name__ == '__main__':
+    if len(sys.argv) == 4 and sys.argv[1] == '--measure':
+        baseline = peak_rss_mb()
+        count = {'full': consume_full, 'stream': consume_stream}[sys.argv[2]](sys.argv[3])
+        print(f'{count} {baseline:.1f} {peak_rss_mb():.1f}')
+        sys.exit(0)
+
+    sizes = [int(arg) for arg in sys.argv[1:]] or [10000, 100000]
+    with tempfile.TemporaryDirectory() as directory:
+        for rows in sizes:
+            path = build_file(rows, directory)
+            size_mb = os.path.getsize(path) / 1024 / 1024
+            for mode, label in (('full', '完整加载（旧）'), ('stream', '只读流式（新）')):
+                count, baseline, peak = measure(mode, path).split()
+                print(f'{rows:>7} 行 ({size_mb:.1f}MB) {label}: 峰值RSS {peak}MB（启动时 {baseline}MB），读取 {count} 行')
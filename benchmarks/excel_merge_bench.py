@@ -0,0 +1,99 @@
+"""整理表格基准：逐行 delete_rows 的旧实现 vs 单次遍历的新实现
+
+用法：python benchmarks/excel_merge_bench.py [行数 ...]（默认 1000 2000 4000）
+生成的表格包含多个sheet、空白行和"高等职业技术学院"的行，
+先校验两种实现输出一致，再打印耗时和每千行耗时（线性扩展时应基本不变）。
+"""
+import os
+import sys
+import tempfile
+import time
+
+import openpyxl
+from openpyxl import Workbook
+
+from bench_utils import ROOT_DIR
+
+sys.path.insert(0, ROOT_DIR)
+
+from excel_merge import merge_excel  # noqa: E402
+
+
+def build_file(rows, directory, sheets=4):
+    path = os.path.join(directory, f'merge_{rows}.xlsx')
+    workbook = Workbook(write_only=True)
+    per_sheet = rows // sheets
+    for s in range(sheets):
+        sheet = workbook.create_sheet(f'Sheet{s + 1}')
+        sheet.append([f'2025-2026爱心币数量名单（{s + 1}）'])
+        if s == 0:
+            sheet.append(['姓名', '学号', '学院', '爱心币', '剩余'])
+        for i in range(per_sheet):
+            if i % 10 == 3:
+                sheet.append([None, None, None, None, None])
+            elif i % 20 == 7:
+                sheet.append([f'学生{s}-{i}', f'{s}{i:06d}', '高等职业技术学院', 200, None])
+            else:
+                sheet.append([f'学生{s}-{i}', f'{s}{i:06d}', f'学院{i % 9}', 300, 280 if i % 2 else None])
+    workbook.save(path)
+    return path
+
+
+def legacy_merge(excel_path, merged_file_path):
+    """旧实现：追加全部行后自下而上 delete_rows，O(行数²)"""
+    workbook = openpyxl.load_workbook(excel_path)
+    merged_workbook = Workbook()
+    merged_sheet = merged_workbook.active
+    merged_sheet.title = '合并数据'
+    sheet_names = workbook.sheetnames
+    for sheet_name in sheet_names:
+        rows = list(workbook[sheet_name].iter_rows(values_only=True))
+        for row in (rows if sheet_name == sheet_names[0] else rows[1:]):
+            merged_sheet.append(row)
+    merged_sheet.delete_rows(1)
+    correct_headers = ["姓名", "学号", "学院", "爱心币数量", "剩余爱心币"]
+    if any(cell.value != header for cell, header in zip(merged_sheet[1], correct_headers)):
+        for i, header in enumerate(correct_headers, 1):
+            merged_sheet.cell(row=1, column=i).value = header
+    for row in range(3, merged_sheet.max_row + 1):
+        e_value = merged_sheet[f'E{row}'].value
+        merged_sheet[f'D{row}'] = e_value if e_value is not None else merged_sheet[f'D{row}'].value
+    for row in range(merged_sheet.max_row, 2, -1):
+        if all(merged_sheet.cell(row=row, column=col).value in (None, '')
+               for col in range(1, merged_sheet.max_column + 1)):
+            merged_sheet.delete_rows(row)
+    delete_count = 0
+    for row in range(merged_sheet.max_row, 2, -1):
+        for col in range(1, merged_sheet.max_column + 1):
+            value = merged_sheet.cell(row=row, column=col).value
+            if value is not None and "高等职业技术学院" in str(value):
+                merged_sheet.delete_rows(row)
+                delete_count += 1
+                break
+    merged_workbook.save(merged_file_path)
+    return {'total_rows': merged_sheet.max_row, 'deleted_rows': delete_count}
+
+
+def read_values(path):
+    return [tuple(row) for row in openpyxl.load_workbook(path).active.iter_rows(values_only=True)]
+
+
+def timed(func, *args):
+    started = time.perf_counter()
+    result = func(*args)
+    return time.perf_counter() - started, result
+
+
+if __name__ == '__main__':
+    sizes = [int(arg) for arg in sys.argv[1:]] or [1000, 2000, 4000]
+    with tempfile.TemporaryDirectory() as directory:
+        for rows in sizes:
+            path = build_file(rows, directory)
+            legacy_out = os.path.join(directory, 'legacy.xlsx')
+            new_out = os.path.join(directory, 'new.xlsx')
+            legacy_time, legacy_stats = timed(legacy_merge, path, legacy_out)
+            new_time, new_stats = timed(merge_excel, path, new_out)
+            assert read_values(legacy_out) == read_values(new_out), '新旧实现输出不一致'
+            assert legacy_stats['deleted_rows'] == new_stats['deleted_rows']
+            print(f'{rows:>7} 行: 旧 {legacy_time:.2f}s（{legacy_time / rows * 1000:.3f}s/千行）  '
+                  f'新 {new_time:.2f}s（{new_time / rows * 1000:.3f}s/千行）  输出一致')
@@ -0,0 +1,67 @@
+"""执行计划检查：确认限购计数、兑换记录和按时间区间的统计报表查询走索引而不是全表扫描
+
+用法：python benchmarks/explain_check.py
+在临时数据库上执行全部迁移并写入一些数据，检查 EXPLAIN QUERY PLAN 的结果，
+任一查询出现全表扫描或额外排序时以非零状态退出。
+"""
+import sys
+from datetime import datetime
+
+from bench_utils import use_temp_database, reset_database
+
+use_temp_database()
+
+from app import (app, db, User, Product, PurchaseRecord, purchase_counter_query, purchase_history_query,  # noqa: E402
+                 verify_purchase_counters)
+from migrations import run_migrations, current_version, explain_query_plan  # noqa: E402
+from reports import ReportRange, college_monthly_statement, purchase_details_statement  # noqa: E402
+
+
+def seed():
+    reset_database(db)
+    run_migrations(db.engine, log=lambda message: None)
+    db.session.add_all([Product(name=f'商品{i}', picture='x.png', price=1, stock=100, limit=5) for i in range(20)])
+    db.session.add_all([User(username=f'S{i}', password='x') for i in range(200)])
+    db.session.flush()
+    db.session.bulk_insert_mappings(PurchaseRecord, [
+        {'user_id': i % 200 + 1, 'product_id': i % 20 + 1, 'quantity': 1, 'purchase_time': datetime(2025, i % 12 + 1, 1)}
+        for i in range(5000)
+    ])
+    db.session.commit()
+    verify_purchase_counters(fix=True)
+    db.session.execute(db.text('ANALYZE'))
+
+
+def check(label, statement, index_name, forbid_sort=False):
+    with db.engine.connect() as connection:
+        plan = explain_query_plan(connection, statement)
+    problems = [step for step in plan if step.startswith(('SCAN purchase_record', 'SCAN purchase_counter'))]
+    if index_name not in ' '.join(plan):
+        problems.append(f'未使用索引 {index_name}')
+    if forbid_sort:
+        problems += [step for step in plan if 'TEMP B-TREE' in step]
+    print(f'{label}:')
+    for step in plan:
+        print(f'    {step}')
+    print(f'    -> {"失败：" + "；".join(problems) if problems else "通过"}')
+    return not problems
+
+
+if __name__ == '__main__':
+    with app.app_context():
+        seed()
+        print(f'当前数据库版本：{current_version(db.engine)}')
+        ok = check('本月限购计数（兑换时的限购检查）',
+                   purchase_counter_query(1, 1, '2025-06').statement,
+                   'sqlite_autoindex_purchase_counter_1')
+        ok &= check('兑换记录查询',
+                    purchase_history_query(1).statement,
+                    'ix_purchase_record_user_time', forbid_sort=True)
+        one_month = ReportRange.parse('2025-06-01', '2025-06-30')
+        ok &= check('学院月度统计（按时间区间）',
+                    college_monthly_statement(one_month),
+                    'ix_purchase_record_time')
+        ok &= check('兑换明细导出（按时间区间）',
+                    purchase_details_statement(one_month),
+                    'ix_purchase_record_time', forbid_sort=True)
+    sys.exit(0 if ok else 1)
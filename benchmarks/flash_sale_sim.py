@@ -0,0 +1,123 @@
+"""抢购模拟：数千名学生同时抢购同一件少量库存的商品，对比普通购买与抢购模式
+
+用法：python benchmarks/flash_sale_sim.py [并发人数] [库存]
+每种模式各运行一次：所有请求线程在同一时刻发出购买请求，统计耗时、延迟、
+请求线程执行的SQL语句数，并校验不超卖、先到先得、积分流水与余额一致。
+"""
+import statistics
+import sys
+import threading
+import time
+
+from bench_utils import use_temp_database, reset_database
+
+use_temp_database()
+
+from sqlalchemy import event  # noqa: E402
+
+from app import (app, db, User, Product, PurchaseRecord, PointsLedger, LEDGER_OPENING,  # noqa: E402
+                 flash_sale, identity_cache, verify_points_ledger, verify_purchase_counters)
+
+PRICE, POINTS = 10, 100
+
+
+def seed(buyers, stock, flash):
+    with app.app_context():
+        reset_database(db)
+        product = Product(name='抢购商品', picture='bench.png', price=PRICE, stock=stock, limit=1, flash_sale=flash)
+        db.session.add(product)
+        users = [User(username=f'S{i:06d}', password='x', points=POINTS, remaining_points=POINTS) for i in range(buyers)]
+        db.session.add_all(users)
+        db.session.flush()
+        db.session.add_all([
+            PointsLedger(user_id=user.id, kind=LEDGER_OPENING, delta=POINTS, balance_after=POINTS) for user in users
+        ])
+        db.session.commit()
+        # 已登录用户的身份在正常使用中已经缓存，这里预先加载，只统计购买本身的数据库访问
+        identity_cache.clear()
+        user_ids = [user.id for user in users]
+        for user_id in user_ids:
+            identity_cache.get(user_id)
+        flash_sale.invalidate()
+        return product.id, user_ids
+
+
+def run(mode, buyers, stock):
+    product_id, user_ids = seed(buyers, stock, flash=(mode == 'flash'))
+    barrier = threading.Barrier(buyers + 1)
+    latencies = {}
+    statuses = {}
+    spans = []
+    lock = threading.Lock()
+    request_threads = set()
+    statements = {'request': 0, 'other': 0}
+
+    def count_statement(*args):
+        key = 'request' if threading.get_ident() in request_threads else 'other'
+        with lock:
+            statements[key] += 1
+
+    def buyer(user_id):
+        client = app.test_client()
+        with client.session_transaction() as sess:
+            sess['user_id'] = user_id
+        with lock:
+            request_threads.add(threading.get_ident())
+        barrier.wait()
+        started = time.perf_counter()
+        response = client.post(f'/purchase/{product_id}', data={'quantity': 1})
+        finished = time.perf_counter()
+        elapsed = finished - started
+        with lock:
+            spans.append((started, finished))
+            statuses[response.status_code] = statuses.get(response.status_code, 0) + 1
+            latencies.setdefault(response.status_code, []).append(elapsed * 1000)
+
+    with app.app_context():
+        engine = db.engine
+    threads = [threading.Thread(target=buyer, args=(user_id,)) for user_id in user_ids]
+    for thread in threads:
+        thread.start()
+    event.listen(engine, 'before_cursor_execute', count_statement)
+    barrier.wait()
+    for thread in threads:
+        thread.join()
+    # 从第一个请求发出到最后一个请求返回（线程很多时主线程可能很晚才被调度，不用主线程计时）
+    elapsed = max(end for _, end in spans) - min(start for start, _ in spans)
+    event.remove(engine, 'before_cursor_execute', count_statement)
+
+    with app.app_context():
+        product = db.session.get(Product, product_id)
+        sold = db.session.query(db.func.sum(PurchaseRecord.quantity)).scalar() or 0
+        spent = db.session.query(db.func.sum(POINTS - User.points)).scalar() or 0
+        over_limit = db.session.query(PurchaseRecord.user_id).group_by(PurchaseRecord.user_id) \
+            .having(db.func.sum(PurchaseRecord.quantity) > 1).count()
+        ledger_drift = verify_points_ledger()
+        counter_drift = verify_purchase_counters()
+
+    print(f'[{"抢购模式" if mode == "flash" else "普通购买"}] 并发 {buyers} 人，库存 {stock}')
+    print(f'  状态码: {statuses}，总耗时 {elapsed:.2f}s')
+    for status, values in sorted(latencies.items()):
+        values.sort()
+        print(f'  {status}: p50 {statistics.median(values):.1f}ms, p95 {values[int(len(values) * 0.95) - 1]:.1f}ms, '
+              f'max {values[-1]:.1f}ms')
+    print(f'  SQL语句：请求线程 {statements["request"]} 条，后台写入线程 {statements["other"]} 条')
+    if mode == 'flash':
+        print(f'  抢购统计: {flash_sale.stats()}')
+
+    assert product.stock == stock - sold and product.stock >= 0, '超卖'
+    assert sold == min(stock, buyers), f'应售出 {min(stock, buyers)} 件，实际 {sold} 件'
+    assert statuses.get(200, 0) == sold, '成功响应数与售出数不一致'
+    assert spent == sold * PRICE, '积分扣减与购买记录不一致'
+    assert over_limit == 0, '存在超过限购数量的用户'
+    assert not ledger_drift and not counter_drift, '积分流水或限购计数不一致'
+    print('  校验通过：无超卖、每人最多一件、积分流水与余额一致')
+    return elapsed
+
+
+if __name__ == '__main__':
+    buyers = int(sys.argv[1]) if len(sys.argv) > 1 else 3000
+    stock = int(sys.argv[2]) if len(sys.argv) > 2 else 100
+    normal = run('normal', buyers, stock)
+    flash = run('flash', buyers, stock)
+    print(f'总耗时：普通购买 {normal:.2f}s，抢购模式 {flash:.2f}s')
@@ -0,0 +1,88 @@
+"""Excel导入基准：对比逐行查询的旧实现与批量upsert的新实现
+
+用法：python benchmarks/import_bench.py [行数]
+生成的表格一半是已存在的学生（走更新），一半是新学生（走插入）。
+"""
+import io
+import sys
+import time
+
+from openpyxl import Workbook, load_workbook
+
+from bench_utils import use_temp_database, reset_database
+
+use_temp_database()
+
+from app import app, db, User, IMPORT_REQUIRED_HEADERS, import_user_rows  # noqa: E402
+from auth import hash_password  # noqa: E402
+
+
+def build_workbook(rows):
+    workbook = Workbook(write_only=True)
+    sheet = workbook.create_sheet()
+    sheet.append(IMPORT_REQUIRED_HEADERS)
+    for i in range(rows):
+        sheet.append([f'学生{i}', f'2025{i:06d}', f'学院{i % 20}', 300, 300 - i % 50])
+    stream = io.BytesIO()
+    workbook.save(stream)
+    return stream.getvalue()
+
+
+def seed_existing(rows):
+    reset_database(db)
+    db.session.bulk_insert_mappings(User, [
+        {'username': f'2025{i:06d}', 'password': 'x', 'is_admin': False, 'points': 0, 'remaining_points': 0}
+        for i in range(0, rows, 2)
+    ])
+    db.session.commit()
+
+
+def legacy_import(headers, rows):
+    """旧实现：每行一次 filter_by(username=...) 查询
+
+    新学生的初始密码与新实现一样按 PASSWORD_BULK_HASH_METHOD 哈希，两者做的是同样的工作。
+    """
+    method = app.config['PASSWORD_BULK_HASH_METHOD']
+    success_count = 0
+    for _, row in rows:
+        row_data = dict(zip(headers, row))
+        student_id = row_data['学号'] or ''
+        if not student_id:
+            continue
+        existing_user = User.query.filter_by(username=str(student_id)).first()
+        if existing_user:
+            existing_user.name = row_data['姓名'] or ''
+            existing_user.college = row_data['学院'] or ''
+            existing_user.points = int(row_data['爱心币数量'] or 0)
+            existing_user.remaining_points = int(row_data['剩余爱心币'] or 0)
+        else:
+            db.session.add(User(
+                username=str(student_id), password=hash_password(str(student_id), method), is_admin=False,
+                name=row_data['姓名'] or '', college=row_data['学院'] or '',
+                points=int(row_data['爱心币数量'] or 0),
+                remaining_points=int(row_data['剩余爱心币'] or 0), gender='male'
+            ))
+        success_count += 1
+    return {'success': success_count}
+
+
+def timed_import(label, importer, content, rows):
+    seed_existing(rows)
+    sheet = load_workbook(io.BytesIO(content), data_only=True).active
+    headers = [cell.value for cell in sheet[1]]
+    started = time.perf_counter()
+    result = importer(headers, enumerate(sheet.iter_rows(min_row=2, values_only=True), start=2))
+    db.session.commit()
+    elapsed = time.perf_counter() - started
+    total = User.query.count()
+    print(f'{label}: {elapsed:.2f}s ({rows / elapsed:.0f} 行/秒)，成功 {result["success"]} 行，用户总数 {total}')
+    return elapsed
+
+
+if __name__ == '__main__':
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+    content = build_workbook(rows)
+    with app.app_context():
+        legacy = timed_import('逐行查询（旧）', legacy_import, content, rows)
+        bulk = timed_import('批量upsert（新）', import_user_rows, content, rows)
+    print(f'加速比：{legacy / bulk:.1f}x')
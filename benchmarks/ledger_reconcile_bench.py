@@ -0,0 +1,55 @@
+"""积分对账耗时：生成大量用户和积分流水，测量 verify_points_ledger 的耗时
+
+用法：python benchmarks/ledger_reconcile_bench.py [用户数] [每人流水条数]
+"""
+import random
+import sys
+import time
+
+from bench_utils import use_temp_database, reset_database
+
+use_temp_database()
+
+from app import app, db, User, PointsLedger, LEDGER_OPENING, LEDGER_PURCHASE, verify_points_ledger  # noqa: E402
+
+
+def seed(users, entries_per_user):
+    reset_database(db)
+    rng = random.Random(42)
+    balances = {}
+    ledger = []
+    for user_id in range(1, users + 1):
+        balance = rng.randint(100, 1000)
+        ledger.append({'user_id': user_id, 'kind': LEDGER_OPENING, 'delta': balance, 'balance_after': balance})
+        for _ in range(entries_per_user - 1):
+            cost = rng.randint(1, 10)
+            balance -= cost
+            ledger.append({'user_id': user_id, 'kind': LEDGER_PURCHASE, 'delta': -cost, 'balance_after': balance})
+        balances[user_id] = balance
+    db.session.bulk_insert_mappings(User, [
+        {'id': user_id, 'username': f'U{user_id:07d}', 'password': 'x', 'points': balance, 'remaining_points': balance}
+        for user_id, balance in balances.items()
+    ])
+    for offset in range(0, len(ledger), 50000):
+        db.session.bulk_insert_mappings(PointsLedger, ledger[offset:offset + 50000])
+    # 人为制造几个不一致的余额
+    db.session.execute(db.update(User).where(User.id.in_([1, users // 2, users])).values(points=User.points + 1))
+    db.session.commit()
+
+
+def main():
+    users = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+    entries_per_user = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+    with app.app_context():
+        started = time.perf_counter()
+        seed(users, entries_per_user)
+        print(f'生成 {users} 个用户、{users * entries_per_user} 条流水：{time.perf_counter() - started:.1f}s')
+
+        started = time.perf_counter()
+        drift = verify_points_ledger()
+        print(f'对账耗时：{time.perf_counter() - started:.2f}s，不一致 {len(drift)} 个')
+        assert len(drift) == 3, drift
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,194 @@
+"""实时事件压测：对比“表单购买 + 重新加载商店页”与 JSON 购买接口，并校验打开的页面收到库存和积分变化
+
+用法：python benchmarks/live_events_bench.py [在线页面数] [购买次数]
+1. 同样的购买次数，分别统计两种方式每次购买执行的SQL语句数和耗时；
+2. 在线页面数超过每个进程的 SSE 连接上限，超出的页面按轮询方式重连，购买结束后每个页面看到的库存、
+   积分都应与数据库一致；
+3. 模拟其他进程直接修改数据库（补货、管理员调整积分），由本进程的后台线程读取后推送。
+"""
+import json
+import sqlite3
+import statistics
+import sys
+import threading
+import time
+
+from bench_utils import use_temp_database, reset_database
+
+use_temp_database()
+
+from sqlalchemy import event  # noqa: E402
+
+from app import (app, db, User, Product, PointsLedger, LEDGER_OPENING, LEDGER_ADJUST,  # noqa: E402
+                 event_hub, identity_cache, verify_points_ledger)
+
+PRICE, POINTS, STOCK = 10, 100000, 100000
+
+
+def seed(pages):
+    with app.app_context():
+        reset_database(db)
+        products = [Product(name=f'商品{i}', picture='bench.png', price=PRICE, stock=STOCK, limit=STOCK)
+                    for i in range(3)]
+        users = [User(username=f'S{i:05d}', password='x', points=POINTS, remaining_points=POINTS)
+                 for i in range(pages)]
+        db.session.add_all(products + users)
+        db.session.flush()
+        db.session.add_all([
+            PointsLedger(user_id=user.id, kind=LEDGER_OPENING, delta=POINTS, balance_after=POINTS) for user in users
+        ])
+        db.session.commit()
+        identity_cache.clear()
+        return [product.id for product in products], [user.id for user in users]
+
+
+def login(user_id):
+    client = app.test_client()
+    with client.session_transaction() as sess:
+        sess['user_id'] = user_id
+    return client
+
+
+class Page:
+    """一个打开的商店页：像浏览器的 EventSource 一样读取事件，连接结束后带 Last-Event-ID 重连"""
+
+    def __init__(self, user_id, cursor):
+        self.user_id = user_id
+        self.client = login(user_id)
+        self.last_event_id = cursor
+        self.stock = {}
+        self.points = None
+        self.events = 0
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def run(self):
+        while not self.stopped.is_set():
+            response = self.client.get('/events', headers={'Last-Event-ID': self.last_event_id}, buffered=False)
+            retry = 1000
+            for chunk in response.response:
+                for message in chunk.decode().split('\n\n'):
+                    fields = dict(line.split(': ', 1) for line in message.split('\n') if ': ' in line)
+                    if 'retry' in fields:
+                        retry = int(fields['retry'])
+                    if 'data' in fields:
+                        self.handle(fields['event'], json.loads(fields['data']))
+                        self.last_event_id = fields['id']
+                if self.stopped.is_set():
+                    break
+            response.close()
+            self.stopped.wait(min(retry, 200) / 1000)  # 压测中缩短重连间隔
+
+    def handle(self, kind, data):
+        self.events += 1
+        if kind == 'snapshot':
+            self.stock.update({int(product_id): stock for product_id, stock in data['stock'].items()})
+            self.points = data.get('points', self.points)
+        elif kind == 'stock':
+            self.stock[data['product_id']] = data['stock']
+        elif kind == 'balance' and data['user_id'] == self.user_id:
+            self.points = data['points']
+
+
+def count_statements(engine, thread_id):
+    counter = {'count': 0}
+
+    def count(*args):
+        if threading.get_ident() == thread_id:
+            counter['count'] += 1
+
+    event.listen(engine, 'before_cursor_execute', count)
+    return counter, lambda: event.remove(engine, 'before_cursor_execute', count)
+
+
+def measure(label, purchases, buy):
+    with app.app_context():
+        engine = db.engine
+    counter, stop = count_statements(engine, threading.get_ident())
+    latencies = []
+    for index in range(purchases):
+        started = time.perf_counter()
+        buy(index)
+        latencies.append((time.perf_counter() - started) * 1000)
+    stop()
+    print(f'{label}：每次购买 SQL {counter["count"] / purchases:.1f} 条，'
+          f'p50 {statistics.median(latencies):.1f}ms，合计 {sum(latencies) / 1000:.2f}s')
+    return counter['count'] / purchases
+
+
+def wait_until(check, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if check():
+            return True
+        time.sleep(0.05)
+    return check()
+
+
+def main():
+    pages = int(sys.argv[1]) if len(sys.argv) > 1 else 12
+    purchases = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+    product_ids, user_ids = seed(pages)
+    event_hub.stream_seconds = 2  # 压测中缩短连接时长，覆盖到期重连
+    event_hub.heartbeat_seconds = 1
+    buyers = [login(user_id) for user_id in user_ids]
+
+    def legacy(index):
+        client = buyers[index % pages]
+        client.post(f'/purchase/{product_ids[index % 3]}', data={'quantity': 1})
+        client.get('/')  # 购买成功页返回后重新加载商店页
+
+    def api(index):
+        response = buyers[index % pages].post(f'/api/purchase/{product_ids[index % 3]}', json={'quantity': 1})
+        assert response.get_json()['success'], response.get_json()
+
+    legacy_sql = measure('表单购买 + 重新加载', purchases, legacy)
+
+    cursor = buyers[0].get('/').get_data(as_text=True).split('data-events-cursor="')[1].split('"')[0]
+    open_pages = [Page(user_id, cursor) for user_id in user_ids]
+    for page in open_pages:
+        page.thread.start()
+    api_sql = measure('JSON 购买接口', purchases, api)
+    assert api_sql < legacy_sql
+
+    with app.app_context():
+        stock = dict(db.session.query(Product.id, Product.stock))
+        points = dict(db.session.query(User.id, User.points))
+    synced = wait_until(lambda: all(page.stock == stock and page.points == points[page.user_id]
+                                    for page in open_pages))
+    print(f'{pages} 个页面共收到 {sum(page.events for page in open_pages)} 个事件，事件统计 {event_hub.stats()}')
+    assert synced, '页面上的库存或积分与数据库不一致'
+
+    # 其他进程的修改：直接写数据库，不经过本进程的会话
+    with app.app_context():
+        path = db.engine.url.database
+    connection = sqlite3.connect(path)
+    with connection:
+        connection.execute('UPDATE product SET stock = stock + 50 WHERE id = ?', (product_ids[0],))
+        connection.execute("UPDATE cache_version SET version = version + 1 WHERE name = 'stock'")
+        connection.execute('UPDATE user SET points = points + 7, remaining_points = points + 7 WHERE id = ?',
+                           (user_ids[0],))
+        connection.execute(
+            'INSERT INTO points_ledger (user_id, kind, delta, balance_after, created_at) '
+            'SELECT id, ?, 7, points, CURRENT_TIMESTAMP FROM user WHERE id = ?', (LEDGER_ADJUST, user_ids[0]))
+    connection.close()
+    stock[product_ids[0]] += 50
+    points[user_ids[0]] += 7
+    synced = wait_until(lambda: all(page.stock == stock and page.points == points[page.user_id]
+                                    for page in open_pages))
+    assert synced, '没有收到其他进程的修改'
+
+    for page in open_pages:
+        page.stopped.set()
+    for page in open_pages:
+        page.thread.join()
+    with app.app_context():
+        assert not verify_points_ledger(), '积分流水与余额不一致'
+    stats = event_hub.stats()
+    assert stats['polled'] > 0 or pages <= app.config['EVENTS_MAX_STREAMS']
+    print(f'校验通过：JSON 接口每次购买少执行 {legacy_sql - api_sql:.1f} 条SQL，'
+          f'所有页面（其中部分为轮询）的库存和积分与数据库一致，其他进程的修改也已推送')
+
+
+if __name__ == '__main__':
+    main()
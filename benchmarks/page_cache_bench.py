@@ -0,0 +1,158 @@
+"""页面片段缓存与 ETag 压测：商品页、管理员页面、用户列表和帮助页
+
+用法：python benchmarks/page_cache_bench.py [学生数] [每人兑换记录数]
+每个页面分别统计：第一次渲染（片段未缓存）、其他学生购买后重新渲染（商品卡片和兑换记录片段命中）、
+浏览器带 If-None-Match 重新请求（304）的耗时和SQL语句数；
+并校验购买、修改商品名称、调整积分后页面内容随之更新。
+"""
+import statistics
+import sys
+import threading
+import time
+from datetime import datetime, timedelta
+
+from bench_utils import use_temp_database, reset_database
+
+use_temp_database()
+
+from sqlalchemy import event  # noqa: E402
+
+from app import (app, db, User, Product, PurchaseRecord, PointsLedger, LEDGER_OPENING,  # noqa: E402
+                 fragment_cache, identity_cache)
+
+PRODUCTS = 40
+
+
+def seed(students, history):
+    with app.app_context():
+        reset_database(db)
+        products = [Product(name=f'商品{i}', picture='bench.png', price=1, stock=100000, limit=100000)
+                    for i in range(PRODUCTS)]
+        users = [User(username=f'S{i:05d}', password='x', name=f'学生{i}', college=f'学院{i % 10}',
+                      points=100000, remaining_points=100000) for i in range(students)]
+        admin = User(username='bench-admin', password='x', is_admin=True)
+        db.session.add_all(products + users + [admin])
+        db.session.flush()
+        db.session.add_all([
+            PointsLedger(user_id=user.id, kind=LEDGER_OPENING, delta=100000, balance_after=100000) for user in users
+        ])
+        start = datetime(2025, 9, 1)
+        db.session.bulk_insert_mappings(PurchaseRecord, [
+            {'user_id': user.id, 'product_id': products[(user.id + i) % PRODUCTS].id, 'quantity': 1,
+             'purchase_time': start + timedelta(hours=user.id + i * 7), 'unit_price': 1, 'total_cost': 1}
+            for user in users for i in range(history)
+        ])
+        db.session.commit()
+        identity_cache.clear()
+        return [product.id for product in products], [user.id for user in users], admin.id
+
+
+def login(user_id):
+    client = app.test_client()
+    with client.session_transaction() as sess:
+        sess['user_id'] = user_id
+    return client
+
+
+class Statements:
+    def __init__(self, engine):
+        self.engine = engine
+        self.thread_id = threading.get_ident()
+        self.count = 0
+
+    def __enter__(self):
+        event.listen(self.engine, 'before_cursor_execute', self._count)
+        return self
+
+    def __exit__(self, *exc):
+        event.remove(self.engine, 'before_cursor_execute', self._count)
+
+    def _count(self, *args):
+        if threading.get_ident() == self.thread_id:
+            self.count += 1
+
+
+def timed(engine, request, before=None, repeat=20):
+    """每次先调用 before()（不计入），再用 request() 发出请求；返回 (p50 毫秒, 每次SQL条数, 最后一个响应)"""
+    latencies = []
+    statements = 0
+    for _ in range(repeat):
+        if before:
+            before()
+        with Statements(engine) as counter:
+            started = time.perf_counter()
+            response = request()
+            latencies.append((time.perf_counter() - started) * 1000)
+        statements += counter.count
+    return statistics.median(latencies), statements / repeat, response
+
+
+def report(label, result):
+    p50, sql, response = result
+    print(f'  {label:<22} 状态 {response.status_code}，p50 {p50:.2f}ms，SQL {sql:.1f} 条')
+
+
+def main():
+    students = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    history = int(sys.argv[2]) if len(sys.argv) > 2 else 40
+    product_ids, user_ids, admin_id = seed(students, history)
+    with app.app_context():
+        engine = db.engine
+    student, other, admin = login(user_ids[0]), login(user_ids[1]), login(admin_id)
+
+    def buy_elsewhere():
+        # 其他学生购买：库存版本变化，本页面需要重新渲染，但本人的兑换记录和其他商品的卡片不变
+        assert other.post(f'/api/purchase/{product_ids[-1]}', json={'quantity': 1}).get_json()['success']
+
+    print(f'商品页（{PRODUCTS} 件商品，{history} 条兑换记录）')
+    fragment_cache.clear()
+    report('片段未缓存', timed(engine, lambda: student.get('/'), before=fragment_cache.clear))
+    report('其他学生购买后', timed(engine, lambda: student.get('/'), before=buy_elsewhere))
+    etag = student.get('/').headers['ETag']
+    report('If-None-Match', timed(engine, lambda: student.get('/', headers={'If-None-Match': etag})))
+
+    # 本人购买后：ETag 变化，兑换记录包含新的一条
+    assert student.post(f'/api/purchase/{product_ids[0]}', json={'quantity': 3}).get_json()['success']
+    response = student.get('/', headers={'If-None-Match': etag})
+    assert response.status_code == 200 and response.headers['ETag'] != etag
+    assert response.get_data(as_text=True).count('<td>3</td>') == 2, '兑换记录没有更新'  # 数量和总花费
+
+    print('管理员页面')
+    report('片段未缓存', timed(engine, lambda: admin.get('/admin'), before=fragment_cache.clear))
+    report('其他学生购买后', timed(engine, lambda: admin.get('/admin'), before=buy_elsewhere))
+    etag = admin.get('/admin').headers['ETag']
+    report('If-None-Match', timed(engine, lambda: admin.get('/admin', headers={'If-None-Match': etag})))
+
+    print('管理员用户列表（每页60人）')
+    report('用户卡片未缓存', timed(engine, lambda: admin.get('/admin/users?limit=60'),
+                                  before=fragment_cache.clear))
+    report('用户卡片已缓存', timed(engine, lambda: admin.get('/admin/users?limit=60')))
+
+    print('帮助页')
+    etag = student.get('/help').headers['ETag']
+    report('If-None-Match', timed(engine, lambda: student.get('/help', headers={'If-None-Match': etag})))
+
+    # 修改商品名称：商品卡片、兑换记录和用户卡片中的名称都更新
+    response = admin.post(f'/update_product/{product_ids[0]}', data={
+        'name': '改名后的商品', 'price': 1, 'stock': 100000, 'limit': 100000})
+    assert response.status_code == 204
+    page = student.get('/').get_data(as_text=True)
+    assert '改名后的商品' in page and '商品0<' not in page, '商品名称没有更新'
+    users = admin.get('/admin/users?limit=60').get_json()['users']
+    assert any(record['product_name'] == '改名后的商品' for record in users[1]['purchases'])
+
+    # 调整积分：用户卡片更新
+    response = admin.post('/admin/batch', json={'operations': [
+        {'op': 'adjust_points', 'user_id': user_ids[0], 'delta': 5}]})
+    assert response.get_json()['applied'] == 1
+    with app.app_context():
+        points = db.session.get(User, user_ids[0]).points
+    users = admin.get('/admin/users?limit=60').get_json()['users']
+    assert next(user for user in users if user['id'] == user_ids[0])['points'] == points, '用户卡片没有更新'
+    assert f'<span id="currentPoints">{points}</span>' in student.get('/').get_data(as_text=True)
+    print(f'片段缓存统计: {fragment_cache.stats()}')
+    print('校验通过：未变化时返回304，购买、改名、调整积分后页面内容随之更新')
+
+
+if __name__ == '__main__':
+    main()
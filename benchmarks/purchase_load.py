@@ -0,0 +1,89 @@
+"""多线程购买压测：N个学生同时抢购同一件商品，验证不超卖、不重复扣分
+
+用法：python benchmarks/purchase_load.py [并发人数] [库存]
+"""
+import sys
+import threading
+import time
+
+from bench_utils import use_temp_database, reset_database
+
+# 使用临时数据库，必须在导入app之前设置
+use_temp_database()
+
+from app import app, db, User, Product, PurchaseRecord, PointsLedger, LEDGER_OPENING, verify_points_ledger  # noqa: E402
+
+
+def seed(buyers, stock, price=10, points=100):
+    with app.app_context():
+        reset_database(db)
+        product = Product(name='压测商品', picture='bench.png', price=price, stock=stock, limit=2)
+        db.session.add(product)
+        users = [
+            User(username=f'S{i:06d}', password='x', name=f'学生{i}', points=points, remaining_points=points)
+            for i in range(buyers)
+        ]
+        db.session.add_all(users)
+        db.session.flush()
+        db.session.add_all([
+            PointsLedger(user_id=user.id, kind=LEDGER_OPENING, delta=points, balance_after=points) for user in users
+        ])
+        db.session.commit()
+        return product.id
+
+
+def run(buyers=200, stock=50, quantity=1, rounds=3):
+    price, points = 10, 100
+    product_id = seed(buyers, stock, price, points)
+    barrier = threading.Barrier(buyers)
+    status_counts = {}
+    lock = threading.Lock()
+
+    def buyer(index):
+        client = app.test_client()
+        with client.session_transaction() as sess:
+            sess['username'] = f'S{index:06d}'
+            sess['is_admin'] = False
+        barrier.wait()
+        for _ in range(rounds):
+            response = client.post(f'/purchase/{product_id}', data={'quantity': quantity})
+            with lock:
+                status_counts[response.status_code] = status_counts.get(response.status_code, 0) + 1
+
+    threads = [threading.Thread(target=buyer, args=(i,)) for i in range(buyers)]
+    started = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - started
+
+    with app.app_context():
+        product = db.session.get(Product, product_id)
+        sold = db.session.query(db.func.sum(PurchaseRecord.quantity)).scalar() or 0
+        spent = db.session.query(db.func.sum(points - User.points)).scalar() or 0
+        negative = User.query.filter(User.points < 0).count()
+        over_limit = db.session.query(PurchaseRecord.user_id) \
+            .group_by(PurchaseRecord.user_id) \
+            .having(db.func.sum(PurchaseRecord.quantity) > product.limit).count()
+        ledger_drift = verify_points_ledger()
+
+    requests_sent = buyers * rounds
+    print(f'并发人数: {buyers}, 每人请求: {rounds}, 初始库存: {stock}')
+    print(f'状态码分布: {status_counts}')
+    print(f'耗时: {elapsed:.2f}s, 吞吐: {requests_sent / elapsed:.1f} req/s')
+    print(f'售出: {sold}, 剩余库存: {product.stock}, 扣除积分: {spent}')
+
+    assert product.stock >= 0, '库存为负'
+    assert sold + product.stock == stock, '库存与购买记录不一致（超卖）'
+    assert spent == sold * price, '积分扣减与购买记录不一致'
+    assert negative == 0, '存在积分为负的用户'
+    assert over_limit == 0, '存在超过限购数量的用户'
+    assert not ledger_drift, '积分余额与积分流水不一致'
+    print('校验通过：无超卖、无重复扣分，积分流水与余额一致')
+
+
+if __name__ == '__main__':
+    buyers = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    stock = int(sys.argv[2]) if len(sys.argv) > 2 else 50
+    run(buyers, stock)
@@ -0,0 +1,162 @@
+"""花名册差异同步：对比全量导入与只写入变化行的差异同步
+
+用法：python benchmarks/roster_sync_bench.py [学生数] [变化行数]
+先全量导入一份花名册，然后修改其中一部分行（修改积分、新增学生、删除学生）重新上传：
+分别统计全量导入和差异同步写入 user 表的行数、耗时，并通过管理员接口走一遍“预览 -> 确认同步”。
+"""
+import io
+import re
+import sys
+import time
+
+from openpyxl import Workbook
+from sqlalchemy import event
+
+from bench_utils import use_temp_database, reset_database
+
+use_temp_database()
+
+from app import (app, db, User, IMPORT_REQUIRED_HEADERS, import_user_rows, diff_roster, apply_roster_diff,  # noqa: E402
+                 job_queue, verify_points_ledger)
+from excel_stream import iter_roster  # noqa: E402
+
+
+def build_rows(students):
+    return {f'2025{i:06d}': [f'学生{i}', f'2025{i:06d}', f'学院{i % 20}', 300, 300 - i % 50] for i in range(students)}
+
+
+def write_workbook(rows, path=None):
+    workbook = Workbook(write_only=True)
+    sheet = workbook.create_sheet()
+    sheet.append(IMPORT_REQUIRED_HEADERS)
+    for row in rows.values():
+        sheet.append(row)
+    stream = path or io.BytesIO()
+    workbook.save(stream)
+    return stream
+
+
+def mutate(rows, changes):
+    """约 3/4 修改积分，1/8 新增，1/8 删除"""
+    rows = {username: list(row) for username, row in rows.items()}
+    removed = changes // 8
+    inserted = changes // 8
+    changed = changes - removed - inserted
+    usernames = list(rows)
+    for username in usernames[:changed]:
+        rows[username][3] += 50
+        rows[username][4] += 50
+    for username in usernames[-removed:]:
+        del rows[username]
+    for i in range(inserted):
+        username = f'2026{i:06d}'
+        rows[username] = [f'新生{i}', username, '新学院', 100, 100]
+    return rows, {'changed': changed, 'inserted': inserted, 'removed': removed}
+
+
+class UserWrites:
+    """统计写入 user 表的行数（executemany 按参数组数计）"""
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.rows = 0
+
+    def __enter__(self):
+        event.listen(self.engine, 'before_cursor_execute', self._count)
+        return self
+
+    def __exit__(self, *exc):
+        event.remove(self.engine, 'before_cursor_execute', self._count)
+
+    def _count(self, conn, cursor, statement, parameters, context, executemany):
+        head = statement.lstrip().upper()
+        if not head.startswith(('INSERT INTO "USER"', 'INSERT INTO USER', 'UPDATE "USER"', 'UPDATE USER')):
+            return
+        # 一条语句可能插入多行：INSERT ... VALUES (...), (...)；executemany 时参数为多组
+        rows = len(re.findall(r'\)\s*,\s*\(', statement)) + 1
+        nested = parameters and isinstance(parameters[0], (tuple, list, dict))
+        self.rows += rows * (len(parameters) if executemany and nested else 1)
+
+
+def roster(stream):
+    stream.seek(0)
+    rows = iter_roster(stream, IMPORT_REQUIRED_HEADERS)
+    return next(rows), rows
+
+
+def main():
+    students = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    changes = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+    original = build_rows(students)
+    updated, expected = mutate(original, changes)
+    first, second = write_workbook(original), write_workbook(updated)
+
+    with app.app_context():
+        reset_database(db)
+        headers, rows = roster(first)
+        import_user_rows(headers, rows)
+        db.session.commit()
+
+        # 全量导入第二份表格（对照组），完成后回滚
+        headers, rows = roster(second)
+        with UserWrites(db.engine) as writes:
+            started = time.perf_counter()
+            import_user_rows(headers, rows)
+            db.session.flush()
+            full_elapsed = time.perf_counter() - started
+        db.session.rollback()
+        print(f'全量导入 {len(updated)} 行：写入 user 表 {writes.rows} 行，{full_elapsed:.2f}s')
+
+        # 差异同步
+        headers, rows = roster(second)
+        with UserWrites(db.engine) as writes:
+            started = time.perf_counter()
+            diff = diff_roster(headers, rows)
+            diff_elapsed = time.perf_counter() - started
+            apply_roster_diff(diff, remove_missing=True)
+            db.session.commit()
+            sync_elapsed = time.perf_counter() - started
+        counts = {key: len(diff[key]) for key in ('inserted', 'changed', 'removed')}
+        print(f'差异同步：{counts}，未变化 {diff["unchanged"]}，写入 user 表 {writes.rows} 行，'
+              f'比较 {diff_elapsed:.2f}s，合计 {sync_elapsed:.2f}s')
+        assert counts == expected, f'预期 {expected}'
+        assert writes.rows == changes, f'应写入 {changes} 行'
+
+        # 同一表格再同步一次：没有变化，不写入
+        headers, rows = roster(second)
+        diff = diff_roster(headers, rows)
+        assert not diff['inserted'] and not diff['changed'] and not diff['removed']
+        assert not verify_points_ledger(), '积分流水与余额不一致'
+
+    # 通过管理员接口：上传预览 -> 确认同步
+    with app.app_context():
+        admin = User(username='bench-admin', password='x', is_admin=True)
+        db.session.add(admin)
+        db.session.commit()
+        admin_id = admin.id
+    client = app.test_client()
+    with client.session_transaction() as sess:
+        sess['user_id'] = admin_id
+    third, _ = mutate(updated, 16)
+    upload = write_workbook(third)
+    upload.seek(0)
+    response = client.post('/import_excel', data={
+        'mode': 'diff', 'excel_file': (upload, 'roster.xlsx'),
+    }, content_type='multipart/form-data')
+    preview_id = response.get_json()['job_id']
+    with app.app_context():
+        job_queue.run_pending()
+    preview = client.get(f'/jobs/{preview_id}').get_json()['result']
+    print(f'接口预览：{preview["message"]}')
+    response = client.post(f'/import_excel/{preview_id}/apply', data={'remove_missing': '0'})
+    apply_id = response.get_json()['job_id']
+    with app.app_context():
+        job_queue.run_pending()
+    result = client.get(f'/jobs/{apply_id}').get_json()['result']
+    print(f'接口同步：{result["message"]}')
+    assert result['written'] == preview['inserted'] + preview['changed']
+    print('校验通过：差异同步只写入变化的学生，积分流水与余额一致')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,335 @@
+"""热点路由基准：登录、商品页、购买、管理员页面、Excel导入
+
+用法：
+    python benchmarks/route_bench.py                       # Flask test client，多线程
+    python benchmarks/route_bench.py --mode http           # 启动本地HTTP服务，通过真实连接压测
+    python benchmarks/route_bench.py --save-baseline base.json
+    python benchmarks/route_bench.py --compare base.json   # 与基线对比，p95变慢超过阈值时返回非零
+
+先在临时数据库中生成 N 个学生、M 件商品和 K 条历史购买记录，
+再按场景并发发送请求，输出每个场景的吞吐量和 p50/p95/p99 延迟。
+"""
+import argparse
+import http.cookiejar
+import io
+import json
+import platform
+import random
+import socket
+import sys
+import threading
+import time
+import urllib.parse
+import urllib.request
+import uuid
+from datetime import datetime, timedelta
+
+from openpyxl import Workbook
+
+from bench_utils import use_temp_database, reset_database
+
+use_temp_database()
+
+from app import app, db, User, Product, PurchaseRecord, verify_purchase_counters, start_job_worker  # noqa: E402
+from auth import BULK_HASH_METHOD, hash_password  # noqa: E402
+
+ADMIN_USERNAME = 'bench_admin'
+ADMIN_PASSWORD = 'bench_admin'
+
+
+# ---------- 数据准备 ----------
+
+def seed(students, products, records):
+    with app.app_context():
+        reset_database(db)
+        db.session.bulk_insert_mappings(User, [
+            {'username': ADMIN_USERNAME, 'password': hash_password(ADMIN_PASSWORD, BULK_HASH_METHOD),
+             'is_admin': True, 'name': '管理员'}
+        ] + [
+            {'username': student_username(i), 'password': hash_password(student_username(i), BULK_HASH_METHOD),
+             'is_admin': False, 'name': f'学生{i}', 'gender': 'male', 'college': f'学院{i % 20}',
+             'points': 1_000_000, 'remaining_points': 1_000_000}
+            for i in range(students)
+        ])
+        db.session.bulk_insert_mappings(Product, [
+            {'name': f'商品{i}', 'picture': 'bench.png', 'price': 1 + i % 5, 'stock': 10_000_000, 'limit': 10_000_000}
+            for i in range(products)
+        ])
+        start = datetime.utcnow() - timedelta(days=365)
+        rng = random.Random(42)
+        for offset in range(0, records, 10000):
+            product_ids = [rng.randint(1, products) for _ in range(min(10000, records - offset))]
+            db.session.bulk_insert_mappings(PurchaseRecord, [
+                {'user_id': rng.randint(2, students + 1), 'product_id': product_id, 'quantity': 1,
+                 'unit_price': 1 + (product_id - 1) % 5, 'total_cost': 1 + (product_id - 1) % 5,
+                 'purchase_time': start + timedelta(minutes=rng.randint(0, 525600))}
+                for product_id in product_ids
+            ])
+        db.session.commit()
+        # 历史记录直接写入，需要同步月度限购计数
+        verify_purchase_counters(fix=True)
+        db.session.remove()
+
+
+def student_username(i):
+    return f'B{i:07d}'
+
+
+def build_roster(rows):
+    workbook = Workbook(write_only=True)
+    sheet = workbook.create_sheet()
+    sheet.append(['姓名', '学号', '学院', '爱心币数量', '剩余爱心币'])
+    for i in range(rows):
+        sheet.append([f'导入{i}', f'I{i:07d}', f'学院{i % 20}', 300, 300])
+    stream = io.BytesIO()
+    workbook.save(stream)
+    return stream.getvalue()
+
+
+def multipart(field, filename, content):
+    boundary = uuid.uuid4().hex
+    body = (f'--{boundary}\r\nContent-Disposition: form-data; name="{field}"; filename="{filename}"\r\n'
+            f'Content-Type: application/octet-stream\r\n\r\n').encode() + content + f'\r\n--{boundary}--\r\n'.encode()
+    return body, f'multipart/form-data; boundary={boundary}'
+
+
+# ---------- 客户端：test client 和 HTTP 两种实现，接口一致 ----------
+# get/post 返回状态码，响应内容保存在 last_body 中
+
+class TestClientDriver:
+    def __init__(self):
+        self.client = app.test_client()
+        self.last_body = b''
+
+    def _done(self, response):
+        self.last_body = response.get_data()
+        return response.status_code
+
+    def get(self, path):
+        return self._done(self.client.get(path))
+
+    def post(self, path, data=None, body=None, content_type=None):
+        if body is not None:
+            return self._done(self.client.post(path, data=body, content_type=content_type))
+        return self._done(self.client.post(path, data=data))
+
+
+class HttpDriver:
+    def __init__(self, base_url):
+        self.base_url = base_url
+        self.opener = urllib.request.build_opener(
+            urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar()), NoRedirect()
+        )
+        self.last_body = b''
+
+    def _open(self, request):
+        try:
+            with self.opener.open(request, timeout=60) as response:
+                self.last_body = response.read()
+                return response.status
+        except urllib.error.HTTPError as e:
+            self.last_body = e.read()
+            return e.code
+
+    def get(self, path):
+        return self._open(urllib.request.Request(self.base_url + path))
+
+    def post(self, path, data=None, body=None, content_type=None):
+        if body is None:
+            body = urllib.parse.urlencode(data or {}).encode()
+            content_type = 'application/x-www-form-urlencoded'
+        return self._open(urllib.request.Request(self.base_url + path, data=body,
+                                                 headers={'Content-Type': content_type}))
+
+
+class NoRedirect(urllib.request.HTTPRedirectHandler):
+    # 登录后的302直接作为结果返回，与 test client 行为一致
+    def redirect_request(self, *args, **kwargs):
+        return None
+
+
+def start_http_server():
+    import logging
+    from werkzeug.serving import make_server
+    # 关闭逐条请求日志，避免输出淹没结果
+    logging.getLogger('werkzeug').setLevel(logging.WARNING)
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        port = s.getsockname()[1]
+    server = make_server('127.0.0.1', port, app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f'http://127.0.0.1:{port}'
+
+
+# ---------- 场景 ----------
+
+def scenarios(args):
+    roster, roster_type = multipart('excel_file', 'roster.xlsx', build_roster(args.import_rows))
+    return [
+        # (名称, 是否管理员, 请求次数, 并发数, 请求函数)
+        ('login', False, args.requests, args.concurrency,
+         lambda d, i, rng: d.post('/login', {'username': student_username(i), 'password': student_username(i)})),
+        ('shop', False, args.requests, args.concurrency, lambda d, i, rng: d.get('/')),
+        ('purchase', False, args.requests, args.concurrency,
+         lambda d, i, rng: d.post(f'/purchase/{rng.randint(1, args.products)}', {'quantity': 1})),
+        ('admin', True, max(args.requests // 5, 1), args.concurrency, lambda d, i, rng: d.get('/admin')),
+        ('admin_users', True, args.requests, args.concurrency, lambda d, i, rng: d.get('/admin/users')),
+        # 同一份名单并发导入会互相冲突，导入按管理员实际操作方式串行执行
+        ('import_excel', True, args.import_requests, 1,
+         lambda d, i, rng: import_and_wait(d, roster, roster_type)),
+    ]
+
+
+def import_and_wait(driver, roster, roster_type):
+    # 导入在后台任务中执行，计时包括上传和等待任务完成
+    status = driver.post('/import_excel', body=roster, content_type=roster_type)
+    if status >= 400:
+        return status
+    status_url = json.loads(driver.last_body)['status_url']
+    while True:
+        status = driver.get(status_url)
+        if status >= 400:
+            return status
+        job = json.loads(driver.last_body)
+        if job['status'] == 'succeeded':
+            return 200
+        if job['status'] == 'failed':
+            return 500
+        time.sleep(0.02)
+
+
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, max(0, round(pct / 100 * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+
+def run_scenario(name, as_admin, total, concurrency, func, args, make_driver):
+    latencies, errors = [], 0
+    lock = threading.Lock()
+    counter = iter(range(total))
+    counter_lock = threading.Lock()
+    # 所有线程登录完成后再开始计时，登录本身的耗时不计入其他场景
+    ready = threading.Barrier(concurrency + 1)
+
+    def worker(worker_id):
+        nonlocal errors
+        rng = random.Random(worker_id)
+        driver = make_driver()
+        user_index = worker_id % args.students
+        if as_admin:
+            driver.post('/login', {'username': ADMIN_USERNAME, 'password': ADMIN_PASSWORD})
+        else:
+            driver.post('/login', {'username': student_username(user_index), 'password': student_username(user_index)})
+        ready.wait()
+        while True:
+            with counter_lock:
+                if next(counter, None) is None:
+                    return
+            started = time.perf_counter()
+            status = func(driver, rng.randrange(args.students), rng)
+            elapsed = (time.perf_counter() - started) * 1000
+            with lock:
+                latencies.append(elapsed)
+                if status >= 400:
+                    errors += 1
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(concurrency)]
+    for t in threads:
+        t.start()
+    ready.wait()
+    started = time.perf_counter()
+    for t in threads:
+        t.join()
+    wall = time.perf_counter() - started
+    latencies.sort()
+    return {
+        'requests': len(latencies),
+        'errors': errors,
+        'throughput': round(len(latencies) / wall, 1) if wall else 0.0,
+        'p50_ms': round(percentile(latencies, 50), 2),
+        'p95_ms': round(percentile(latencies, 95), 2),
+        'p99_ms': round(percentile(latencies, 99), 2),
+    }
+
+
+def compare(results, baseline, threshold):
+    regressions = []
+    print(f'\n与基线对比（{baseline["meta"].get("created_at", "")}，阈值 +{threshold:.0%}）')
+    for name, current in results.items():
+        previous = baseline['results'].get(name)
+        if not previous:
+            continue
+        change = (current['p95_ms'] - previous['p95_ms']) / previous['p95_ms'] if previous['p95_ms'] else 0
+        flag = '变慢' if change > threshold else ''
+        if flag:
+            regressions.append(name)
+        print(f'  {name:<14} p95 {previous["p95_ms"]:>8.2f} -> {current["p95_ms"]:>8.2f} ms ({change:+.0%})  '
+              f'吞吐 {previous["throughput"]:>8.1f} -> {current["throughput"]:>8.1f} req/s  {flag}')
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--students', type=int, default=2000)
+    parser.add_argument('--products', type=int, default=30)
+    parser.add_argument('--records', type=int, default=50000)
+    parser.add_argument('--requests', type=int, default=500, help='每个场景的请求数')
+    parser.add_argument('--import-requests', type=int, default=5)
+    parser.add_argument('--import-rows', type=int, default=2000)
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--mode', choices=['testclient', 'http'], default='testclient')
+    parser.add_argument('--only', nargs='*', help='只运行指定场景')
+    parser.add_argument('--save-baseline', metavar='FILE')
+    parser.add_argument('--compare', metavar='FILE')
+    parser.add_argument('--threshold', type=float, default=0.2, help='p95 变慢超过该比例视为退化')
+    args = parser.parse_args()
+
+    print(f'生成数据：{args.students} 个学生，{args.products} 件商品，{args.records} 条购买记录')
+    seed(args.students, args.products, args.records)
+    start_job_worker()
+
+    server = None
+    if args.mode == 'http':
+        server, base_url = start_http_server()
+        make_driver = lambda: HttpDriver(base_url)  # noqa: E731
+    else:
+        make_driver = TestClientDriver
+
+    results = {}
+    print(f'{"场景":<14}{"请求":>6}{"错误":>6}{"吞吐(req/s)":>14}{"p50(ms)":>10}{"p95(ms)":>10}{"p99(ms)":>10}')
+    for name, as_admin, total, concurrency, func in scenarios(args):
+        if args.only and name not in args.only:
+            continue
+        result = run_scenario(name, as_admin, total, concurrency, func, args, make_driver)
+        results[name] = result
+        print(f'{name:<14}{result["requests"]:>6}{result["errors"]:>6}{result["throughput"]:>14}'
+              f'{result["p50_ms"]:>10}{result["p95_ms"]:>10}{result["p99_ms"]:>10}')
+    if server:
+        server.shutdown()
+
+    report = {
+        'meta': {
+            'created_at': datetime.now().isoformat(timespec='seconds'),
+            'mode': args.mode,
+            'python': platform.python_version(),
+            'students': args.students, 'products': args.products, 'records': args.records,
+            'concurrency': args.concurrency,
+        },
+        'results': results,
+    }
+    if args.save_baseline:
+        with open(args.save_baseline, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f'基线已保存到 {args.save_baseline}')
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as f:
+            regressions = compare(results, json.load(f), args.threshold)
+        if regressions:
+            print(f'性能退化：{", ".join(regressions)}')
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
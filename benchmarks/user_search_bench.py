@@ -0,0 +1,98 @@
+"""学生搜索耗时：生成大量中文姓名的学生，比较全文索引与 LIKE 查询的延迟，并检查触发器同步
+
+用法：python benchmarks/user_search_bench.py [学生数] [每种查询的次数]
+"""
+import random
+import statistics
+import sys
+import time
+
+from bench_utils import use_temp_database, reset_database
+
+use_temp_database()
+
+from app import app, db, User  # noqa: E402
+from sqlalchemy import or_  # noqa: E402
+from user_search import search_index_exists, search_user_ids  # noqa: E402
+
+SURNAMES = '王李张刘陈杨黄赵吴周徐孙马朱胡郭何高林罗郑梁谢宋唐许韩冯邓曹彭曾肖田董袁潘于蒋蔡余杜叶程苏魏吕丁任沈'
+GIVEN = '伟芳娜秀英敏静丽强磊军洋勇艳杰娟涛明超秀兰霞平刚桂英华玉萍红娥玲芬燕彬鑫宇浩然子轩梓涵一诺欣怡思远'
+COLLEGES = ['文学院', '理学院', '工学院', '经济管理学院', '外国语学院', '计算机科学与技术学院', '艺术学院', '医学院']
+
+
+def seed(students):
+    reset_database(db)
+    rng = random.Random(42)
+    db.session.bulk_insert_mappings(User, [
+        {'username': f'2025{index:06d}', 'password': 'x', 'is_admin': False,
+         'name': rng.choice(SURNAMES) + ''.join(rng.choice(GIVEN) for _ in range(rng.randint(1, 2))),
+         'college': rng.choice(COLLEGES)}
+        for index in range(students)
+    ])
+    db.session.commit()
+
+
+def like_user_ids(keyword, college, limit):
+    # 原来的查询方式：ILIKE 子串匹配，按管理员、id 排序
+    query = db.session.query(User.id)
+    if college:
+        query = query.filter(User.college.ilike(f'%{college}%'))
+    query = query.filter(or_(User.username.ilike(f'%{keyword}%'), User.name.ilike(f'%{keyword}%')))
+    return [row[0] for row in query.order_by(db.func.coalesce(User.is_admin, 0).desc(), User.id).limit(limit)]
+
+
+def measure(func, repeat):
+    samples = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        func()
+        samples.append((time.perf_counter() - started) * 1000)
+    samples.sort()
+    return statistics.median(samples), samples[int(len(samples) * 0.95) - 1]
+
+
+def main():
+    students = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    repeat = int(sys.argv[2]) if len(sys.argv) > 2 else 50
+    with app.app_context():
+        started = time.perf_counter()
+        seed(students)
+        print(f'生成 {students} 个学生（含触发器写入索引）：{time.perf_counter() - started:.1f}s')
+        assert search_index_exists(db.session), '当前SQLite不支持FTS5 trigram分词器'
+
+        cases = [
+            ('学号子串', '000123', ''),
+            ('学号前缀（命中很多）', '2025', ''),
+            ('姓名', '王子轩', ''),
+            ('姓名+学院', '李欣怡', '计算机'),
+            ('不存在', '不存在的人', ''),
+        ]
+        print(f'{"查询":<16}{"索引 p50":>10}{"p95(ms)":>10}{"LIKE p50":>10}{"p95(ms)":>10}')
+        for label, keyword, college in cases:
+            indexed = measure(lambda: search_user_ids(db.session, keyword, college, 21), repeat)
+            like = measure(lambda: like_user_ids(keyword, college, 21), repeat)
+            print(f'{label:<16}{indexed[0]:>10.2f}{indexed[1]:>10.2f}{like[0]:>10.2f}{like[1]:>10.2f}')
+
+        # 宽泛关键字翻到后面的页：按id键集分页，与第一页耗时相同
+        _, cursor = search_user_ids(db.session, '2025', '', 20)
+        assert cursor and cursor.startswith('k')
+        deep = f'k{students - 100}'
+        user_ids, _ = search_user_ids(db.session, '2025', '', 20, deep)
+        assert user_ids == list(range(students - 99, students - 79)), user_ids
+        first = measure(lambda: search_user_ids(db.session, '2025', '', 20), repeat)
+        late = measure(lambda: search_user_ids(db.session, '2025', '', 20, deep), repeat)
+        print(f'学号前缀翻页：第一页 p50 {first[0]:.2f}ms，第 {students // 20} 页 p50 {late[0]:.2f}ms')
+
+        # 触发器同步：修改、删除后索引立即反映
+        user = db.session.get(User, 1)
+        user.name = '欧阳索引测试'
+        db.session.commit()
+        assert search_user_ids(db.session, '欧阳索引', '', 5)[0] == [1]
+        db.session.delete(user)
+        db.session.commit()
+        assert search_user_ids(db.session, '欧阳索引', '', 5)[0] == []
+        print('触发器同步：通过')
+
+
+if __name__ == '__main__':
+    main()
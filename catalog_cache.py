@@ -0,0 +1,72 @@
+"""进程内商品目录缓存
+
+商品的静态字段（名称、价格、图片、限购）只有管理员修改时才会变化，缓存在内存中；
+库存变化频繁，单独按库存版本刷新。两个版本号保存在数据库的 cache_version 表中，
+所有进程（多个gunicorn worker）共享，任何进程修改商品后增加版本号，
+其他进程在下一次读取时发现版本变化并重新加载。
+"""
+import threading
+from collections import namedtuple
+
+CATALOG_VERSION = 'catalog'  # 商品静态字段
+STOCK_VERSION = 'stock'  # 商品库存
+
+CachedProduct = namedtuple('CachedProduct', ['id', 'name', 'picture', 'price', 'stock', 'limit', 'flash_sale'])
+
+
+class CatalogCache:
+    """load_products() 返回完整商品行，load_stock() 返回 {商品id: 库存}，
+    read_versions() 返回 {版本名: 版本号}"""
+
+    def __init__(self, load_products, load_stock, read_versions):
+        self._load_products = load_products
+        self._load_stock = load_stock
+        self._read_versions = read_versions
+        self._lock = threading.Lock()
+        self._products = None  # {商品id: CachedProduct}，按id排序
+        self._versions = {}
+        self.hits = 0
+        self.misses = 0
+        self.stock_refreshes = 0
+
+    def _refresh(self):
+        versions = self._read_versions()
+        catalog_version = versions.get(CATALOG_VERSION, 0)
+        stock_version = versions.get(STOCK_VERSION, 0)
+        if self._products is not None and catalog_version == self._versions.get(CATALOG_VERSION):
+            if stock_version != self._versions.get(STOCK_VERSION):
+                # 只有库存变化：只查询库存列，静态字段继续使用内存中的数据
+                stock = self._load_stock()
+                self._products = {
+                    product_id: product._replace(stock=stock[product_id])
+                    for product_id, product in self._products.items() if product_id in stock
+                }
+                self._versions[STOCK_VERSION] = stock_version
+                self.stock_refreshes += 1
+            else:
+                self.hits += 1
+            return self._products
+        self.misses += 1
+        self._products = {
+            product.id: CachedProduct(product.id, product.name, product.picture,
+                                      product.price, product.stock, product.limit, bool(product.flash_sale))
+            for product in self._load_products()
+        }
+        self._versions = {CATALOG_VERSION: catalog_version, STOCK_VERSION: stock_version}
+        return self._products
+
+    def all(self):
+        with self._lock:
+            return list(self._refresh().values())
+
+    def get(self, product_id):
+        with self._lock:
+            return self._refresh().get(product_id)
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'stock_refreshes': self.stock_refreshes,
+            'versions': dict(self._versions),
+        }
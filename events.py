@@ -0,0 +1,270 @@
+"""实时事件：把库存和积分变化推送到打开的商店页和管理页（Server-Sent Events）
+
+- 事务提交后，本进程修改过的商品库存、用户积分发布到进程内的 EventHub，立即推送给本进程的订阅者；
+- 多进程部署时其他进程的修改由每个进程的后台线程补齐：库存版本号变化时重新读取库存并推送有变化的商品，
+  积分按只追加的积分流水表（points_ledger）从上次读到的位置继续读取。不论多少页面在线，
+  每个进程每 poll_interval 秒最多执行这几条查询；
+- 每个 SSE 连接占用一个处理请求的线程，每个进程同时保持的连接数有上限，连接保持 stream_seconds 秒后结束，
+  浏览器按 retry 间隔自动重连；名额用完时立即返回积压的事件并结束，浏览器过 poll_retry_ms 毫秒后重连，
+  相当于轮询，不会占满处理购买的线程；
+- 事件id由进程标识和序号组成，重连到其他进程或积压的事件已被丢弃时，先发送一次当前库存和积分的快照。
+"""
+import itertools
+import json
+import logging
+import os
+import threading
+import time
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+
+def sse_message(event, data, event_id=None):
+    lines = [f'id: {event_id}'] if event_id else []
+    lines += [f'event: {event}', f'data: {json.dumps(data, ensure_ascii=False)}']
+    return '\n'.join(lines) + '\n\n'
+
+
+class EventHub:
+    """read_stock_version() 返回库存版本号，load_stock() 返回 {商品id: 库存}，
+    load_balances(after_id) 返回 (最后一条流水id, {用户id: 余额})，after_id 为 None 时只返回当前最大的流水id"""
+
+    def __init__(self, app, read_stock_version, load_stock, load_balances, max_streams=4, stream_seconds=25,
+                 heartbeat_seconds=10, poll_retry_ms=5000, poll_interval=1.0, history=2000, viewer_ttl=60):
+        self.app = app
+        self._read_stock_version = read_stock_version
+        self._load_stock = load_stock
+        self._load_balances = load_balances
+        self.stream_seconds = stream_seconds
+        self.heartbeat_seconds = heartbeat_seconds
+        self.poll_retry_ms = poll_retry_ms
+        self.poll_interval = poll_interval
+        self.viewer_ttl = viewer_ttl
+        self._max_streams = max_streams
+        self._history = history
+        self._reset()
+        if hasattr(os, 'register_at_fork'):
+            # 在主进程中创建后 fork 出的 worker（如 gunicorn --preload）不能沿用主进程的进程标识和序号，
+            # 否则其他 worker 发出的事件id会被当作本进程的，从无关的序号继续
+            os.register_at_fork(after_in_child=self._reset)
+
+    def _reset(self):
+        """初始化本进程的事件序号、缓存和线程状态（创建时及 fork 后的子进程中执行）"""
+        self.token = f'{os.getpid():x}{int(time.time()) & 0xffff:x}'  # 区分不同进程（及重启后）的事件序号
+        self._streams = threading.BoundedSemaphore(self._max_streams)
+        self._lock = threading.Lock()
+        self._changed = threading.Condition(self._lock)
+        self._prime_lock = threading.Lock()
+        self._events = deque(maxlen=self._history)  # (序号, 事件名, 接收的用户id或None, 数据)
+        self._seq = itertools.count(1)
+        self._last_seq = 0
+        self._stock = {}  # 最近推送的库存，用于去重和快照
+        self._balances = {}  # 最近推送的积分
+        self._viewers = {}  # 用户id -> 最近一次连接的时间
+        self._admin_seen = None
+        self._stock_version = None
+        self._ledger_id = None
+        self._primed = False
+        self._thread = None
+        self.streamed = 0
+        self.polled = 0
+        self.snapshots = 0
+
+    # ---------- 发布 ----------
+
+    def publish_changes(self, changes):
+        """事务提交后调用：changes 为 {('stock', 商品id) 或 ('balance', 用户id): 新值}"""
+        for (kind, key), value in changes.items():
+            if kind == 'stock':
+                self.publish_stock(key, value)
+            else:
+                self.publish_balance(key, value)
+
+    def publish_stock(self, product_id, stock):
+        with self._lock:
+            if self._stock.get(product_id) == stock:
+                return
+            self._stock[product_id] = stock
+            self._append('stock', None, {'product_id': product_id, 'stock': stock})
+
+    def publish_balance(self, user_id, points):
+        with self._lock:
+            # 只推送有页面在线的用户；有管理员在线时推送所有用户
+            if not self._watching(user_id):
+                self._balances.pop(user_id, None)  # 不在线期间的变化没有推送，之后不能再用于去重
+                return
+            if self._balances.get(user_id) == points:
+                return
+            self._balances[user_id] = points
+            self._append('balance', user_id, {'user_id': user_id, 'points': points})
+
+    def _append(self, kind, user_id, data):
+        self._last_seq = next(self._seq)
+        self._events.append((self._last_seq, kind, user_id, data))
+        self._changed.notify_all()
+
+    def _watching(self, user_id):
+        now = time.monotonic()
+        if self._admin_seen is not None and now - self._admin_seen < self.viewer_ttl:
+            return True
+        seen = self._viewers.get(user_id)
+        return seen is not None and now - seen < self.viewer_ttl
+
+    def _touch(self, user_id, is_admin):
+        with self._lock:
+            now = time.monotonic()
+            self._viewers[user_id] = now
+            if is_admin:
+                self._admin_seen = now
+            if len(self._viewers) > 10000:
+                self._viewers = {uid: seen for uid, seen in self._viewers.items() if now - seen < self.viewer_ttl}
+
+    # ---------- 订阅 ----------
+
+    def cursor(self):
+        """当前位置，渲染页面时写入页面，页面订阅时只接收这之后的事件"""
+        with self._lock:
+            return f'{self.token}-{self._last_seq}'
+
+    def parse_cursor(self, last_event_id):
+        """Last-Event-ID 为本进程发出的事件id时返回序号，否则返回 None（需要先发送快照）"""
+        token, _, seq = (last_event_id or '').partition('-')
+        if token != self.token or not seq.isdigit():
+            return None
+        seq = int(seq)
+        with self._lock:
+            oldest = self._events[0][0] if self._events else self._last_seq + 1
+            if seq > self._last_seq or seq < oldest - 1:
+                return None  # 中间的事件已被丢弃
+        return seq
+
+    def stream(self, user_id, is_admin, cursor, points=None):
+        """SSE 事件生成器；cursor 为 parse_cursor() 的结果，为 None 时先发送快照（points 为用户当前积分）"""
+        self._touch(user_id, is_admin)
+        self._ensure_thread()
+        # 生成器开始执行时才占用名额：客户端在响应开始前断开时不会泄漏
+        held = self._streams.acquire(blocking=False)
+        try:
+            if held:
+                self.streamed += 1
+                yield 'retry: 1000\n\n'
+            else:
+                self.polled += 1
+                yield f'retry: {self.poll_retry_ms}\n\n'
+            if cursor is None:
+                cursor, message = self._snapshot(user_id, points)
+                yield message
+            deadline = time.monotonic() + (self.stream_seconds if held else 0)
+            while True:
+                timeout = min(self.heartbeat_seconds, deadline - time.monotonic())
+                events, cursor = self._wait(cursor, user_id, is_admin, timeout)
+                if events is None:
+                    # 连接期间积压的事件超过了缓存的数量，改为发送快照
+                    cursor, message = self._snapshot(user_id)
+                    yield message
+                    continue
+                for seq, kind, data in events:
+                    yield sse_message(kind, data, f'{self.token}-{seq}')
+                if time.monotonic() >= deadline:
+                    return
+                if not events:
+                    self._touch(user_id, is_admin)
+                    yield ': keepalive\n\n'
+        finally:
+            if held:
+                self._streams.release()
+
+    def _snapshot(self, user_id, points=None):
+        self.snapshots += 1
+        with self._lock:
+            cursor = self._last_seq
+            snapshot = {'stock': {str(product_id): stock for product_id, stock in self._stock.items()}}
+            if points is not None:
+                self._balances[user_id] = points
+            else:
+                points = self._balances.get(user_id)  # 在线期间推送过的积分就是当前积分
+            if points is not None:
+                snapshot['points'] = points
+        return cursor, sse_message('snapshot', snapshot, f'{self.token}-{cursor}')
+
+    def _wait(self, cursor, user_id, is_admin, timeout):
+        """返回 (cursor 之后发给该用户的事件, 新的 cursor)；中间的事件已被丢弃时事件为 None"""
+        with self._changed:
+            if timeout > 0:
+                self._changed.wait_for(lambda: self._last_seq > cursor, timeout)
+            if self._events and self._events[0][0] > cursor + 1:
+                return None, cursor
+            events = [
+                (seq, kind, data) for seq, kind, target, data in self._events
+                if seq > cursor and (target is None or target == user_id or is_admin)
+            ]
+            return events, self._last_seq
+
+    # ---------- 其他进程的修改 ----------
+
+    def prime(self):
+        """在请求线程（有应用上下文）中调用：本进程第一次有页面订阅时读取当前库存和流水位置"""
+        if self._primed:
+            return
+        with self._prime_lock:
+            if self._primed:
+                return
+            version = self._read_stock_version()
+            stock = self._load_stock()
+            ledger_id, _ = self._load_balances(None)
+            with self._lock:
+                self._stock_version = version
+                self._stock.update(stock)
+                self._ledger_id = ledger_id
+                self._primed = True
+
+    def poll(self):
+        """读取其他进程提交的库存和积分变化并推送，在应用上下文中调用"""
+        version = self._read_stock_version()
+        if version != self._stock_version:
+            for product_id, stock in self._load_stock().items():
+                self.publish_stock(product_id, stock)
+            self._stock_version = version
+        self._ledger_id, balances = self._load_balances(self._ledger_id)
+        for user_id, points in balances.items():
+            self.publish_balance(user_id, points)
+
+    def _idle(self):
+        with self._lock:
+            now = time.monotonic()
+            return not any(now - seen < self.viewer_ttl for seen in self._viewers.values())
+
+    def _ensure_thread(self):
+        # 第一次有页面订阅时启动（在 fork 出的 worker 进程中启动，而不是在主进程中）
+        if self._thread is None or not self._thread.is_alive():
+            with self._prime_lock:
+                if self._thread is None or not self._thread.is_alive():
+                    self._thread = threading.Thread(target=self._run, name='event-hub-poller', daemon=True)
+                    self._thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.poll_interval)
+            if not self._primed:
+                continue
+            if self._idle():
+                # 没有页面在线时不查询；之后有页面订阅时重新读取当前位置，不补读空闲期间的流水
+                self._primed = False
+                continue
+            try:
+                with self.app.app_context():
+                    self.poll()
+            except Exception:
+                logger.exception('读取库存和积分变化失败')
+
+    def stats(self):
+        with self._lock:
+            return {
+                'last_seq': self._last_seq,
+                'buffered': len(self._events),
+                'viewers': len(self._viewers),
+                'streamed': self.streamed,
+                'polled': self.polled,
+                'snapshots': self.snapshots,
+            }
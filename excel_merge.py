@@ -0,0 +1,96 @@
+"""整理表格：合并所有sheet并清洗数据，单次遍历完成
+
+命令行脚本 changeExcel.py 和 /process_excel 路由共用这里的逻辑。
+处理步骤与原来逐行删除的实现一致：
+1. 第一个sheet保留全部行，其余sheet跳过表头；
+2. 删除第一行（标题行），并把第二行修正为标准表头；
+3. 从第3行起，E列有值时用E列覆盖D列（爱心币数量）；
+4. 从第3行起，删除空白行和包含"高等职业技术学院"的行。
+所有步骤都是生成器，输出用 write_only 工作簿一次写出，耗时与行数成线性关系。
+"""
+import os
+
+from openpyxl import Workbook
+
+from excel_stream import open_workbook, iter_sheet_rows, is_blank_row
+
+CORRECT_HEADERS = ["姓名", "学号", "学院", "爱心币数量", "剩余爱心币"]
+EXCLUDED_COLLEGE = "高等职业技术学院"
+MERGED_SHEET_TITLE = '合并数据'
+
+
+def iter_merged_rows(workbook):
+    """依次返回每个sheet的行：第一个sheet包括表头，其余sheet跳过表头"""
+    for index, sheet_name in enumerate(workbook.sheetnames):
+        yield from iter_sheet_rows(workbook[sheet_name], min_row=1 if index == 0 else 2)
+
+
+def fix_header(row):
+    # 表头不正确时替换前5列为标准表头，其余列保持不变
+    row = tuple(row)
+    padded = row + (None,) * (len(CORRECT_HEADERS) - len(row))
+    if all(value == header for value, header in zip(padded, CORRECT_HEADERS)):
+        return row
+    return tuple(CORRECT_HEADERS) + row[len(CORRECT_HEADERS):]
+
+
+def coalesce_points(row):
+    # 如果E列有数值（不是None），则使用E列的值写入D列，否则保留D列；E列保持不变
+    row = list(row)
+    if len(row) < 5:
+        row.extend([None] * (5 - len(row)))
+    if row[4] is not None:
+        row[3] = row[4]
+    return tuple(row)
+
+
+def contains_excluded_college(row):
+    return any(value is not None and EXCLUDED_COLLEGE in str(value) for value in row)
+
+
+def clean_rows(rows, stats):
+    """对合并后的行做表头修正、D/E列合并和过滤，stats['deleted_rows'] 记录按学院删除的行数"""
+    rows = iter(rows)
+    # 删除第一行（标题行）
+    next(rows, None)
+    header = next(rows, None)
+    if header is None:
+        return
+    yield fix_header(header)
+    # 第2行原样保留，不参与D/E列处理和删除
+    second = next(rows, None)
+    if second is None:
+        return
+    yield tuple(second)
+    for row in rows:
+        row = coalesce_points(row)
+        if is_blank_row(row):
+            continue
+        if contains_excluded_college(row):
+            stats['deleted_rows'] += 1
+            continue
+        yield row
+
+
+def merged_output_path(output_dir, input_filename):
+    name, ext = os.path.splitext(os.path.basename(input_filename))
+    return os.path.join(output_dir, f'{name}_处理后{ext}')
+
+
+def merge_excel(input_path, output_path, on_progress=None, progress_every=1000):
+    """合并整理 input_path，结果写入 output_path，返回原始sheet数、输出行数和删除行数
+
+    on_progress(stats) 每输出 progress_every 行调用一次，用于后台任务上报进度。
+    """
+    stats = {'original_sheets': 0, 'total_rows': 0, 'deleted_rows': 0}
+    merged_workbook = Workbook(write_only=True)
+    merged_sheet = merged_workbook.create_sheet(MERGED_SHEET_TITLE)
+    with open_workbook(input_path, data_only=False) as workbook:
+        stats['original_sheets'] = len(workbook.sheetnames)
+        for row in clean_rows(iter_merged_rows(workbook), stats):
+            merged_sheet.append(row)
+            stats['total_rows'] += 1
+            if on_progress and stats['total_rows'] % progress_every == 0:
+                on_progress(stats)
+    merged_workbook.save(output_path)
+    return stats
@@ -0,0 +1,77 @@
+"""流式读取上传的Excel文件
+
+上传内容先分块写入临时文件，再以 read_only 模式逐行读取，
+内存占用与表格行数、sheet数量无关。
+"""
+import os
+import shutil
+import tempfile
+from contextlib import contextmanager
+
+from openpyxl import load_workbook
+
+SPOOL_CHUNK_SIZE = 1024 * 1024
+
+
+class ExcelFormatError(ValueError):
+    """表格结构不符合要求（如缺少必要列），消息直接返回给前端"""
+
+
+@contextmanager
+def spooled_upload(file_storage, suffix='.xlsx'):
+    """把上传文件分块写入临时文件，退出时删除"""
+    fd, path = tempfile.mkstemp(suffix=suffix)
+    try:
+        with os.fdopen(fd, 'wb') as out:
+            shutil.copyfileobj(file_storage.stream, out, SPOOL_CHUNK_SIZE)
+        yield path
+    finally:
+        if os.path.exists(path):
+            os.remove(path)
+
+
+@contextmanager
+def open_workbook(path, data_only=True):
+    """以只读模式打开工作簿，退出时关闭文件句柄"""
+    workbook = load_workbook(path, read_only=True, data_only=data_only)
+    try:
+        yield workbook
+    finally:
+        workbook.close()
+
+
+def iter_sheet_rows(sheet, min_row=1):
+    """逐行返回单元格值元组，不在内存中保留整个sheet"""
+    yield from sheet.iter_rows(min_row=min_row, values_only=True)
+
+
+def is_blank_row(row):
+    return all(value is None or value == '' for value in row)
+
+
+def estimate_rows(path, all_sheets=False):
+    """按工作表记录的尺寸估算行数（不逐行读取），用于显示进度；无法估算时返回 None"""
+    with open_workbook(path) as workbook:
+        sheets = workbook.worksheets if all_sheets else [workbook.active]
+        counts = [sheet.max_row for sheet in sheets]
+    if any(count is None for count in counts):
+        return None
+    return sum(counts)
+
+
+def iter_roster(path, required_headers):
+    """读取第一个sheet的花名册，先返回表头，再逐行返回 (行号, 数据元组)
+
+    缺少必要列时抛出 ExcelFormatError；整行为空的行直接跳过。
+    """
+    with open_workbook(path) as workbook:
+        rows = iter_sheet_rows(workbook.active)
+        headers = list(next(rows, None) or ())
+        for header in required_headers:
+            if header not in headers:
+                raise ExcelFormatError(f"Excel文件缺少必要列: {header}")
+        yield headers
+        for row_number, row in enumerate(rows, start=2):
+            if is_blank_row(row):
+                continue
+            yield row_number, row
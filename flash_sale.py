@@ -0,0 +1,213 @@
+"""抢购模式：热门商品的购买请求先在内存中预留库存，再由后台线程按批次写入数据库
+
+普通购买每个请求都要拿数据库写锁、读写同一行商品库存，热门商品上架时大量请求在写锁上排队。
+开启抢购模式的商品：
+- 请求到达时在进程内按先来先到扣减预留库存，进入该商品的有界队列，然后等待写入结果；
+- 预留库存用完后直接返回“已售罄”，队列已满时直接返回“人数过多”，都不访问数据库；
+- 后台线程每次从队列头取出最多 batch_size 个预留，在一个加锁事务中逐个校验积分和限购并写入，
+  校验失败的预留退回预留库存。
+
+预留库存只是准入控制，数据库事务中仍然检查库存，多进程部署时各进程分别预留也不会超卖。
+各进程每 refresh_interval 秒从数据库读取一次抢购商品及库存（管理员开关抢购、补货在这之后生效），
+预留库存 = 数据库库存 - 本进程尚未写入的预留数量。
+"""
+import collections
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class FlashSaleRejected(Exception):
+    """抢购请求未被接受（售罄、排队人数过多、等待超时），消息直接返回给用户"""
+
+
+class Ticket:
+    """一个购买请求的预留，由后台线程写入后设置结果"""
+
+    def __init__(self, product_id, user_id, quantity):
+        self.product_id = product_id
+        self.user_id = user_id
+        self.quantity = quantity
+        self.result = None
+        self.error = None
+        self._done = threading.Event()
+
+    def succeed(self, result):
+        self.result = result
+        self._done.set()
+
+    def fail(self, error):
+        self.error = error
+        self._done.set()
+
+    def wait(self, timeout=None):
+        return self._done.wait(timeout)
+
+
+class _Sale:
+    def __init__(self, product_id, stock):
+        self.product_id = product_id
+        self.remaining = stock  # 可以继续预留的数量
+        self.queue = collections.deque()  # 等待写入的预留，先进先出
+        self.in_flight = 0  # 已取出、正在写入的预留数量
+
+    def pending_quantity(self):
+        return self.in_flight + sum(ticket.quantity for ticket in self.queue)
+
+
+class FlashSaleManager:
+    """load_active() 返回 {商品id: 数据库库存}（只包括开启抢购的商品）；
+    commit_batch(product_id, tickets) 在一个事务中写入，对每个 ticket 调用 succeed/fail，返回写入后的库存"""
+
+    def __init__(self, app, load_active, commit_batch, queue_size=1000, batch_size=50,
+                 refresh_interval=1.0, timeout=10.0):
+        self.app = app
+        self._load_active = load_active
+        self._commit_batch = commit_batch
+        self.queue_size = queue_size
+        self.batch_size = batch_size
+        self.refresh_interval = refresh_interval
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self._work = threading.Condition(self._lock)
+        self._refresh_lock = threading.Lock()
+        self._sales = {}
+        self._closing = []  # 已关闭抢购、但还有预留未写入的商品
+        self._last_refresh = None
+        self._thread = None
+        self.admitted = 0
+        self.rejected = 0
+        self.batches = 0
+
+    # ---------- 抢购商品列表 ----------
+
+    def _fresh(self):
+        last = self._last_refresh
+        return last is not None and time.monotonic() - last < self.refresh_interval
+
+    def _refresh(self):
+        if self._fresh():
+            return
+        # 同一时间只有一个请求去数据库读取，其他请求继续使用当前数据；
+        # 还没有读取过（或刚失效）时没有可用的数据，等待正在进行的读取完成
+        if not self._refresh_lock.acquire(blocking=self._last_refresh is None):
+            return
+        try:
+            if self._fresh():
+                return
+            active = self._load_active()
+            with self._lock:
+                for product_id in list(self._sales):
+                    if product_id not in active:
+                        sale = self._sales.pop(product_id)
+                        if sale.queue or sale.in_flight:
+                            self._closing.append(sale)  # 已排队的预留仍由后台线程写入
+                for product_id, stock in active.items():
+                    sale = self._sales.get(product_id)
+                    if sale is None:
+                        self._sales[product_id] = _Sale(product_id, stock)
+                    else:
+                        sale.remaining = max(stock - sale.pending_quantity(), 0)
+            self._last_refresh = time.monotonic()
+        finally:
+            self._refresh_lock.release()
+
+    def is_active(self, product_id):
+        self._refresh()
+        return product_id in self._sales
+
+    def invalidate(self):
+        """本进程修改了抢购开关或库存，下一个请求立即重新读取"""
+        self._last_refresh = None
+
+    # ---------- 购买 ----------
+
+    def purchase(self, product_id, user_id, quantity):
+        """预留并等待写入结果；商品未开启抢购时返回 None，由调用方走普通购买流程
+
+        成功返回 commit_batch 设置的结果，失败抛出 FlashSaleRejected。
+        """
+        self._refresh()
+        with self._lock:
+            sale = self._sales.get(product_id)
+            if sale is None:
+                return None
+            if sale.remaining < quantity:
+                self.rejected += 1
+                raise FlashSaleRejected('已售罄' if sale.remaining == 0 else '库存不足')
+            if len(sale.queue) >= self.queue_size:
+                self.rejected += 1
+                raise FlashSaleRejected('当前抢购人数过多，请稍后再试')
+            ticket = Ticket(product_id, user_id, quantity)
+            sale.remaining -= quantity
+            sale.queue.append(ticket)
+            self.admitted += 1
+            self._ensure_thread()
+            self._work.notify()
+
+        if not ticket.wait(self.timeout):
+            with self._lock:
+                if ticket in sale.queue:
+                    # 还没有开始写入，撤销预留
+                    sale.queue.remove(ticket)
+                    sale.remaining += quantity
+                    raise FlashSaleRejected('排队超时，请稍后再试')
+            ticket.wait()  # 已在写入中，等待结果
+        if ticket.error:
+            raise FlashSaleRejected(ticket.error)
+        return ticket.result
+
+    # ---------- 后台写入 ----------
+
+    def _ensure_thread(self):
+        # 第一次有预留时启动（在 fork 出的 worker 进程中启动，而不是在主进程中）
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._run, name='flash-sale-committer', daemon=True)
+            self._thread.start()
+
+    def _next_batch(self):
+        with self._lock:
+            while True:
+                self._closing = [sale for sale in self._closing if sale.queue or sale.in_flight]
+                for sale in list(self._sales.values()) + self._closing:
+                    if sale.queue:
+                        count = min(self.batch_size, len(sale.queue))
+                        tickets = [sale.queue.popleft() for _ in range(count)]
+                        sale.in_flight += sum(ticket.quantity for ticket in tickets)
+                        return sale, tickets
+                self._work.wait()
+
+    def _run(self):
+        while True:
+            sale, tickets = self._next_batch()
+            try:
+                with self.app.app_context():
+                    stock = self._commit_batch(sale.product_id, tickets)
+            except Exception:
+                logger.exception('抢购商品 %s 写入失败', sale.product_id)
+                stock = None
+                for ticket in tickets:
+                    if not ticket.wait(0):
+                        ticket.fail('抢购失败，请重试')
+            with self._lock:
+                sale.in_flight -= sum(ticket.quantity for ticket in tickets)
+                if stock is not None:
+                    # 以数据库库存为准，扣除本进程仍在排队的预留（失败的预留在这里退回）
+                    sale.remaining = max(stock - sale.pending_quantity(), 0)
+                else:
+                    sale.remaining += sum(ticket.quantity for ticket in tickets)
+                self.batches += 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                'admitted': self.admitted,
+                'rejected': self.rejected,
+                'batches': self.batches,
+                'products': {
+                    product_id: {'remaining': sale.remaining, 'queued': len(sale.queue)}
+                    for product_id, sale in self._sales.items()
+                },
+            }
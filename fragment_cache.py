@@ -0,0 +1,84 @@
+"""页面片段缓存与条件请求（ETag / 304）
+
+- FragmentCache：商品卡片、兑换记录表格、管理员用户卡片等片段的渲染结果（HTML 或序列化后的数据）
+  保存在进程内 LRU 中。键里包含行版本（商品行的全部字段、用户最新一条积分流水的id、商品目录版本号等），
+  行被修改后使用新的键，旧条目不再被命中、按 LRU 淘汰，不需要主动失效；
+- conditional_page()：先按页面依赖的版本计算 ETag，浏览器带 If-None-Match 且没有变化时直接返回 304，
+  不查询页面数据也不渲染模板。页面因用户而异，使用 Cache-Control: private, no-cache，每次都向服务器确认。
+"""
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+
+from flask import make_response, render_template, request
+from markupsafe import Markup
+
+
+class FragmentCache:
+    def __init__(self, maxsize=4096):
+        self.maxsize = maxsize
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return self._entries[key]
+            self.misses += 1
+            return None
+
+    def put(self, key, value):
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def get_or_create(self, key, create):
+        value = self.get(key)
+        if value is None:
+            value = create()  # 不持有锁渲染，同一片段偶尔被并发请求重复渲染一次
+            self.put(key, value)
+        return value
+
+    def render(self, template_name, key, load=None, **context):
+        """渲染模板片段，key 相同时直接返回之前的结果；load() 返回渲染需要的数据，只在未命中时调用"""
+        def create():
+            if load is not None:
+                context.update(load())
+            return Markup(render_template(template_name, **context))
+        return self.get_or_create((template_name, key), create)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self._entries), 'maxsize': self.maxsize}
+
+
+def folder_version(folder):
+    """目录中各文件的修改时间和大小：部署新版本的模板或静态文件后，页面的 ETag 随之变化"""
+    parts = []
+    for name in sorted(os.listdir(folder)):
+        stat = os.stat(os.path.join(folder, name))
+        parts.append(f'{name}:{stat.st_mtime_ns}:{stat.st_size}')
+    return '|'.join(parts)
+
+
+def conditional_page(versions, render):
+    """versions 为页面依赖的全部版本（可 repr 的元组），未变化时返回 304，否则调用 render() 生成页面"""
+    etag = hashlib.blake2b(repr(versions).encode(), digest_size=12).hexdigest()
+    if request.if_none_match.contains(etag):
+        response = make_response('', 304)
+    else:
+        response = make_response(render())
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'private, no-cache'
+    response.vary.add('Cookie')
+    return response
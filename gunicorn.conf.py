@@ -0,0 +1,24 @@
+"""gunicorn 配置（Linux 生产环境）：gunicorn -c gunicorn.conf.py wsgi:app
+
+worker 数和线程数可以通过环境变量调整。SQLite 同一时刻只允许一个写入者，
+worker 过多只会增加写锁等待，一般 2~4 个进程、每个进程 8 个左右线程即可。
+"""
+import multiprocessing
+import os
+import subprocess
+import sys
+
+bind = os.environ.get('SHOP_BIND', '0.0.0.0:5000')
+workers = int(os.environ.get('SHOP_WORKERS', min(4, multiprocessing.cpu_count())))
+threads = int(os.environ.get('SHOP_THREADS', 8))
+worker_class = 'gthread'
+timeout = 120  # 大表格导入可能耗时较长
+keepalive = 5
+accesslog = '-'
+
+
+def on_starting(server):
+    # 在主进程启动 worker 之前执行一次数据库初始化。放在子进程中执行，主进程不导入 app：
+    # 否则数据库连接池、进程内缓存和实时事件的状态会在 fork 时被复制到每个 worker
+    subprocess.run([sys.executable, '-m', 'flask', '--app', 'app', 'init-db'],
+                   cwd=os.path.dirname(os.path.abspath(__file__)), check=True)
@@ -0,0 +1,137 @@
+"""商品图片处理：按内容哈希命名、去重，并生成不同尺寸的 WebP/JPEG 版本
+
+上传的原图保存为 <哈希>.<扩展名>，相同内容的图片只保存一份；
+同时生成 <哈希>_thumb / _card / _full 三种宽度的 .webp 和 .jpg，
+模板通过 srcset 让浏览器按需下载合适的尺寸。
+未安装 Pillow 时只做哈希命名和去重，页面回退为加载原图。
+安装了 Pillow 时先完整解码上传的文件，不是图片或文件不完整时抛出 ImageError，不写入任何文件。
+"""
+import hashlib
+import io
+import os
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # Pillow 为可选依赖
+    Image = None
+
+# 各尺寸的最大宽度（像素），不会放大比它小的原图
+VARIANTS = {'thumb': 160, 'card': 480, 'full': 1200}
+VARIANT_FORMATS = {'webp': 'WEBP', 'jpg': 'JPEG'}
+WEBP_QUALITY = 80
+JPEG_QUALITY = 82
+
+_EXTENSION_ALIASES = {'jpeg': 'jpg', 'mpo': 'jpg'}
+
+
+class ImageError(ValueError):
+    """上传的文件无法作为图片解码"""
+
+
+def content_hash(data):
+    return hashlib.sha256(data).hexdigest()[:32]
+
+
+def variant_name(picture, variant, fmt):
+    stem = os.path.splitext(picture)[0]
+    return f'{stem}_{variant}.{fmt}'
+
+
+def _detect_extension(data, filename):
+    """按图片内容确定扩展名；安装了 Pillow 时同时校验文件能完整解码"""
+    if Image is not None:
+        try:
+            with Image.open(io.BytesIO(data)) as img:
+                img.verify()
+                fmt = img.format.lower()
+            # verify() 不解码像素数据，截断的文件要 load() 才能发现
+            with Image.open(io.BytesIO(data)) as img:
+                img.load()
+        except (OSError, SyntaxError, ValueError, Image.DecompressionBombError) as e:
+            raise ImageError('无法识别的图片文件') from e
+        return _EXTENSION_ALIASES.get(fmt, fmt)
+    ext = filename.rsplit('.', 1)[-1].lower() if '.' in filename else 'bin'
+    return _EXTENSION_ALIASES.get(ext, ext)
+
+
+def generate_variants(folder, picture):
+    """为 folder/picture 生成所有尺寸的 WebP/JPEG 文件，已存在的跳过；返回新生成的文件名"""
+    if Image is None:
+        return []
+    created = []
+    with Image.open(os.path.join(folder, picture)) as source:
+        # 按EXIF方向旋转手机照片，动图只取第一帧
+        source = ImageOps.exif_transpose(source)
+        for variant, max_width in VARIANTS.items():
+            pending = [fmt for fmt in VARIANT_FORMATS
+                       if not os.path.exists(os.path.join(folder, variant_name(picture, variant, fmt)))]
+            if not pending:
+                continue
+            resized = source.copy()
+            resized.thumbnail((max_width, max_width * 4))
+            for fmt in pending:
+                image = resized
+                if fmt == 'jpg':
+                    image = _flatten(resized)
+                elif image.mode not in ('RGB', 'RGBA'):
+                    image = image.convert('RGBA')
+                name = variant_name(picture, variant, fmt)
+                options = {'quality': JPEG_QUALITY, 'optimize': True, 'progressive': True} \
+                    if fmt == 'jpg' else {'quality': WEBP_QUALITY, 'method': 4}
+                image.save(os.path.join(folder, name), VARIANT_FORMATS[fmt], **options)
+                created.append(name)
+    return created
+
+
+def _flatten(image):
+    # JPEG 不支持透明，透明区域填充白色
+    if image.mode in ('RGBA', 'LA') or (image.mode == 'P' and 'transparency' in image.info):
+        rgba = image.convert('RGBA')
+        background = Image.new('RGB', rgba.size, (255, 255, 255))
+        background.paste(rgba, mask=rgba.getchannel('A'))
+        return background
+    return image.convert('RGB')
+
+
+def store_image(folder, data, filename):
+    """按内容哈希保存图片并生成各尺寸版本，返回保存的文件名；相同内容的图片直接复用
+
+    文件无法作为图片解码时抛出 ImageError。
+    """
+    picture = f'{content_hash(data)}.{_detect_extension(data, filename)}'
+    path = os.path.join(folder, picture)
+    if not os.path.exists(path):
+        tmp_path = f'{path}.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    generate_variants(folder, picture)
+    return picture
+
+
+def remove_image(folder, picture):
+    """删除原图及其所有尺寸版本（调用方需确认没有其他商品引用）"""
+    names = [picture] + [variant_name(picture, variant, fmt) for variant in VARIANTS for fmt in VARIANT_FORMATS]
+    for name in names:
+        path = os.path.join(folder, name)
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def picture_sources(folder, picture, file_url):
+    """模板使用的图片地址：src 为卡片尺寸（无缩略图时为原图），以及 WebP/JPEG 的 srcset
+
+    file_url(文件名) 返回图片的访问地址。
+    """
+    if not os.path.exists(os.path.join(folder, variant_name(picture, 'card', 'jpg'))):
+        return {'src': file_url(picture), 'webp_srcset': '', 'jpeg_srcset': ''}
+
+    def srcset(fmt):
+        return ', '.join(f'{file_url(variant_name(picture, variant, fmt))} {width}w'
+                         for variant, width in VARIANTS.items())
+
+    return {
+        'src': file_url(variant_name(picture, 'card', 'jpg')),
+        'webp_srcset': srcset('webp'),
+        'jpeg_srcset': srcset('jpg'),
+    }
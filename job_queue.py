@@ -0,0 +1,239 @@
+"""后台任务队列：Excel导入、整理表格等耗时操作在后台线程中执行
+
+任务保存在数据库的 background_job 表中，上传文件和生成的结果文件保存在
+<任务目录>/<任务id>/ 下。请求只负责保存上传文件并登记任务，立即返回任务id，
+前端轮询任务状态显示进度，完成后下载结果文件。
+
+多个进程（gunicorn worker、flask run-jobs）可以同时取任务：
+取任务是一条带条件的 UPDATE，同一个任务只会被一个进程取到。
+进程中途退出时任务停留在 running 状态，超过 stale_after 秒没有进度更新的任务标记为失败。
+"""
+import json
+import logging
+import os
+import shutil
+import threading
+import time
+import uuid
+from datetime import datetime, timedelta
+
+from sqlalchemy import select, update
+
+JOB_QUEUED = 'queued'
+JOB_RUNNING = 'running'
+JOB_SUCCEEDED = 'succeeded'
+JOB_FAILED = 'failed'
+
+logger = logging.getLogger(__name__)
+
+
+class JobFailed(Exception):
+    """任务处理函数主动失败，消息直接展示给用户"""
+
+
+class JobContext:
+    """传给任务处理函数的对象：输入文件、工作目录、进度上报和结果文件"""
+
+    def __init__(self, queue, job):
+        self._queue = queue
+        self.job = job
+        self.id = job.id
+        self.params = json.loads(job.params) if job.params else {}
+        self.original_filename = job.original_filename
+        self.work_dir = queue.job_dir(job.id)
+        self.input_path = os.path.join(self.work_dir, job.input_name) if job.input_name else None
+        self._last_progress = 0.0
+
+    def progress(self, processed=None, failed=None, total=None, commit=True, force=False):
+        """更新进度；默认每 progress_interval 秒最多写一次数据库
+
+        commit=True 时在当前会话中提交，调用方未提交的修改（例如一批导入的数据）会一起提交。
+        commit='separate' 时用单独的连接写入进度，不结束当前会话的事务，
+        用于边读取查询结果边处理的任务（提交会关闭正在读取的结果集）。
+        """
+        if processed is not None:
+            self.job.processed_rows = processed
+        if failed is not None:
+            self.job.failed_rows = failed
+        if total is not None:
+            self.job.total_rows = total
+        now = time.monotonic()
+        if not force and now - self._last_progress < self._queue.progress_interval:
+            return
+        self._last_progress = now
+        self.job.heartbeat_at = datetime.utcnow()
+        if commit == 'separate':
+            with self._queue.db.engine.begin() as connection:
+                connection.execute(
+                    update(self._queue.model).where(self._queue.model.id == self.id).values(
+                        processed_rows=self.job.processed_rows, failed_rows=self.job.failed_rows,
+                        total_rows=self.job.total_rows, heartbeat_at=self.job.heartbeat_at)
+                )
+        elif commit:
+            self._queue.db.session.commit()
+
+    def artifact_path(self, filename):
+        return os.path.join(self.work_dir, filename)
+
+    def set_artifact(self, filename):
+        """登记 work_dir 下的结果文件，任务完成后可以下载"""
+        self.job.artifact_name = filename
+
+
+class JobQueue:
+    def __init__(self, db, model, root_dir, poll_interval=1.0, progress_interval=0.5,
+                 stale_after=300, retention_days=7):
+        self.db = db
+        self.model = model
+        self.root_dir = root_dir
+        self.poll_interval = poll_interval
+        self.progress_interval = progress_interval
+        self.stale_after = stale_after
+        self.retention_days = retention_days
+        self._handlers = {}
+        self._wakeup = threading.Event()
+        self._threads = []
+        self._last_maintenance = 0.0
+
+    def register(self, kind):
+        """注册任务处理函数：func(job: JobContext) 返回可JSON序列化的结果"""
+        def decorator(func):
+            self._handlers[kind] = func
+            return func
+        return decorator
+
+    def job_dir(self, job_id):
+        return os.path.join(self.root_dir, job_id)
+
+    # ---------- 提交与查询 ----------
+
+    def submit(self, kind, input_path=None, original_filename=None, created_by=None, params=None):
+        """登记任务，input_path 指向的文件移动到任务目录；返回任务id"""
+        if kind not in self._handlers:
+            raise ValueError(f'未知的任务类型: {kind}')
+        job_id = uuid.uuid4().hex
+        work_dir = self.job_dir(job_id)
+        os.makedirs(work_dir, exist_ok=True)
+        input_name = None
+        if input_path:
+            input_name = 'input' + os.path.splitext(original_filename or input_path)[1]
+            shutil.move(input_path, os.path.join(work_dir, input_name))
+        self.db.session.add(self.model(
+            id=job_id, kind=kind, status=JOB_QUEUED, created_by=created_by,
+            original_filename=original_filename, input_name=input_name,
+            params=json.dumps(params, ensure_ascii=False) if params else None,
+            created_at=datetime.utcnow()
+        ))
+        self.db.session.commit()
+        self._wakeup.set()
+        return job_id
+
+    def get(self, job_id):
+        return self.db.session.get(self.model, job_id)
+
+    def artifact_file(self, job):
+        if job.status != JOB_SUCCEEDED or not job.artifact_name:
+            return None
+        path = os.path.join(self.job_dir(job.id), job.artifact_name)
+        return path if os.path.isfile(path) else None
+
+    # ---------- 执行 ----------
+
+    def claim(self):
+        """取出最早的排队任务并标记为运行中，没有任务时返回 None"""
+        model = self.model
+        now = datetime.utcnow()
+        oldest = select(model.id).where(model.status == JOB_QUEUED) \
+            .order_by(model.created_at).limit(1).scalar_subquery()
+        job_id = self.db.session.execute(
+            update(model)
+            .where(model.id == oldest, model.status == JOB_QUEUED)
+            .values(status=JOB_RUNNING, started_at=now, heartbeat_at=now)
+            .returning(model.id)
+            .execution_options(synchronize_session=False)
+        ).scalar()
+        self.db.session.commit()
+        return job_id
+
+    def run_job(self, job_id):
+        job = self.db.session.get(self.model, job_id, populate_existing=True)
+        context = JobContext(self, job)
+        try:
+            result = self._handlers[job.kind](context)
+        except Exception as e:
+            self.db.session.rollback()
+            job = self.db.session.get(self.model, job_id, populate_existing=True)
+            if isinstance(e, JobFailed):
+                job.error = str(e)
+            else:
+                logger.exception('后台任务 %s (%s) 失败', job_id, job.kind)
+                job.error = f'处理失败: {e}'
+            job.status = JOB_FAILED
+        else:
+            job.status = JOB_SUCCEEDED
+            job.result = json.dumps(result, ensure_ascii=False, default=str)
+        job.finished_at = datetime.utcnow()
+        self.db.session.commit()
+        return job.status
+
+    def run_pending(self):
+        """执行所有排队中的任务，返回执行的任务数"""
+        count = 0
+        while True:
+            job_id = self.claim()
+            if job_id is None:
+                return count
+            self.run_job(job_id)
+            self.db.session.remove()
+            count += 1
+
+    def maintain(self):
+        """把长时间没有进度的运行中任务标记为失败，并删除过期任务及其文件"""
+        model = self.model
+        now = datetime.utcnow()
+        self.db.session.execute(
+            update(model)
+            .where(model.status == JOB_RUNNING, model.heartbeat_at < now - timedelta(seconds=self.stale_after))
+            .values(status=JOB_FAILED, error='任务中断（处理进程已退出），请重新提交', finished_at=now)
+            .execution_options(synchronize_session=False)
+        )
+        expired = self.db.session.execute(
+            select(model.id).where(model.status.in_([JOB_SUCCEEDED, JOB_FAILED]),
+                                   model.finished_at < now - timedelta(days=self.retention_days))
+        ).scalars().all()
+        if expired:
+            self.db.session.execute(
+                model.__table__.delete().where(model.id.in_(expired))
+            )
+        self.db.session.commit()
+        for job_id in expired:
+            shutil.rmtree(self.job_dir(job_id), ignore_errors=True)
+
+    def _loop(self, app, stop):
+        while not stop.is_set():
+            try:
+                with app.app_context():
+                    if time.monotonic() - self._last_maintenance > 3600:
+                        self._last_maintenance = time.monotonic()
+                        self.maintain()
+                    ran = self.run_pending()
+            except Exception:
+                logger.exception('后台任务线程出错')
+                ran = 0
+            if not ran:
+                # 本进程提交任务时立即唤醒，其他进程提交的任务最多等待 poll_interval 秒
+                self._wakeup.wait(self.poll_interval)
+                self._wakeup.clear()
+
+    def start(self, app, threads=1):
+        """启动后台线程（守护线程，随进程退出）；返回用于停止线程的 Event"""
+        stop = threading.Event()
+        for index in range(threads):
+            thread = threading.Thread(target=self._loop, args=(app, stop), name=f'job-worker-{index}', daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        return stop
+
+    def run_forever(self, app):
+        """独立进程中持续执行任务（flask run-jobs）"""
+        self._loop(app, threading.Event())
@@ -0,0 +1,244 @@
+"""数据库版本化迁移
+
+每个迁移有一个递增的版本号，已执行的版本记录在 schema_migrations 表中，
+启动时只执行尚未执行过的迁移。新增迁移时在文件末尾追加一个 @migration 函数即可，
+不要修改已经发布的迁移。
+"""
+from datetime import datetime
+
+from sqlalchemy import inspect, text
+
+from auth import BULK_HASH_METHOD, hash_password, is_password_hash
+from user_search import create_search_index
+
+MIGRATIONS = []
+
+
+def migration(version, description):
+    def decorator(func):
+        MIGRATIONS.append((version, description, func))
+        return func
+    return decorator
+
+
+def _add_column_if_missing(connection, table, column, ddl):
+    columns = {col['name'] for col in inspect(connection).get_columns(table)}
+    if column not in columns:
+        connection.execute(text(f'ALTER TABLE "{table}" ADD COLUMN {column} {ddl}'))
+
+
+@migration(1, '用户表增加学院字段')
+def add_user_college(connection):
+    _add_column_if_missing(connection, 'user', 'college', 'VARCHAR(100)')
+
+
+@migration(2, '用户表增加剩余爱心币字段')
+def add_user_remaining_points(connection):
+    _add_column_if_missing(connection, 'user', 'remaining_points', 'INTEGER DEFAULT 0')
+
+
+@migration(3, '购买记录增加限购统计和历史记录查询用的索引')
+def add_purchase_record_indexes(connection):
+    # 购买时的本月限购统计：WHERE user_id=? AND product_id=? AND purchase_time>=?
+    connection.execute(text(
+        'CREATE INDEX IF NOT EXISTS ix_purchase_record_user_product_time '
+        'ON purchase_record (user_id, product_id, purchase_time)'
+    ))
+    # 商品页的兑换记录：WHERE user_id=? ORDER BY purchase_time DESC
+    connection.execute(text(
+        'CREATE INDEX IF NOT EXISTS ix_purchase_record_user_time '
+        'ON purchase_record (user_id, purchase_time)'
+    ))
+
+
+@migration(4, '增加月度限购计数表并根据购买记录回填')
+def add_purchase_counter(connection):
+    connection.execute(text(
+        'CREATE TABLE IF NOT EXISTS purchase_counter ('
+        'user_id INTEGER NOT NULL REFERENCES user (id), '
+        'product_id INTEGER NOT NULL REFERENCES product (id), '
+        'year_month VARCHAR(7) NOT NULL, '
+        'quantity INTEGER NOT NULL, '
+        'PRIMARY KEY (user_id, product_id, year_month))'
+    ))
+    connection.execute(text(
+        "INSERT OR REPLACE INTO purchase_counter (user_id, product_id, year_month, quantity) "
+        "SELECT user_id, product_id, strftime('%Y-%m', purchase_time), SUM(quantity) "
+        "FROM purchase_record GROUP BY user_id, product_id, strftime('%Y-%m', purchase_time)"
+    ))
+
+
+@migration(5, '增加进程间共享的缓存版本号表')
+def add_cache_version(connection):
+    connection.execute(text(
+        'CREATE TABLE IF NOT EXISTS cache_version ('
+        'name VARCHAR(50) PRIMARY KEY, '
+        'version INTEGER NOT NULL)'
+    ))
+
+
+@migration(6, '明文密码改为加盐哈希')
+def hash_plaintext_passwords(connection):
+    # 已有的明文密码使用低成本哈希，用户下次登录时按正式配置重新哈希
+    rows = connection.execute(text('SELECT id, password FROM "user"')).fetchall()
+    updates = [
+        {'id': user_id, 'password': hash_password(password or '', BULK_HASH_METHOD)}
+        for user_id, password in rows if not is_password_hash(password)
+    ]
+    if updates:
+        connection.execute(text('UPDATE "user" SET password = :password WHERE id = :id'), updates)
+
+
+@migration(7, '增加积分流水表，购买记录保存单价和实际扣除积分')
+def add_points_ledger(connection):
+    connection.execute(text(
+        'CREATE TABLE IF NOT EXISTS points_ledger ('
+        'id INTEGER PRIMARY KEY, '
+        'user_id INTEGER NOT NULL REFERENCES user (id), '
+        'kind VARCHAR(20) NOT NULL, '
+        'delta INTEGER NOT NULL, '
+        'balance_after INTEGER NOT NULL, '
+        'purchase_record_id INTEGER, '
+        'note VARCHAR(200), '
+        'created_at DATETIME NOT NULL)'
+    ))
+    connection.execute(text('CREATE INDEX IF NOT EXISTS ix_points_ledger_user_id ON points_ledger (user_id, id)'))
+
+    # 历史购买记录按当前商品价格回填（此前没有保存购买时的价格）
+    _add_column_if_missing(connection, 'purchase_record', 'unit_price', 'INTEGER')
+    _add_column_if_missing(connection, 'purchase_record', 'total_cost', 'INTEGER')
+    current_price = ('CAST(ROUND(COALESCE((SELECT price FROM product '
+                     'WHERE product.id = purchase_record.product_id), 0)) AS INTEGER)')
+    connection.execute(text(
+        f'UPDATE purchase_record SET unit_price = {current_price}, total_cost = quantity * {current_price} '
+        'WHERE unit_price IS NULL'
+    ))
+
+    # 余额改为整数，并以当前余额作为每个用户的期初流水
+    connection.execute(text('UPDATE "user" SET points = CAST(ROUND(COALESCE(points, 0)) AS INTEGER)'))
+    connection.execute(text(
+        "INSERT INTO points_ledger (user_id, kind, delta, balance_after, note, created_at) "
+        "SELECT id, 'opening', points, points, '启用积分流水时的余额', :now FROM \"user\" "
+        "WHERE points != 0 AND id NOT IN (SELECT user_id FROM points_ledger)"
+    ), {'now': datetime.utcnow()})
+
+
+@migration(8, '增加后台任务表')
+def add_background_job(connection):
+    connection.execute(text(
+        'CREATE TABLE IF NOT EXISTS background_job ('
+        'id VARCHAR(32) PRIMARY KEY, '
+        'kind VARCHAR(50) NOT NULL, '
+        'status VARCHAR(20) NOT NULL, '
+        'created_by INTEGER, '
+        'original_filename VARCHAR(255), '
+        'input_name VARCHAR(255), '
+        'params TEXT, '
+        'processed_rows INTEGER NOT NULL DEFAULT 0, '
+        'failed_rows INTEGER NOT NULL DEFAULT 0, '
+        'total_rows INTEGER, '
+        'result TEXT, '
+        'error TEXT, '
+        'artifact_name VARCHAR(255), '
+        'created_at DATETIME NOT NULL, '
+        'started_at DATETIME, '
+        'heartbeat_at DATETIME, '
+        'finished_at DATETIME)'
+    ))
+    connection.execute(text(
+        'CREATE INDEX IF NOT EXISTS ix_background_job_status_created ON background_job (status, created_at)'
+    ))
+
+
+@migration(9, '购买记录增加按时间区间统计用的索引')
+def add_purchase_record_time_index(connection):
+    # 统计报表和导出：WHERE purchase_time >= ? AND purchase_time < ?
+    connection.execute(text(
+        'CREATE INDEX IF NOT EXISTS ix_purchase_record_time ON purchase_record (purchase_time)'
+    ))
+
+
+@migration(10, '增加学生搜索的全文索引（FTS5 trigram）及同步触发器')
+def add_user_search_index(connection):
+    # SQLite 不支持 trigram 分词器时跳过，搜索回退到 LIKE 查询；升级后可执行 flask rebuild-search-index
+    create_search_index(connection)
+
+
+@migration(11, '商品表增加抢购模式字段')
+def add_product_flash_sale(connection):
+    _add_column_if_missing(connection, 'product', 'flash_sale', 'BOOLEAN NOT NULL DEFAULT 0')
+
+
+@migration(12, '增加花名册指纹表，用于差异同步导入')
+def add_roster_fingerprint(connection):
+    connection.execute(text(
+        'CREATE TABLE IF NOT EXISTS roster_fingerprint ('
+        'username VARCHAR(80) PRIMARY KEY, '
+        'row_hash VARCHAR(32) NOT NULL, '
+        'imported_at DATETIME NOT NULL)'
+    ))
+
+
+@migration(13, '增加兑换记录归档清单表')
+def add_archive_manifest(connection):
+    connection.execute(text(
+        'CREATE TABLE IF NOT EXISTS archive_manifest ('
+        'batch_id VARCHAR(32) PRIMARY KEY, '
+        'period VARCHAR(9) NOT NULL, '
+        'start_time DATETIME NOT NULL, '
+        'end_time DATETIME NOT NULL, '
+        'filename VARCHAR(200) NOT NULL, '
+        'record_count INTEGER NOT NULL, '
+        'total_quantity INTEGER NOT NULL, '
+        'total_cost INTEGER NOT NULL, '
+        'archived_at DATETIME NOT NULL)'
+    ))
+    connection.execute(text(
+        'CREATE INDEX IF NOT EXISTS ix_archive_manifest_period ON archive_manifest (period)'
+    ))
+
+
+def _ensure_version_table(engine):
+    with engine.begin() as connection:
+        connection.execute(text(
+            'CREATE TABLE IF NOT EXISTS schema_migrations ('
+            'version INTEGER PRIMARY KEY, '
+            'description VARCHAR(200) NOT NULL, '
+            'applied_at DATETIME NOT NULL)'
+        ))
+
+
+def current_version(engine):
+    _ensure_version_table(engine)
+    with engine.connect() as connection:
+        return connection.execute(text('SELECT MAX(version) FROM schema_migrations')).scalar() or 0
+
+
+def run_migrations(engine, log=print):
+    """按版本顺序执行未执行的迁移，每个迁移在独立事务中执行并记录版本，返回本次执行的版本号"""
+    applied = []
+    version = current_version(engine)
+    for migration_version, description, func in sorted(MIGRATIONS, key=lambda m: m[0]):
+        if migration_version <= version:
+            continue
+        with engine.begin() as connection:
+            func(connection)
+            connection.execute(
+                text('INSERT INTO schema_migrations (version, description, applied_at) '
+                     'VALUES (:version, :description, :applied_at)'),
+                {'version': migration_version, 'description': description, 'applied_at': datetime.utcnow()}
+            )
+        log(f'数据库迁移 {migration_version}：{description}')
+        applied.append(migration_version)
+    return applied
+
+
+def explain_query_plan(connection, statement):
+    """返回SQLite对语句的 EXPLAIN QUERY PLAN 结果（每个步骤的描述文本）"""
+    compiled = statement.compile(dialect=connection.dialect)
+    params = compiled.construct_params()
+    values = tuple(params[name] for name in compiled.positiontup)
+    # 执行计划与参数值无关，日期等参数转成字符串即可
+    values = tuple(str(value) if isinstance(value, datetime) else value for value in values)
+    rows = connection.exec_driver_sql(f'EXPLAIN QUERY PLAN {compiled}', values).fetchall()
+    return [row[-1] for row in rows]
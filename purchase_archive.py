@@ -0,0 +1,259 @@
+"""历史兑换记录归档：已结束学年的购买记录移到按学年划分的 SQLite 文件
+
+purchase_record 只增不减，几年后主库中大部分记录属于早已结束的学年，却仍占用页面缓存、拖慢兑换记录查询和备份。
+归档把一个已结束学年（默认每年9月1日开始）的记录复制到 <归档目录>/purchases_<学年>.db，核对后从主库删除：
+- 归档文件中每条记录附带学号、姓名、学院和商品名称的快照，单独打开也能看懂；
+- 主库的 archive_manifest 表登记每次归档（批次）的学年、文件名、记录数和合计。报表和导出按统计区间
+  ATTACH 需要的归档文件，与主库的记录 UNION ALL 后统计，结果与归档前一致；
+- 归档期间持有主库写锁，复制和删除之间不会有新的购买或退货。归档文件先提交，主库再在一个事务中登记批次并删除记录；
+  中途失败时归档文件中留下的是未登记的批次，查询时不计入，下次归档时删除后重新复制；
+- 归档学年的月度限购计数一并删除（限购只看当月的计数）。
+"""
+import logging
+import os
+import uuid
+from contextlib import contextmanager
+from datetime import datetime
+
+from sqlalchemy import text
+from sqlalchemy.exc import OperationalError
+
+from reports import PurchaseSource, LIVE_PURCHASES
+
+logger = logging.getLogger(__name__)
+
+ARCHIVE_VERSION = 'archive'  # 归档后递增：主库中的兑换记录减少，兑换记录片段随之失效
+
+COLUMNS = 'id, user_id, product_id, quantity, purchase_time, unit_price, total_cost'
+
+ARCHIVE_SCHEMA = (
+    'CREATE TABLE IF NOT EXISTS {schema}.purchase_record ('
+    'id INTEGER PRIMARY KEY, '
+    'user_id INTEGER NOT NULL, '
+    'product_id INTEGER NOT NULL, '
+    'quantity INTEGER NOT NULL, '
+    'purchase_time DATETIME NOT NULL, '
+    'unit_price INTEGER, '
+    'total_cost INTEGER, '
+    'username VARCHAR(80), '
+    'name VARCHAR(100), '
+    'college VARCHAR(100), '
+    'product_name VARCHAR(80), '
+    'batch_id VARCHAR(32) NOT NULL)',
+    'CREATE INDEX IF NOT EXISTS {schema}.ix_purchase_record_time ON purchase_record (purchase_time)',
+    'CREATE INDEX IF NOT EXISTS {schema}.ix_purchase_record_user_time ON purchase_record (user_id, purchase_time)',
+)
+
+# 只统计已在主库登记的批次
+FINALIZED = 'batch_id IN (SELECT batch_id FROM main.archive_manifest)'
+
+
+class ArchiveError(Exception):
+    """归档参数错误、归档文件缺失或核对不一致，消息直接显示给管理员"""
+
+
+def academic_year_of(moment, start_month=9):
+    """moment 所在学年的起始年份"""
+    return moment.year if moment.month >= start_month else moment.year - 1
+
+
+def academic_year_bounds(year, start_month=9):
+    """学年的时间区间 [start, end)"""
+    return datetime(year, start_month, 1), datetime(year + 1, start_month, 1)
+
+
+def period_label(year):
+    return f'{year}-{year + 1}'
+
+
+def archive_filename(year):
+    return f'purchases_{period_label(year)}.db'
+
+
+def _schema(year):
+    return f'archive_{year}'
+
+
+def _time(moment):
+    return moment.strftime('%Y-%m-%d %H:%M:%S')
+
+
+def _range_params(year, start_month):
+    start, end = academic_year_bounds(year, start_month)
+    return {'start': _time(start), 'end': _time(end)}
+
+
+def _totals(connection, table, params, extra=''):
+    row = connection.execute(text(
+        'SELECT COUNT(*), COALESCE(SUM(quantity), 0), COALESCE(SUM(total_cost), 0), COALESCE(SUM(id), 0) '
+        f'FROM {table} WHERE purchase_time >= :start AND purchase_time < :end {extra}'
+    ), params).one()
+    return {'record_count': row[0], 'total_quantity': row[1], 'total_cost': row[2], 'id_sum': row[3]}
+
+
+# ---------- 归档 ----------
+
+def pending_years(connection, now=None, start_month=9):
+    """主库中仍有记录的已结束学年：[(学年, 记录数, 件数, 积分)]，按时间顺序"""
+    oldest = connection.execute(text('SELECT MIN(purchase_time) FROM purchase_record')).scalar()
+    if oldest is None:
+        return []
+    if isinstance(oldest, str):
+        oldest = datetime.strptime(oldest[:19], '%Y-%m-%d %H:%M:%S')
+    current = academic_year_of(now or datetime.utcnow(), start_month)
+    years = []
+    for year in range(academic_year_of(oldest, start_month), current):
+        totals = _totals(connection, 'purchase_record', _range_params(year, start_month))
+        if totals['record_count']:
+            years.append((year, totals['record_count'], totals['total_quantity'], totals['total_cost']))
+    return years
+
+
+def archive_year(engine, archive_dir, year, start_month=9, now=None):
+    """把一个已结束学年的记录移到归档文件，返回本次归档的批次（dict）；主库中没有该学年的记录时返回 None"""
+    start, end = academic_year_bounds(year, start_month)
+    if end > (now or datetime.utcnow()):
+        raise ArchiveError(f'{period_label(year)} 学年尚未结束')
+    params = _range_params(year, start_month)
+    batch_id = uuid.uuid4().hex
+    with engine.connect() as lock_connection, engine.connect() as copy_connection:
+        # 先取得主库写锁再复制：复制到删除之间不会有新的购买或退货
+        lock_connection.exec_driver_sql('BEGIN IMMEDIATE')
+        try:
+            with attached(copy_connection, archive_dir, [year], create=True) as (schema,):
+                copied = _copy(copy_connection, schema, batch_id, params)
+                copy_connection.commit()
+            if not copied['record_count']:
+                lock_connection.rollback()
+                return None
+            if _totals(lock_connection, 'purchase_record', params) != copied:
+                raise ArchiveError(f'{period_label(year)} 学年归档文件与主库记录不一致，未删除主库记录')
+            batch = {
+                'batch_id': batch_id, 'period': period_label(year), 'start_time': params['start'],
+                'end_time': params['end'], 'filename': archive_filename(year),
+                'record_count': copied['record_count'], 'total_quantity': copied['total_quantity'],
+                'total_cost': copied['total_cost'], 'archived_at': datetime.utcnow(),
+            }
+            _finalize(lock_connection, batch, start_month)
+            lock_connection.commit()
+        except Exception:
+            lock_connection.rollback()
+            raise
+    return batch
+
+
+def _copy(connection, schema, batch_id, params):
+    """把主库中该学年的记录复制到归档文件（尚未提交），返回复制的记录合计"""
+    for statement in ARCHIVE_SCHEMA:
+        connection.exec_driver_sql(statement.format(schema=schema))
+    # 之前中断的归档留下的未登记批次：对应的记录仍在主库中，重新复制
+    connection.execute(text(f'DELETE FROM {schema}.purchase_record WHERE NOT {FINALIZED}'))
+    connection.execute(text(
+        f'INSERT INTO {schema}.purchase_record ({COLUMNS}, username, name, college, product_name, batch_id) '
+        'SELECT r.id, r.user_id, r.product_id, r.quantity, r.purchase_time, r.unit_price, r.total_cost, '
+        'u.username, u.name, u.college, p.name, :batch_id '
+        'FROM main.purchase_record r '
+        'LEFT JOIN main."user" u ON u.id = r.user_id '
+        'LEFT JOIN main.product p ON p.id = r.product_id '
+        'WHERE r.purchase_time >= :start AND r.purchase_time < :end'
+    ), dict(params, batch_id=batch_id))
+    return _totals(connection, f'{schema}.purchase_record', dict(params, batch_id=batch_id),
+                   'AND batch_id = :batch_id')
+
+
+def _finalize(connection, batch, start_month):
+    """在持有写锁的主库事务中登记批次、删除记录和对应月份的限购计数"""
+    connection.execute(text(
+        'INSERT INTO archive_manifest (batch_id, period, start_time, end_time, filename, record_count, '
+        'total_quantity, total_cost, archived_at) VALUES (:batch_id, :period, :start_time, :end_time, '
+        ':filename, :record_count, :total_quantity, :total_cost, :archived_at)'
+    ), batch)
+    year = int(batch['period'][:4])
+    connection.execute(text(
+        'DELETE FROM purchase_counter WHERE year_month >= :start AND year_month < :end'
+    ), {'start': f'{year}-{start_month:02d}', 'end': f'{year + 1}-{start_month:02d}'})
+    connection.execute(text(
+        'DELETE FROM purchase_record WHERE purchase_time >= :start AND purchase_time < :end'
+    ), {'start': batch['start_time'], 'end': batch['end_time']})
+    connection.execute(text(
+        'INSERT INTO cache_version (name, version) VALUES (:name, 1) '
+        'ON CONFLICT (name) DO UPDATE SET version = version + 1'
+    ), {'name': ARCHIVE_VERSION})
+
+
+def list_archives(connection):
+    """已归档的学年及合计（同一学年可能分多次归档）"""
+    return [dict(row._mapping) for row in connection.execute(text(
+        'SELECT period, filename, COUNT(*) AS batches, SUM(record_count) AS record_count, '
+        'SUM(total_quantity) AS total_quantity, SUM(total_cost) AS total_cost, MAX(archived_at) AS archived_at '
+        'FROM archive_manifest GROUP BY period, filename ORDER BY period'
+    ))]
+
+
+# ---------- 查询 ----------
+
+def archived_years(connection, report_range=None):
+    """与统计区间重叠的已归档学年，从新到旧；report_range 为 None 时返回全部"""
+    clauses, params = [], {}
+    if report_range is not None:
+        if report_range.end:
+            clauses.append('start_time < :end')
+            params['end'] = _time(report_range.end)
+        if report_range.start:
+            clauses.append('end_time > :start')
+            params['start'] = _time(report_range.start)
+    where = 'WHERE ' + ' AND '.join(clauses) if clauses else ''
+    periods = connection.execute(text(
+        f'SELECT DISTINCT period FROM archive_manifest {where} ORDER BY period DESC'
+    ), params).scalars()
+    return [int(period[:4]) for period in periods]
+
+
+@contextmanager
+def attached(connection, archive_dir, years, create=False):
+    """把各学年的归档文件 ATTACH 到 connection（必须不在事务中），返回各自的 schema 名，结束时分离
+
+    create 为 False 时归档文件必须已经存在（否则 ATTACH 会创建一个空文件）。
+    """
+    present = {row[1] for row in connection.exec_driver_sql('PRAGMA database_list')}
+    if create:
+        os.makedirs(archive_dir, exist_ok=True)
+    schemas = []
+    try:
+        for year in years:
+            schema = _schema(year)
+            if schema not in present:
+                path = os.path.join(archive_dir, archive_filename(year))
+                if not create and not os.path.exists(path):
+                    raise ArchiveError(f'缺少归档文件 {path}')
+                connection.exec_driver_sql(f'ATTACH DATABASE ? AS {schema}', (path,))
+                present.add(schema)
+            schemas.append(schema)
+        yield tuple(schemas)
+    finally:
+        for schema in schemas:
+            try:
+                connection.exec_driver_sql(f'DETACH DATABASE {schema}')
+            except OperationalError:
+                # 查询尚未结束（例如导出中途断开），保留到连接下次使用时再分离
+                logger.warning('分离归档文件 %s 失败', schema)
+
+
+def purchase_source(schemas, report_range=None):
+    """报表使用的购买记录来源：主库与各归档文件中已登记批次的 UNION ALL，别名仍为 purchase_record
+
+    区间条件同时写进每个分支，各自使用 purchase_time 索引，不需要先合并全部记录。
+    """
+    if not schemas:
+        return LIVE_PURCHASES
+    clauses, _ = report_range.conditions('purchase_time') if report_range is not None else ([], {})
+    branches = [f'SELECT {COLUMNS} FROM main.purchase_record'
+                + (' WHERE ' + ' AND '.join(clauses) if clauses else '')]
+    branches += [f'SELECT {COLUMNS} FROM {schema}.purchase_record WHERE ' + ' AND '.join([FINALIZED] + clauses)
+                 for schema in schemas]
+    # 最近兑换时间：主库中的记录都比归档的新，依次查主库和从新到旧的归档文件，取第一个非空值
+    latest = ['(SELECT MAX(purchase_time) FROM main.purchase_record WHERE user_id = u.id)']
+    latest += [f'(SELECT MAX(purchase_time) FROM {schema}.purchase_record WHERE user_id = u.id AND {FINALIZED})'
+               for schema in schemas]
+    return PurchaseSource(table='(' + ' UNION ALL '.join(branches) + ') AS purchase_record',
+                          last_purchase='COALESCE(' + ', '.join(latest) + ')')
@@ -0,0 +1,340 @@
+"""兑换统计报表与导出
+
+每个报表是一条按学院/商品/月份分组的SQL，直接在数据库中汇总，不把购买记录加载到内存：
+- college_monthly：各学院每月消耗的积分、兑换件数和人数
+- top_products：兑换最多的商品
+- stock_turnover：商品售出数量、当前库存、售罄率和按当前速度可售天数
+- unused_balance：仍有积分未使用的学生（按学院汇总 + 余额最多的学生）
+
+报表结果缓存在进程内，键为（报表名, 参数），数据库中的缓存版本号（购买/退货/库存、商品、用户）
+任一变化时整体失效，与商品目录缓存使用同一套版本号，多进程部署时同样生效。
+
+导出逐行读取查询结果：CSV 边查询边输出，XLSX 用 write_only 工作簿写入临时文件，
+内存占用与导出的行数无关。
+
+已结束学年的记录归档到单独的文件后（见 purchase_archive.py），报表查询的 purchase_record 换成
+主库与归档文件的 UNION ALL（PurchaseSource），统计结果与归档前一致。
+"""
+import codecs
+import csv
+import io
+import threading
+from collections import OrderedDict, namedtuple
+from datetime import datetime, timedelta
+
+from openpyxl import Workbook
+from sqlalchemy import text
+
+from catalog_cache import CATALOG_VERSION, STOCK_VERSION
+
+USERS_VERSION = 'users'  # 用户的学院、余额等字段（新建、修改、删除、导入时递增）
+
+# 报表依赖的缓存版本号：购买和退货会递增库存版本号
+REPORT_VERSIONS = (STOCK_VERSION, CATALOG_VERSION, USERS_VERSION)
+
+NO_COLLEGE = '未填写'
+
+# 报表查询的购买记录来源：table 为 FROM 中的 purchase_record（表名或别名为 purchase_record 的子查询），
+# last_purchase 为学生（别名 u）最近一次兑换时间的表达式
+PurchaseSource = namedtuple('PurchaseSource', ['table', 'last_purchase'])
+LIVE_PURCHASES = PurchaseSource(
+    table='purchase_record',
+    last_purchase='(SELECT MAX(purchase_time) FROM purchase_record WHERE purchase_record.user_id = u.id)',
+)
+
+
+class ReportError(ValueError):
+    """报表参数错误，消息直接返回给用户"""
+
+
+class ReportRange:
+    """统计区间 [start, end)，两端都可以为空（不限）"""
+
+    def __init__(self, start=None, end=None):
+        self.start = start
+        self.end = end
+
+    @classmethod
+    def parse(cls, start, end):
+        """解析 YYYY-MM-DD 格式的起止日期，结束日期包含当天"""
+        try:
+            start = datetime.strptime(start, '%Y-%m-%d') if start else None
+            end = datetime.strptime(end, '%Y-%m-%d') + timedelta(days=1) if end else None
+        except ValueError:
+            raise ReportError('日期格式应为 YYYY-MM-DD')
+        if start and end and start >= end:
+            raise ReportError('开始日期不能晚于结束日期')
+        return cls(start, end)
+
+    def key(self):
+        return (self.start, self.end)
+
+    def conditions(self, column='purchase_record.purchase_time'):
+        """WHERE 条件和参数；时间按字符串比较（SQLite 中日期时间以 ISO 格式文本保存）"""
+        clauses, params = [], {}
+        if self.start:
+            clauses.append(f'{column} >= :start')
+            params['start'] = self.start.strftime('%Y-%m-%d %H:%M:%S')
+        if self.end:
+            clauses.append(f'{column} < :end')
+            params['end'] = self.end.strftime('%Y-%m-%d %H:%M:%S')
+        return clauses, params
+
+    def days(self, now):
+        """区间天数，用于计算日均销量；未指定开始日期时返回 None"""
+        if not self.start:
+            return None
+        end = min(self.end, now) if self.end else now
+        return max((end - self.start).total_seconds() / 86400, 1)
+
+    def label(self):
+        start = self.start.strftime('%Y-%m-%d') if self.start else '最早'
+        end = (self.end - timedelta(days=1)).strftime('%Y-%m-%d') if self.end else '至今'
+        return f'{start}_{end}'
+
+
+def _where(clauses, prefix='WHERE'):
+    return f'{prefix} ' + ' AND '.join(clauses) if clauses else ''
+
+
+# ---------- 报表查询 ----------
+
+def college_monthly_statement(report_range, source=LIVE_PURCHASES):
+    clauses, params = report_range.conditions()
+    return text(
+        "SELECT COALESCE(NULLIF(u.college, ''), :no_college) AS college, "
+        "strftime('%Y-%m', purchase_record.purchase_time) AS month, "
+        "SUM(purchase_record.total_cost) AS points, SUM(purchase_record.quantity) AS quantity, "
+        "COUNT(*) AS orders, COUNT(DISTINCT purchase_record.user_id) AS students "
+        f'FROM {source.table} JOIN "user" u ON u.id = purchase_record.user_id '
+        f'{_where(clauses)} '
+        'GROUP BY 1, 2 ORDER BY 2, 3 DESC'
+    ).bindparams(no_college=NO_COLLEGE, **params)
+
+
+def top_products_statement(report_range, limit=None, source=LIVE_PURCHASES):
+    clauses, params = report_range.conditions()
+    sql = (
+        'SELECT product.id AS product_id, product.name AS name, '
+        'SUM(purchase_record.quantity) AS quantity, SUM(purchase_record.total_cost) AS points, '
+        'COUNT(*) AS orders, COUNT(DISTINCT purchase_record.user_id) AS students '
+        f'FROM {source.table} JOIN product ON product.id = purchase_record.product_id '
+        f'{_where(clauses)} '
+        'GROUP BY product.id ORDER BY quantity DESC, product.id'
+    )
+    if limit:
+        sql += ' LIMIT :limit'
+        params['limit'] = limit
+    return text(sql).bindparams(**params)
+
+
+def stock_turnover_statement(report_range, source=LIVE_PURCHASES):
+    # 区间条件放在 JOIN 上，没有销量的商品也会列出
+    clauses, params = report_range.conditions()
+    return text(
+        'SELECT product.id AS product_id, product.name AS name, product.stock AS stock, '
+        'COALESCE(SUM(purchase_record.quantity), 0) AS sold, COUNT(purchase_record.id) AS orders '
+        f'FROM product LEFT JOIN {source.table} ON purchase_record.product_id = product.id '
+        f'{_where(clauses, "AND")} '
+        'GROUP BY product.id ORDER BY sold DESC, product.id'
+    ).bindparams(**params)
+
+
+def unused_balance_by_college_statement(min_points):
+    return text(
+        "SELECT COALESCE(NULLIF(college, ''), :no_college) AS college, "
+        'COUNT(*) AS students, SUM(points) AS points '
+        'FROM "user" WHERE COALESCE(is_admin, 0) = 0 AND points >= :min_points '
+        'GROUP BY 1 ORDER BY points DESC'
+    ).bindparams(no_college=NO_COLLEGE, min_points=min_points)
+
+
+def unused_balance_students_statement(min_points, limit=None, source=LIVE_PURCHASES):
+    # 最近一次兑换时间用相关子查询，按 (user_id, purchase_time) 索引各取一行
+    sql = (
+        'SELECT u.id AS user_id, u.username AS username, u.name AS name, '
+        "COALESCE(NULLIF(u.college, ''), :no_college) AS college, u.points AS points, "
+        f'{source.last_purchase} AS last_purchase '
+        'FROM "user" u WHERE COALESCE(u.is_admin, 0) = 0 AND u.points >= :min_points '
+        'ORDER BY u.points DESC, u.id'
+    )
+    params = {'no_college': NO_COLLEGE, 'min_points': min_points}
+    if limit:
+        sql += ' LIMIT :limit'
+        params['limit'] = limit
+    return text(sql).bindparams(**params)
+
+
+def purchase_details_statement(report_range, source=LIVE_PURCHASES):
+    clauses, params = report_range.conditions()
+    return text(
+        'SELECT purchase_record.id AS record_id, purchase_record.purchase_time AS purchase_time, '
+        "u.username AS username, u.name AS name, COALESCE(NULLIF(u.college, ''), :no_college) AS college, "
+        'product.name AS product_name, purchase_record.quantity AS quantity, '
+        'purchase_record.unit_price AS unit_price, purchase_record.total_cost AS total_cost '
+        f'FROM {source.table} '
+        'JOIN "user" u ON u.id = purchase_record.user_id '
+        'JOIN product ON product.id = purchase_record.product_id '
+        f'{_where(clauses)} '
+        'ORDER BY purchase_record.purchase_time, purchase_record.id'
+    ).bindparams(no_college=NO_COLLEGE, **params)
+
+
+def _rows(session, statement):
+    return [{key: _cell(value) for key, value in row._mapping.items()} for row in session.execute(statement)]
+
+
+def college_monthly(session, report_range, source=LIVE_PURCHASES):
+    return _rows(session, college_monthly_statement(report_range, source))
+
+
+def top_products(session, report_range, limit=20, source=LIVE_PURCHASES):
+    return _rows(session, top_products_statement(report_range, limit, source))
+
+
+def stock_turnover(session, report_range, now=None, source=LIVE_PURCHASES):
+    days = report_range.days(now or datetime.utcnow())
+    rows = _rows(session, stock_turnover_statement(report_range, source))
+    for row in rows:
+        # 售罄率 = 售出 / (售出 + 当前库存)；可售天数按区间内日均销量估算
+        row['sell_through'] = round(row['sold'] / (row['sold'] + row['stock']), 4) if row['sold'] + row['stock'] > 0 else None
+        row['days_of_stock'] = round(row['stock'] / (row['sold'] / days), 1) if days and row['sold'] else None
+    return rows
+
+
+def unused_balance(session, min_points=1, limit=50, source=LIVE_PURCHASES):
+    return {
+        'by_college': _rows(session, unused_balance_by_college_statement(min_points)),
+        'students': _rows(session, unused_balance_students_statement(min_points, limit, source)),
+    }
+
+
+# ---------- 缓存 ----------
+
+class ReportCache:
+    """报表结果的 LRU 缓存，read_versions() 返回的版本号与上次不同时清空
+
+    pysqlite 不为 SELECT 开启事务，读取版本号和计算报表之间可能有其他写入提交（写入与版本号递增在同一事务中）。
+    因此计算后再读一次版本号，有变化时这次的结果只返回不缓存，不会把新数据的结果记在旧版本号下。
+    """
+
+    def __init__(self, read_versions, depends_on=REPORT_VERSIONS, maxsize=64):
+        self._read_versions = read_versions
+        self.depends_on = depends_on
+        self.maxsize = maxsize
+        self._lock = threading.Lock()
+        self._versions = None
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def _current_versions(self):
+        all_versions = self._read_versions()
+        return tuple(all_versions.get(name, 0) for name in self.depends_on)
+
+    def get(self, key, compute):
+        versions = self._current_versions()
+        with self._lock:
+            if versions != self._versions:
+                self._entries.clear()
+                self._versions = versions
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return self._entries[key]
+            self.misses += 1
+        value = compute()
+        if self._current_versions() != versions:
+            return value
+        with self._lock:
+            if versions == self._versions:
+                self._entries[key] = value
+                while len(self._entries) > self.maxsize:
+                    self._entries.popitem(last=False)
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self._entries)}
+
+
+# ---------- 导出 ----------
+
+def _cell(value):
+    if isinstance(value, datetime):
+        return value.strftime('%Y-%m-%d %H:%M:%S')
+    if isinstance(value, str) and len(value) > 19 and value[4] == '-' and value[10] == ' ':
+        return value[:19]  # SQLite 返回的日期时间文本去掉微秒
+    return value
+
+
+def iter_csv(headers, rows, chunk_rows=1000):
+    """逐块生成 UTF-8 CSV（带BOM，Excel可以直接打开中文），rows 为元组的可迭代对象"""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(headers)
+    pending = 0
+    yield codecs.BOM_UTF8 + buffer.getvalue().encode('utf-8')
+    buffer.seek(0)
+    buffer.truncate()
+    for row in rows:
+        writer.writerow([_cell(value) for value in row])
+        pending += 1
+        if pending >= chunk_rows:
+            yield buffer.getvalue().encode('utf-8')
+            buffer.seek(0)
+            buffer.truncate()
+            pending = 0
+    if pending:
+        yield buffer.getvalue().encode('utf-8')
+
+
+def write_xlsx(path, title, headers, rows, on_progress=None, progress_every=5000):
+    """用 write_only 工作簿写出，返回行数；on_progress(行数) 每 progress_every 行调用一次"""
+    workbook = Workbook(write_only=True)
+    sheet = workbook.create_sheet(title[:31])
+    sheet.append(headers)
+    count = 0
+    for row in rows:
+        sheet.append([_cell(value) for value in row])
+        count += 1
+        if on_progress and count % progress_every == 0:
+            on_progress(count)
+    workbook.save(path)
+    return count
+
+
+# 可导出的报表：名称 -> (标题, 表头, statement(report_range, min_points, source))
+EXPORTS = {
+    'purchases': ('兑换明细',
+                  ['记录ID', '兑换时间', '学号', '姓名', '学院', '商品', '数量', '单价', '消耗积分'],
+                  lambda report_range, min_points, source: purchase_details_statement(report_range, source)),
+    'college_monthly': ('学院月度统计',
+                        ['学院', '月份', '消耗积分', '兑换件数', '兑换次数', '兑换人数'],
+                        lambda report_range, min_points, source: college_monthly_statement(report_range, source)),
+    'top_products': ('商品兑换排行',
+                     ['商品ID', '商品', '兑换件数', '消耗积分', '兑换次数', '兑换人数'],
+                     lambda report_range, min_points, source: top_products_statement(report_range, source=source)),
+    'stock_turnover': ('库存周转',
+                       ['商品ID', '商品', '当前库存', '售出件数', '兑换次数'],
+                       lambda report_range, min_points, source: stock_turnover_statement(report_range, source)),
+    'unused_balance': ('未使用积分学生',
+                       ['用户ID', '学号', '姓名', '学院', '剩余积分', '最近兑换时间'],
+                       lambda report_range, min_points, source: unused_balance_students_statement(
+                           min_points, source=source)),
+}
+
+
+def iter_export_rows(session, name, report_range, min_points=1, batch_size=2000, source=LIVE_PURCHASES):
+    """逐批读取导出数据，返回行元组的生成器"""
+    statement = EXPORTS[name][2](report_range, min_points, source)
+    result = session.execute(statement.execution_options(yield_per=batch_size))
+    for row in result:
+        yield tuple(row)
+
+
+def export_filename(name, report_range, ext):
+    return f'{EXPORTS[name][0]}_{report_range.label()}.{ext}'
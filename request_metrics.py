@@ -0,0 +1,213 @@
+"""请求级性能统计（可选开启）
+
+开启后每个请求记录：总耗时、SQL语句数和数据库耗时（SQLAlchemy 引擎事件）、模板渲染耗时，
+按路由端点汇总，由 /metrics 以 Prometheus 文本格式输出。
+同一请求内相同的SQL重复执行达到阈值时记为疑似 N+1 查询并写入日志。
+按采样率对部分请求开启 cProfile，只保留最慢的若干个 .prof 文件，
+可用 `python -m pstats <文件>` 或 snakeviz 查看。
+统计数据保存在进程内存中，多进程部署时每个worker分别统计。
+"""
+import cProfile
+import heapq
+import os
+import random
+import re
+import threading
+import time
+from collections import Counter, defaultdict
+
+from flask import g, has_request_context, request, before_render_template, template_rendered
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# 请求耗时直方图的分桶上限（秒）
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class EndpointStats:
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.duration = 0.0
+        self.buckets = [0] * len(DURATION_BUCKETS)
+        self.sql_statements = 0
+        self.sql_duration = 0.0
+        self.template_duration = 0.0
+        self.n_plus_one = 0
+
+    def observe(self, duration, status, sql_statements, sql_duration, template_duration, n_plus_one):
+        self.count += 1
+        if status >= 500:
+            self.errors += 1
+        self.duration += duration
+        for index, bound in enumerate(DURATION_BUCKETS):
+            if duration <= bound:
+                self.buckets[index] += 1
+        self.sql_statements += sql_statements
+        self.sql_duration += sql_duration
+        self.template_duration += template_duration
+        if n_plus_one:
+            self.n_plus_one += 1
+
+
+class RequestMetrics:
+    def __init__(self, app):
+        self.app = app
+        self.n_plus_one_threshold = app.config['METRICS_N_PLUS_ONE_THRESHOLD']
+        self.profile_sample_rate = app.config['METRICS_PROFILE_SAMPLE_RATE']
+        self.profile_dir = app.config['METRICS_PROFILE_DIR']
+        self.profile_keep = app.config['METRICS_PROFILE_KEEP']
+        self._lock = threading.Lock()
+        self._endpoints = defaultdict(EndpointStats)
+        self._slowest_profiles = []  # 小顶堆：(耗时, 文件路径)
+        self.profiles_written = 0
+
+    # ---------- 请求生命周期 ----------
+
+    def start_request(self):
+        g.metrics_started = time.perf_counter()
+        g.metrics_sql_count = 0
+        g.metrics_sql_duration = 0.0
+        g.metrics_sql_statements = Counter()
+        g.metrics_template_duration = 0.0
+        g.metrics_profiler = None
+        if self.profile_sample_rate and random.random() < self.profile_sample_rate:
+            profiler = cProfile.Profile()
+            try:
+                profiler.enable()
+            except ValueError:  # 同一进程中已有其他分析器在运行，本次不采样
+                return
+            g.metrics_profiler = profiler
+
+    def finish_request(self, response):
+        self._record(response.status_code)
+        return response
+
+    def teardown_request(self, exc):
+        # 未处理的异常不会经过 after_request，在这里按500记录
+        if 'metrics_started' in g:
+            self._record(500)
+
+    def _record(self, status_code):
+        started = g.pop('metrics_started', None)
+        if started is None:
+            return
+        duration = time.perf_counter() - started
+        profiler = g.pop('metrics_profiler', None)
+        if profiler is not None:
+            profiler.disable()
+
+        endpoint = request.endpoint or 'unknown'
+        repeated = [(statement, times) for statement, times in g.metrics_sql_statements.most_common(3)
+                    if times >= self.n_plus_one_threshold]
+        for statement, times in repeated:
+            self.app.logger.warning('疑似N+1查询：%s %s 中同一语句执行了 %d 次：%s',
+                                    request.method, request.path, times, _shorten(statement))
+        with self._lock:
+            self._endpoints[endpoint].observe(duration, status_code, g.metrics_sql_count,
+                                              g.metrics_sql_duration, g.metrics_template_duration,
+                                              bool(repeated))
+        if profiler is not None:
+            self._keep_profile(profiler, duration, endpoint)
+
+    def _keep_profile(self, profiler, duration, endpoint):
+        with self._lock:
+            if len(self._slowest_profiles) >= self.profile_keep and duration <= self._slowest_profiles[0][0]:
+                return
+            os.makedirs(self.profile_dir, exist_ok=True)
+            filename = f'{time.strftime("%Y%m%d-%H%M%S")}_{int(duration * 1000)}ms_{endpoint}_{os.getpid()}.prof'
+            path = os.path.join(self.profile_dir, filename)
+            profiler.dump_stats(path)
+            self.profiles_written += 1
+            heapq.heappush(self._slowest_profiles, (duration, path))
+            if len(self._slowest_profiles) > self.profile_keep:
+                _, evicted = heapq.heappop(self._slowest_profiles)
+                if os.path.exists(evicted):
+                    os.remove(evicted)
+
+    # ---------- SQL 与模板计时 ----------
+
+    def before_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        if has_request_context() and 'metrics_started' in g:
+            conn.info['metrics_query_started'] = time.perf_counter()
+
+    def after_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        started = conn.info.pop('metrics_query_started', None)
+        if started is None or not has_request_context() or 'metrics_started' not in g:
+            return
+        g.metrics_sql_duration += time.perf_counter() - started
+        g.metrics_sql_count += 1
+        # 参数化语句文本相同而参数不同，正是循环中逐条查询（N+1）的特征
+        g.metrics_sql_statements[statement] += 1
+
+    def before_render(self, sender, template, context, **extra):
+        if 'metrics_started' in g:
+            g.metrics_render_started = time.perf_counter()
+
+    def after_render(self, sender, template, context, **extra):
+        started = g.pop('metrics_render_started', None)
+        if started is not None:
+            g.metrics_template_duration += time.perf_counter() - started
+
+    # ---------- 输出 ----------
+
+    def render_prometheus(self, extra_gauges=None):
+        """Prometheus 文本格式；extra_gauges 为 {指标名: (说明, 数值)}"""
+        with self._lock:
+            endpoints = sorted(self._endpoints.items())
+            lines = [
+                '# HELP shop_request_duration_seconds 请求总耗时',
+                '# TYPE shop_request_duration_seconds histogram',
+            ]
+            for endpoint, stats in endpoints:
+                label = _label(endpoint)
+                for bound, cumulative in zip(DURATION_BUCKETS, stats.buckets):
+                    lines.append(f'shop_request_duration_seconds_bucket{{endpoint="{label}",le="{bound}"}} {cumulative}')
+                lines.append(f'shop_request_duration_seconds_bucket{{endpoint="{label}",le="+Inf"}} {stats.count}')
+                lines.append(f'shop_request_duration_seconds_sum{{endpoint="{label}"}} {stats.duration:.6f}')
+                lines.append(f'shop_request_duration_seconds_count{{endpoint="{label}"}} {stats.count}')
+            counters = [
+                ('shop_request_errors_total', '返回5xx的请求数', 'errors', '{}'),
+                ('shop_db_statements_total', '执行的SQL语句数', 'sql_statements', '{}'),
+                ('shop_db_duration_seconds_total', 'SQL执行总耗时', 'sql_duration', '{:.6f}'),
+                ('shop_template_render_seconds_total', '模板渲染总耗时', 'template_duration', '{:.6f}'),
+                ('shop_n_plus_one_requests_total', '出现疑似N+1查询的请求数', 'n_plus_one', '{}'),
+            ]
+            for name, help_text, attr, fmt in counters:
+                lines.append(f'# HELP {name} {help_text}')
+                lines.append(f'# TYPE {name} counter')
+                for endpoint, stats in endpoints:
+                    lines.append(f'{name}{{endpoint="{_label(endpoint)}"}} {fmt.format(getattr(stats, attr))}')
+            lines += [
+                '# HELP shop_profiles_written_total 保存的cProfile文件数',
+                '# TYPE shop_profiles_written_total counter',
+                f'shop_profiles_written_total {self.profiles_written}',
+            ]
+        for name, (help_text, value) in (extra_gauges or {}).items():
+            lines += [f'# HELP {name} {help_text}', f'# TYPE {name} gauge', f'{name} {value}']
+        return '\n'.join(lines) + '\n'
+
+
+def _label(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _shorten(statement, limit=200):
+    statement = re.sub(r'\s+', ' ', statement).strip()
+    return statement if len(statement) <= limit else statement[:limit] + '...'
+
+
+def init_request_metrics(app):
+    """METRICS_ENABLED 为真时注册请求钩子、SQL事件和模板信号，返回 RequestMetrics；否则返回 None"""
+    if not app.config.get('METRICS_ENABLED'):
+        return None
+    metrics = RequestMetrics(app)
+    app.extensions['request_metrics'] = metrics
+    app.before_request(metrics.start_request)
+    app.after_request(metrics.finish_request)
+    app.teardown_request(metrics.teardown_request)
+    event.listen(Engine, 'before_cursor_execute', metrics.before_cursor_execute)
+    event.listen(Engine, 'after_cursor_execute', metrics.after_cursor_execute)
+    before_render_template.connect(metrics.before_render, app)
+    template_rendered.connect(metrics.after_render, app)
+    return metrics
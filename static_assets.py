@@ -0,0 +1,150 @@
+"""静态资源指纹与长期缓存
+
+url_for('static', filename=...) 生成的地址会自动带上文件内容哈希（?v=<哈希>），
+带正确哈希的请求返回一年的 Cache-Control: immutable，文件内容变化后哈希随之变化，
+浏览器自动获取新版本；不带哈希的旧地址仍按默认方式协商缓存。
+JS/CSS 等文本文件可预先压缩为 .br / .gz，按 Accept-Encoding 直接返回压缩版本；
+视频等大文件支持 Range 请求，可以拖动进度条而不必下载整个文件。
+"""
+import gzip
+import hashlib
+import mimetypes
+import os
+import stat
+import threading
+
+from flask import request, send_from_directory
+from werkzeug.exceptions import NotFound
+from werkzeug.security import safe_join
+
+try:
+    import brotli
+except ImportError:  # brotli 为可选依赖，未安装时只生成 gzip
+    brotli = None
+
+IMMUTABLE_MAX_AGE = 365 * 24 * 3600
+COMPRESSIBLE_EXTENSIONS = ('.js', '.css', '.svg', '.json', '.txt', '.map')
+# (Accept-Encoding 中的名称, 文件后缀)，按优先级排列
+PRECOMPRESSED_ENCODINGS = (('br', '.br'), ('gzip', '.gz'))
+
+
+class AssetManifest:
+    """静态文件 -> 内容哈希 的映射，按文件的修改时间和大小缓存，文件变化后自动重新计算"""
+
+    def __init__(self, static_folder):
+        self.static_folder = static_folder
+        self._lock = threading.Lock()
+        self._entries = {}  # filename -> (mtime_ns, size, 哈希)
+
+    def fingerprint(self, filename):
+        path = safe_join(self.static_folder, filename)
+        if path is None:
+            return None
+        try:
+            info = os.stat(path)
+        except OSError:
+            return None
+        if not stat.S_ISREG(info.st_mode):
+            return None  # 目录等不是静态文件，按不存在处理
+        entry = self._entries.get(filename)
+        if entry and entry[0] == info.st_mtime_ns and entry[1] == info.st_size:
+            return entry[2]
+        digest = hashlib.sha256()
+        try:
+            with open(path, 'rb') as f:
+                for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                    digest.update(chunk)
+        except OSError:
+            return None  # 文件在 stat 之后被删除或无法读取
+        fingerprint = digest.hexdigest()[:12]
+        with self._lock:
+            self._entries[filename] = (info.st_mtime_ns, info.st_size, fingerprint)
+        return fingerprint
+
+    def as_dict(self):
+        return {filename: entry[2] for filename, entry in self._entries.items()}
+
+
+def _precompressed_file(static_folder, filename):
+    """按 Accept-Encoding 选择预压缩版本；压缩文件比原文件旧（修改后没有重新执行 precompress-static）时不使用"""
+    if not filename.endswith(COMPRESSIBLE_EXTENSIONS):
+        return None, None
+    source = safe_join(static_folder, filename)
+    for encoding, suffix in PRECOMPRESSED_ENCODINGS:
+        # 按质量值判断，"gzip;q=0" 表示不接受
+        if request.accept_encodings[encoding] <= 0:
+            continue
+        path = safe_join(static_folder, filename + suffix)
+        if path and os.path.isfile(path) and os.path.getmtime(path) >= os.path.getmtime(source):
+            return filename + suffix, encoding
+    return None, None
+
+
+def init_static_assets(app):
+    """接管 static 路由：url_for 自动附加内容哈希，响应附加长期缓存头和预压缩版本"""
+    manifest = AssetManifest(app.static_folder)
+    app.extensions['asset_manifest'] = manifest
+
+    @app.url_defaults
+    def add_asset_fingerprint(endpoint, values):
+        if endpoint == 'static' and 'filename' in values and 'v' not in values:
+            fingerprint = manifest.fingerprint(values['filename'])
+            if fingerprint:
+                values['v'] = fingerprint
+
+    def static(filename):
+        fingerprint = manifest.fingerprint(filename)
+        if fingerprint is None:
+            raise NotFound()
+        immutable = request.args.get('v') == fingerprint
+
+        compressed, encoding = _precompressed_file(app.static_folder, filename)
+        if compressed:
+            # 按原文件名推断 Content-Type，压缩版本只改变传输编码
+            response = send_from_directory(app.static_folder, compressed, conditional=True,
+                                           mimetype=_guess_mimetype(filename))
+            response.headers['Content-Encoding'] = encoding
+        else:
+            # conditional=True 时支持 If-None-Match 和 Range（视频拖动进度条）
+            response = send_from_directory(app.static_folder, filename, conditional=True)
+        if filename.endswith(COMPRESSIBLE_EXTENSIONS):
+            response.vary.add('Accept-Encoding')
+        if immutable:
+            response.cache_control.no_cache = None
+            response.cache_control.public = True
+            response.cache_control.max_age = IMMUTABLE_MAX_AGE
+            response.cache_control.immutable = True
+            response.expires = None
+        return response
+
+    app.view_functions['static'] = static
+    return manifest
+
+
+def _guess_mimetype(filename):
+    return mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+
+
+def precompress_static(static_folder, log=print):
+    """为可压缩的静态文件生成 .gz（以及安装了brotli时的 .br），源文件未变化时跳过"""
+    created = 0
+    for root, _dirs, files in os.walk(static_folder):
+        for name in files:
+            if not name.endswith(COMPRESSIBLE_EXTENSIONS):
+                continue
+            path = os.path.join(root, name)
+            with open(path, 'rb') as f:
+                data = f.read()
+            outputs = [('.gz', lambda d: gzip.compress(d, compresslevel=9, mtime=0))]
+            if brotli is not None:
+                outputs.append(('.br', lambda d: brotli.compress(d, quality=11)))
+            for suffix, compress in outputs:
+                target = path + suffix
+                if os.path.exists(target) and os.path.getmtime(target) >= os.path.getmtime(path):
+                    continue
+                compressed = compress(data)
+                with open(target, 'wb') as f:
+                    f.write(compressed)
+                created += 1
+                log(f'{os.path.relpath(target, static_folder)}：{len(data)} -> {len(compressed)} 字节')
+    return created
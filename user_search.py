@@ -0,0 +1,147 @@
+"""学生搜索索引：SQLite FTS5 trigram
+
+user_search 是以 user 表为外部内容的 FTS5 虚拟表，索引学号、姓名和学院，
+trigram 分词按每三个连续字符建立索引，中文姓名和学号的任意子串（至少3个字符）都能命中，
+结果按 bm25 相关度排序。命中很多时（例如只输入入学年份）计算相关度需要对所有命中排序，
+这种宽泛的查询改为按id排序并按id键集分页，保证每次查询（包括很后面的页）都在毫秒级完成。
+user 表上的触发器在新增、删除和修改这三列时同步索引，修改积分等其他列不会触发。
+
+trigram 无法匹配少于3个字符的词，这类词在索引命中的结果中再用 LIKE 过滤；
+所有条件都少于3个字符时 search_user_ids 返回 None，由调用方按原来的方式查询。
+SQLite 3.34 之前没有 trigram 分词器，此时不建索引，同样回退到原来的查询。
+"""
+import sqlite3
+
+from sqlalchemy import text
+
+SEARCH_TABLE = 'user_search'
+MIN_TERM_LENGTH = 3  # trigram 能匹配的最短字符数
+RANK_LIMIT = 1000  # 命中数不超过此值时按相关度排序，否则按id排序
+
+_TRIGGERS = {
+    'user_search_ai': (
+        'CREATE TRIGGER IF NOT EXISTS user_search_ai AFTER INSERT ON "user" BEGIN '
+        'INSERT INTO user_search (rowid, username, name, college) '
+        'VALUES (new.id, new.username, new.name, new.college); END'
+    ),
+    'user_search_ad': (
+        'CREATE TRIGGER IF NOT EXISTS user_search_ad AFTER DELETE ON "user" BEGIN '
+        "INSERT INTO user_search (user_search, rowid, username, name, college) "
+        "VALUES ('delete', old.id, old.username, old.name, old.college); END"
+    ),
+    'user_search_au': (
+        'CREATE TRIGGER IF NOT EXISTS user_search_au AFTER UPDATE OF username, name, college ON "user" BEGIN '
+        "INSERT INTO user_search (user_search, rowid, username, name, college) "
+        "VALUES ('delete', old.id, old.username, old.name, old.college); "
+        'INSERT INTO user_search (rowid, username, name, college) '
+        'VALUES (new.id, new.username, new.name, new.college); END'
+    ),
+}
+
+
+def trigram_available():
+    """当前 SQLite 是否支持 FTS5 和 trigram 分词器"""
+    connection = sqlite3.connect(':memory:')
+    try:
+        connection.execute("CREATE VIRTUAL TABLE probe USING fts5(value, tokenize='trigram')")
+        return True
+    except sqlite3.OperationalError:
+        return False
+    finally:
+        connection.close()
+
+
+def create_search_index(connection):
+    """创建索引表和触发器，并按 user 表现有数据重建索引；不支持 trigram 时返回 False"""
+    if not trigram_available():
+        return False
+    connection.execute(text(
+        'CREATE VIRTUAL TABLE IF NOT EXISTS user_search USING fts5('
+        "username, name, college, content='user', content_rowid='id', tokenize='trigram')"
+    ))
+    for ddl in _TRIGGERS.values():
+        connection.execute(text(ddl))
+    connection.execute(text("INSERT INTO user_search (user_search) VALUES ('rebuild')"))
+    return True
+
+
+def search_index_exists(connection):
+    return connection.execute(text(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = :name"
+    ), {'name': SEARCH_TABLE}).first() is not None
+
+
+def _phrase(term):
+    return '"' + term.replace('"', '""') + '"'
+
+
+def contains_pattern(term):
+    """子串匹配的 LIKE 模式，% _ \\ 转义为普通字符（配合 ESCAPE '\\'）"""
+    return '%' + term.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
+
+
+def uses_index(keyword, college=''):
+    """关键字或学院中有至少3个字符的词时可以使用索引"""
+    terms = keyword.split() + ([college] if college else [])
+    return any(len(term) >= MIN_TERM_LENGTH for term in terms)
+
+
+def search_user_ids(connection, keyword, college='', limit=20, cursor=''):
+    """按学号/姓名关键字（空格分隔的多个词都要匹配）和学院搜索，返回 (按顺序的用户id, 下一页的游标或None)
+
+    完全等于学号或姓名的排在最前，其余按 bm25 排序；命中超过 RANK_LIMIT 时按id排序。
+    第一页按命中数决定排序方式，之后的页沿用游标中的方式：
+    - 按相关度排序的游标为 'r<偏移量>'：每页都要重新计算相关度并跳过前面的命中，但命中数不超过 RANK_LIMIT，
+      最多翻到第 RANK_LIMIT 个结果为止，后面的页同样在毫秒级完成；
+    - 按id排序的游标为 'k<上一页最后的用户id>'（键集分页），宽泛的关键字翻到很后面的页也只读取一页的行。
+    没有可以用索引匹配的词时返回 None；游标格式错误时抛出 ValueError。
+    """
+    match_parts, conditions = [], []
+    params = {'limit': limit + 1, 'exact': keyword}
+    for index, term in enumerate(keyword.split()):
+        if len(term) >= MIN_TERM_LENGTH:
+            match_parts.append('{username name} : ' + _phrase(term))
+        else:
+            params[f'term{index}'] = contains_pattern(term)
+            conditions.append(f"(u.username LIKE :term{index} ESCAPE '\\' OR u.name LIKE :term{index} ESCAPE '\\')")
+    if college:
+        if len(college) >= MIN_TERM_LENGTH:
+            match_parts.append('college : ' + _phrase(college))
+        else:
+            params['college'] = contains_pattern(college)
+            conditions.append("u.college LIKE :college ESCAPE '\\'")
+    if not match_parts:
+        return None  # 与 uses_index 返回 False 的情况相同
+    params['match'] = ' AND '.join(match_parts)
+    source = ('FROM user_search JOIN "user" u ON u.id = user_search.rowid WHERE user_search MATCH :match '
+              + ''.join(f'AND {condition} ' for condition in conditions))
+
+    if cursor:
+        ranked, position = cursor[0] == 'r', int(cursor[1:])
+        if cursor[0] not in 'rk' or position < 0:
+            raise ValueError(cursor)
+    else:
+        # 不排序时按文档顺序取前 RANK_LIMIT+1 个命中，开销与命中总数无关
+        params['rank_limit'] = RANK_LIMIT + 1
+        hits = connection.execute(text(f'SELECT COUNT(*) FROM (SELECT 1 {source}LIMIT :rank_limit)'), params).scalar()
+        ranked, position = hits <= RANK_LIMIT, 0
+
+    if ranked:
+        if position >= RANK_LIMIT:
+            return [], None
+        params['offset'] = position
+        # bm25 各列权重：学号、姓名、学院
+        order = 'u.username = :exact DESC, u.name = :exact DESC, bm25(user_search, 10.0, 10.0, 1.0), u.id'
+        rows = connection.execute(text(f'SELECT u.id {source}ORDER BY {order} LIMIT :limit OFFSET :offset'), params)
+    else:
+        params['after'] = position
+        rows = connection.execute(text(
+            f'SELECT u.id {source}AND user_search.rowid > :after ORDER BY user_search.rowid LIMIT :limit'), params)
+    user_ids = [row[0] for row in rows]
+    if len(user_ids) <= limit:
+        return user_ids, None
+    user_ids = user_ids[:limit]
+    if ranked:
+        next_position = position + limit
+        return user_ids, (f'r{next_position}' if next_position < RANK_LIMIT else None)
+    return user_ids, f'k{user_ids[-1]}'
@@ -0,0 +1,8 @@
+"""WSGI 入口：gunicorn -c gunicorn.conf.py wsgi:app
+
+数据库初始化（建表、迁移、默认管理员）由 gunicorn.conf.py 在启动 worker 之前执行一次（主进程本身不导入 app），
+每个 worker 进程导入本模块时启动自己的后台任务线程。
+"""
+from app import app, start_job_worker  # noqa: F401
+
+start_job_worker()